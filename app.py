@@ -1,15 +1,27 @@
 import os
 import sys
+import hmac
+import json
+import time
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from dataclasses import dataclass
 from typing import List, Optional
-from utils.llm.openai import OpenAIChat
 from service import TSID
+from service import classify
+from service import sandbox
+from service import images
+from service import progress
 from service.deploy import k8s
+from service.deploy import lifecycle
 
+from config import Config
+from service.jobs import DEFAULT_LANE, AdmissionRejected, Handoff, Job, JobManager
 from utils import CodeRequest
+from utils.cache import make_key
+from utils import metrics
+from utils import tracing
 
 intro = """CodeAIdapter 是一款旨在協助開發者更有效率地解決程式問題的工具。我們提供以下服務：
 1. 版本轉換
@@ -23,106 +35,326 @@ intro = """CodeAIdapter 是一款旨在協助開發者更有效率地解決程
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+jobs = JobManager(
+    max_workers=Config.JOB_WORKERS,
+    result_ttl=Config.JOB_RESULT_TTL,
+    dedup_ttl=Config.JOB_DEDUP_TTL,
+    max_queue=Config.JOB_QUEUE,
+    lane_workers=Config.JOB_LANE_WORKERS,
+    lane_queue=Config.JOB_LANE_QUEUE,
+    client_limit=Config.CLIENT_MAX_INFLIGHT,
+)
+images.prepull()
+k8s.prewarm_base_images()
+lifecycle.reaper.start()
+
 @app.route("/")
 def index():
     return "Hello, World!"
  
+def parse_request() -> CodeRequest:
+    data = request.get_json(force=True)
+
+    print('[app.py] Received data:', file=sys.stderr)
+    for key, value in data.items(): print(f"{key}: {value}", file=sys.stderr)
+
+    return CodeRequest(
+        prompt=data.get("prompt"),
+        file=data.get("file"),
+        filename=data.get("filename"),
+    )
+
+def request_key() -> Optional[str]:
+    """
+    Dedup key of the current request: the JSON body independent of key order and
+    formatting, plus the client's Idempotency-Key header if it sent one.
+    """
+    if not Config.JOB_DEDUP:
+        return None
+    body = json.dumps(request.get_json(force=True), sort_keys=True, ensure_ascii=False)
+    return make_key("analyze", request.headers.get("Idempotency-Key", ""), body)
+
+# Lane of each class code, requests that are answered right away use the default lane
+LANES = {1: "A1", 2: "A2", 3: "A3", 4: "B", 5: "deploy"}
+# Requests only the LLM can classify wait here, then move on to the lane of their task
+CLASSIFY_LANE = "classify"
+
+def client_id() -> str:
+    """
+    Who a request is counted against. Headers only name the client when the request came
+    through one of the TRUSTED_PROXIES, which must set or strip X-Client-Id itself.
+    """
+    address = request.remote_addr or "unknown"
+    if address not in Config.TRUSTED_PROXIES:
+        return address
+    if request.headers.get("X-Client-Id"):
+        return request.headers["X-Client-Id"]
+    # The nearest address the trusted proxies did not add is the client's
+    forwarded = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    for hop in reversed(forwarded):
+        if hop not in Config.TRUSTED_PROXIES:
+            return hop
+    return address
+
+def job_call(code_request: CodeRequest, class_code: Optional[int]) -> tuple:
+    """
+    Function, arguments and lane of the job for a request. A request without a class code
+    is classified by the LLM inside its job, see `classify_llm`.
+    """
+    if class_code is None:
+        return classify_llm, (code_request,), CLASSIFY_LANE
+    return analyze, (code_request, class_code), LANES.get(class_code, DEFAULT_LANE)
+
+def admit(code_request: CodeRequest) -> Job:
+    """
+    Queue a request in the lane of its task, so a burst of deploys cannot hold up quick
+    conversions. Only the fast path and the classification cache run before the request is
+    queued, so the job id and the first byte of a stream go out right away; requests they
+    cannot answer are classified by the LLM in their job. Duplicates attach to the running job.
+
+    Raises:
+        AdmissionRejected: If the lane is full or the client has too many requests in flight.
+    """
+    key = request_key()
+    job = jobs.attach(key)
+    if job is not None:
+        return job
+    start = time.monotonic()
+    class_code = classify.quick_classify(code_request)
+    elapsed = time.monotonic() - start
+    fn, args, lane = job_call(code_request, class_code)
+    job = jobs.submit(fn, *args, dedup_key=key, lane=lane, client=client_id())
+    job.timings.setdefault("classify", elapsed)
+    return job
+
+def classify_llm(code_request: CodeRequest) -> Handoff:
+    # A classifier error fails the job like any other error
+    with tracing.span("classify"):
+        class_code = classify.slow_classify(code_request)
+    return Handoff(LANES.get(class_code, DEFAULT_LANE), analyze, (code_request, class_code))
+
+def server_timing(job: Job) -> str:
+    """
+    Server-Timing of a job: the stages of its trace, the classification done at admission
+    or in the classify lane and the time it waited for workers.
+    """
+    entries = [tracing.server_timing(job.trace)]
+    entries += [f"{name};dur={seconds * 1000:.1f}" for name, seconds in job.timings.items()]
+    if job.started_at is not None:
+        entries.append(f"queue;dur={job.queue_seconds * 1000:.1f}")
+    return ", ".join(entry for entry in entries if entry)
+
+def rejected(e: AdmissionRejected):
+    print('[app.py] Rejected:', e, file=sys.stderr)
+    return jsonify({
+        "status": "error",
+        "message": str(e)
+    }), 429, {"Retry-After": str(e.retry_after)}
+
+def analyze(code_request: CodeRequest, class_code: int) -> dict:
+    progress.emit("classified", f"Class code: {class_code}", class_code=class_code)
+    if class_code <= 0:
+        if class_code == -1:
+            ret_msg = "非程式相關技術問題\n\n"
+        else:
+            ret_msg = "抱歉，目前不支援您的需求\n\n"
+        ret_msg += intro
+        response = {
+            "file": "",
+            "filename": "",
+            "message": ret_msg
+        }
+    
+    else:
+            assert 1 <= class_code <= 5
+            if class_code < 5:
+                task = "B"
+                if class_code == 1:
+                    task = "A1"
+                elif class_code == 2:  
+                    task = "A2"
+                elif class_code == 3:
+                    task = "A3"
+                code_res = TSID.StartProcess(code_request.file , task, code_request.prompt)
+                prefix = "已成功完成程式轉換，執行結果：\n"
+            else:
+                code_res = k8s.deploy_handle(code_request.prompt, code_request.filename, code_request.file)
+                prefix = "部署成功：\n"
+    
+            if code_res.status == False:
+                response = {
+                    "file": "",
+                    "filename": "",
+                    "message": "抱歉，目前無法完成您的需求。\nerror message:\n" + code_res.error_msg
+                }
+            else:
+                response = {
+                    "file": code_res.file,
+                    "filename": code_res.filename,
+                    "message": prefix + code_res.success_msg
+                }
+            if code_res.usage:
+                response["usage"] = code_res.usage
+    
+    print('[server response]', file=sys.stderr)
+    for key, value in response.items(): print(f"{key}: {value}", file=sys.stderr)
+
+    return response
+
 @app.route("/api", methods=["POST"])
 def api_analyze():
     try:
-        data = request.get_json(force=True)
+        code_request = parse_request()
 
-        print('[app.py] Received data:', file=sys.stderr)
-        for key, value in data.items(): print(f"{key}: {value}", file=sys.stderr)
+        # Old clients still get a blocking call, the work itself runs on the job pool
+        job = admit(code_request)
+        job.wait()
+        if job.exception is not None:
+            raise job.exception
 
-        code_request = CodeRequest(
-            prompt=data.get("prompt"),
-            file=data.get("file"),
-            filename=data.get("filename"),
-        )
+        return jsonify(job.result), 200, {"Server-Timing": server_timing(job)}
+
+    except AdmissionRejected as e:
+        return rejected(e)
+    except Exception as e:
+        print('[error]', e, file=sys.stderr)
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
 
-        cs = {
-            1: "版本轉換",
-            2: "語言轉換：不同程式語言之間的轉換",
-            3: "效能優化",
-            4: "程式debug：找出程式的錯誤，並回傳可以成功執行的程式",
-            5: "部署請求",
+@app.route("/api/jobs", methods=["POST"])
+def api_submit_job():
+    try:
+        code_request = parse_request()
+        job = admit(code_request)
+        return jsonify(job.to_dict()), 202, {"Location": f"/api/jobs/{job.id}"}
+
+    except AdmissionRejected as e:
+        return rejected(e)
+    except Exception as e:
+        print('[error]', e, file=sys.stderr)
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def api_job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Job not found: {job_id}"}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def api_job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Job not found: {job_id}"}), 404
+    if not job.done:
+        return jsonify(job.to_dict()), 202
+    headers = {"Server-Timing": server_timing(job)}
+    if job.exception is not None:
+        return jsonify({
+            "status": "error",
+            "message": job.error
+        }), 400, headers
+    return jsonify(job.result), 200, headers
+
+def event_stream(job, after: int = 0):
+    # Open with a comment so the client gets its first byte before any stage finishes
+    yield "retry: 3000\n: connected\n\n"
+    for event in job.progress.follow(after=after):
+        yield event.to_sse() if event is not None else ": heartbeat\n\n"
+
+def sse_response(job, after: int = 0):
+    return Response(
+        stream_with_context(event_stream(job, after)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.route("/api/jobs/<job_id>/events", methods=["GET"])
+def api_job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Job not found: {job_id}"}), 404
+    after = request.headers.get("Last-Event-ID") or request.args.get("after", "0")
+    if not str(after).isdigit():
+        return jsonify({"status": "error", "message": f"Invalid event id: {after}"}), 400
+    return sse_response(job, int(after))
+
+@app.route("/api/stream", methods=["POST"])
+def api_stream():
+    try:
+        code_request = parse_request()
+        job = admit(code_request)
+        return sse_response(job)
+
+    except AdmissionRejected as e:
+        return rejected(e)
+    except Exception as e:
+        print('[error]', e, file=sys.stderr)
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+def parse_batch() -> List[Optional[CodeRequest]]:
+    data = request.get_json(force=True)
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError("Expected a non-empty list under 'items'")
+    if len(items) > Config.BATCH_MAX_ITEMS:
+        raise ValueError(f"A batch holds at most {Config.BATCH_MAX_ITEMS} items, got {len(items)}")
+    print(f'[app.py] Received batch of {len(items)} items', file=sys.stderr)
+
+    # Malformed items fail on their own, the rest of the batch still runs
+    return [
+        CodeRequest(prompt=item.get("prompt"), file=item.get("file"), filename=item.get("filename"))
+        if isinstance(item, dict) and item.get("prompt") else None
+        for item in items
+    ]
+
+def batch_results(code_requests: List[Optional[CodeRequest]], client: str):
+    """
+    Classify the batch in shared LLM calls, run each item in the lane of its task, counted
+    against the client, and yield each item's result as soon as it is done.
+    """
+    valid = [i for i, code_request in enumerate(code_requests) if code_request is not None]
+    for i, code_request in enumerate(code_requests):
+        if code_request is None:
+            yield {"index": i, "status": "failed", "error": "Item needs a 'prompt'"}
+
+    try:
+        class_codes = classify.classify_many([code_requests[i] for i in valid])
+    except Exception as e:
+        print('[app.py] Batch classification failed:', e, file=sys.stderr)
+        class_codes = [None] * len(valid)
+
+    calls = [job_call(code_requests[i], class_code) for i, class_code in zip(valid, class_codes)]
+    for n, job in jobs.submit_many(calls, concurrency=Config.BATCH_CONCURRENCY, client=client):
+        result = {
+            "index": valid[n],
+            "filename": code_requests[valid[n]].filename,
+            "job_id": job.id,
+            "status": job.status,
         }
-        cs_str = "\n".join([f"{key}: {value}" for key, value in cs.items()])
-        dev_prot = (
-            "請幫我將使用者的需求分類為以下幾項，只能回傳需求的編號，不能包含任何其他字串\n"
-            "若非程式相關技術問題請回傳-1\n"
-            "若為技術問題，請根據使用者附的程式分析來源程式是什麼語言，再根據使用者的prompt分析目標程式分別是什麼語言，若其中任一為python, java外的語言，請回傳0\n"
-            "若為以下未條列的技術問題也請回傳0：\n"
-            f'{cs_str}\n'
-        )
-        
-        usr_prot = f'{code_request.prompt}\n'
-        if code_request.filename: usr_prot += f'source file name: {code_request.filename}\n'
-        if code_request.file: usr_prot += f'source code: \n{code_request.file}\n'
-
-        print('[dev prompt]', file=sys.stderr)
-        print(dev_prot+'\n', file=sys.stderr)
-        print('[user prompt]', file=sys.stderr)
-        print(usr_prot+'\n', file=sys.stderr)
-
-        gpt = OpenAIChat()
-        response = gpt.chat(dev_prot, usr_prot)
-        print('[gpt response]', file=sys.stderr)
-        print(response+'\n', file=sys.stderr)
-
-        if not isinstance(response, str):
-            raise ValueError(f'Invalid response by llm: {response}')
-        class_code = int(response)
-        if class_code <= 0:
-            if class_code == -1:
-                ret_msg = "非程式相關技術問題\n\n"
-            else:
-                ret_msg = "抱歉，目前不支援您的需求\n\n"
-            ret_msg += intro
-            response = {
-                "file": "",
-                "filename": "",
-                "message": ret_msg
-            }
-        
+        if job.exception is not None:
+            result["error"] = job.error
         else:
-                if class_code not in cs:
-                    raise ValueError(f'Invalid class code: {class_code}')
-                
-                assert 1 <= class_code <= 5
-                if class_code < 5:
-                    task = "B"
-                    if class_code == 1:
-                        task = "A1"
-                    elif class_code == 2:  
-                        task = "A2"
-                    elif class_code == 3:
-                        task = "A3"
-                    code_res = TSID.StartProcess(code_request.file , task, code_request.prompt)
-                    prefix = "已成功完成程式轉換，執行結果：\n"
-                else:
-                    code_res = k8s.deploy_handle(code_request.prompt, code_request.filename, code_request.file)
-                    prefix = "部署成功：\n"
-        
-                if code_res.status == False:
-                    response = {
-                        "file": "",
-                        "filename": "",
-                        "message": "抱歉，目前無法完成您的需求。\nerror message:\n" + code_res.error_msg
-                    }
-                else:
-                    response = {
-                        "file": code_res.file,
-                        "filename": code_res.filename,
-                        "message": prefix + code_res.success_msg
-                    }
-        
-        print('[server response]', file=sys.stderr)
-        for key, value in response.items(): print(f"{key}: {value}", file=sys.stderr)
-
-        return jsonify(response), 200
-        
+            result["response"] = job.result
+        yield result
+
+@app.route("/api/batch", methods=["POST"])
+def api_batch():
+    try:
+        code_requests = parse_batch()
+        client = client_id()
+        # Each item is admitted on its own as the batch runs, a client at its limit is turned away up front
+        jobs.admit(client=client)
+    except AdmissionRejected as e:
+        return rejected(e)
     except Exception as e:
         print('[error]', e, file=sys.stderr)
         return jsonify({
@@ -130,5 +362,57 @@ def api_analyze():
             "message": str(e)
         }), 400
 
+    if request.args.get("stream", "false").lower() == "true" or "application/x-ndjson" in request.headers.get("Accept", ""):
+        lines = (json.dumps(result, ensure_ascii=False) + "\n" for result in batch_results(code_requests, client))
+        return Response(
+            stream_with_context(lines),
+            mimetype="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    results = sorted(batch_results(code_requests, client), key=lambda result: result["index"])
+    succeeded = sum(1 for result in results if "response" in result)
+    return jsonify({
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results,
+    }), 200
+
+@app.route("/api/stats", methods=["GET"])
+def api_stats():
+    return jsonify({
+        "jobs": jobs.stats(),
+        "classify_cache": classify.cache.stats(),
+        "classify_fast_path": classify.agreement.stats(),
+        "sandbox_pool": sandbox.pool.stats(),
+        "run_cache": TSID.run_cache.stats(),
+        "image_store": images.store.stats(),
+        "lifecycle": lifecycle.reaper.stats(),
+    }), 200
+
+def is_admin() -> bool:
+    """
+    Admin routes need the ADMIN_TOKEN as a bearer token and are closed when no token is set.
+    Behind the proxy every request comes from localhost, so the address proves nothing.
+    """
+    if not Config.ADMIN_TOKEN:
+        return False
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    return hmac.compare_digest(token.encode(), Config.ADMIN_TOKEN.encode())
+
+# Outside /api/* so the open CORS rule does not apply
+@app.route("/admin/lifecycle/sweep", methods=["POST"])
+def admin_lifecycle_sweep():
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    # ?all=true reclaims every finished deploy regardless of TTLs and quotas
+    everything = request.args.get("all", "false").lower() == "true"
+    return jsonify(lifecycle.reaper.sweep(everything=everything)), 200
+
+@app.route("/metrics", methods=["GET"])
+def api_metrics():
+    payload, content_type = metrics.export()
+    return Response(payload, headers={"Content-Type": content_type})
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080, debug=False)
@@ -0,0 +1,135 @@
+import os
+import re
+import json
+from typing import Dict, List, Optional
+
+from utils.llm.replay import ReplayChat, REPLAY, parse_latency
+
+FAKEBIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakebin")
+
+PYTHON_CODE = "def main():\n    print(sum(i * i for i in range(1000)))\n\nmain()\n"
+JAVA_CODE = (
+    "public class Main {\n"
+    "    public static void main(String[] args) {\n"
+    "        long total = 0;\n"
+    "        for (int i = 0; i < 1000; i++) total += (long) i * i;\n"
+    "        System.out.println(total);\n"
+    "    }\n"
+    "}\n"
+)
+
+def use_fake_tools(docker_latency: float, sandbox_latency: float, sandbox_fail_rate: float,
+                   build_latency: float, kubectl_latency: float, pod_latency: float):
+    """
+    Put the stand-in docker, sudo and kubectl executables first on PATH and set their latencies.
+    Subprocesses started by the server inherit both.
+    """
+    os.environ["PATH"] = FAKEBIN + os.pathsep + os.environ.get("PATH", "")
+    os.environ.update({
+        "BENCH_DOCKER_LATENCY": str(docker_latency),
+        "BENCH_SANDBOX_LATENCY": str(sandbox_latency),
+        "BENCH_SANDBOX_FAIL_RATE": str(sandbox_fail_rate),
+        "BENCH_BUILD_LATENCY": str(build_latency),
+        "BENCH_KUBECTL_LATENCY": str(kubectl_latency),
+        "BENCH_POD_LATENCY": str(pod_latency),
+    })
+
+class SyntheticChat(ReplayChat):
+    def __init__(self, latency: str = ""):
+        """
+        Stand-in LLM that answers every call site with a plausible synthetic response, so the
+        benchmark needs neither the API nor recorded fixtures. Plugs in as a replay backend.
+
+        Args:
+            latency (str): Latency distribution spec, see utils.llm.replay.parse_latency.
+        """
+        self.mode = REPLAY
+        self.sampler = parse_latency(latency)
+
+    def lookup(self, dev_prompt: str, usr_prompt: str, model: str, response_format: Optional[dict] = None, history: Optional[List[Dict[str, str]]] = None) -> dict:
+        return {"response": self.respond(dev_prompt, usr_prompt, response_format, history), "latency": None}
+
+    def record(self, *args, **kwargs):
+        raise RuntimeError("The synthetic LLM backend cannot record")
+
+    def respond(self, dev_prompt: str, usr_prompt: str, response_format: Optional[dict] = None, history: Optional[List[Dict[str, str]]] = None) -> str:
+        if response_format and response_format.get("json_schema", {}).get("name") == "deploy_bundle":
+            return json.dumps({
+                "dockerfile": self._dockerfile(usr_prompt),
+                "config_yaml": self._config_yaml(usr_prompt),
+            })
+        if response_format and response_format.get("json_schema", {}).get("name") == "classify_batch":
+            items = re.split(r"^### 需求 \d+\n", usr_prompt, flags=re.M)[1:]
+            return json.dumps({"classes": [self._class_code(item) for item in items]})
+        if "You fix code that failed" in dev_prompt:
+            return self._fixed(history)
+        if "請幫我將使用者的需求分類" in dev_prompt:
+            return str(self._class_code(usr_prompt))
+        if "Please give me Dockerfile content" in dev_prompt:
+            return self._dockerfile(usr_prompt)
+        if "content of the config.yaml file based on" in dev_prompt:
+            return self._config_yaml(usr_prompt)
+        if "Please give me a report" in dev_prompt:
+            return "Docker Image tag: synthetic\nPod Name: synthetic\nPod Output: ok\n"
+        if "Please only give me the code content" in dev_prompt:
+            return PYTHON_CODE
+        if "to Java" in dev_prompt or ("java code" in dev_prompt.lower() and "to Python" not in dev_prompt):
+            return json.dumps({"code": JAVA_CODE, "language": "java", "docker_image": "openjdk:21", "class_name": "Main"})
+        return json.dumps({"code": PYTHON_CODE, "language": "python", "docker_image": "python:3.12", "class_name": "output"})
+
+    @staticmethod
+    def _fixed(history: Optional[List[Dict[str, str]]]) -> str:
+        answers = [m["content"] for m in history or () if m["role"] == "assistant" and m["content"].startswith("{")]
+        answer = json.loads(answers[-1]) if answers else {"code": PYTHON_CODE, "language": "python", "docker_image": "python:3.12", "class_name": "output"}
+        # Every fix changes the code, like a real model would
+        comment = "//" if answer["language"] == "java" else "#"
+        answer["code"] = f"{answer['code'].rstrip()}\n{comment} fix {len(history or ())}\n"
+        return json.dumps(answer)
+
+    @staticmethod
+    def _class_code(usr_prompt: str) -> int:
+        prompt = usr_prompt.lower()
+        if "deploy" in prompt or "部署" in prompt:
+            return 5
+        if "optimi" in prompt or "faster" in prompt:
+            return 3
+        if "error" in prompt or "fix" in prompt or "bug" in prompt:
+            return 4
+        if "version" in prompt or re.search(r"\b[23]\.\d+\b|\bjava\s*\d+\b", prompt):
+            return 1
+        return 2
+
+    @staticmethod
+    def _pod_name(usr_prompt: str) -> str:
+        match = re.search(r"Pod name:\s*(\S+)", usr_prompt)
+        return match.group(1) if match else "codeaidapter-synthetic"
+
+    @staticmethod
+    def _dockerfile(usr_prompt: str) -> str:
+        match = re.search(r"File:\s*(\S+)", usr_prompt)
+        filename = match.group(1) if match else "app.py"
+        return (
+            "FROM python:3.12-slim\n"
+            "WORKDIR /app\n"
+            f"COPY {filename} .\n"
+            "RUN pip install --no-cache-dir requests\n"
+            f'CMD ["python", "{filename}"]\n'
+        )
+
+    def _config_yaml(self, usr_prompt: str) -> str:
+        pod_name = self._pod_name(usr_prompt)
+        match = re.search(r"Docker image tag:\s*(\S+)", usr_prompt)
+        image = match.group(1) if match else f"{pod_name}:latest"
+        return (
+            "apiVersion: v1\n"
+            "kind: Pod\n"
+            "metadata:\n"
+            f"  name: {pod_name}\n"
+            "  labels:\n"
+            f"    app: {pod_name}\n"
+            "spec:\n"
+            "  restartPolicy: Never\n"
+            "  containers:\n"
+            f"  - name: {pod_name}\n"
+            f"    image: {image}\n"
+        )
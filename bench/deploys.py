@@ -0,0 +1,82 @@
+"""
+Concurrency check for deploys. Runs many K8sService deploys in parallel threads against
+the stand-in docker and kubectl, which fail when a build or apply runs from another
+deploy's directory, and exits non-zero if any deploy failed:
+
+    python -m bench.deploys --deploys 64 --concurrency 16
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+DOCKERFILE = "FROM python:3.12-slim\nCOPY app.py .\nCMD [\"python\", \"app.py\"]\n"
+CONFIG_YAML = (
+    "apiVersion: v1\n"
+    "kind: Pod\n"
+    "metadata:\n"
+    "  name: {name}\n"
+    "  labels:\n"
+    "    app: {name}\n"
+    "spec:\n"
+    "  containers:\n"
+    "  - name: {name}\n"
+    "    image: {name}:latest\n"
+)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run deploys in parallel against stand-in docker and kubectl")
+    parser.add_argument("--deploys", type=int, default=64, help="Number of deploys")
+    parser.add_argument("--concurrency", type=int, default=16, help="Deploys running at the same time")
+    parser.add_argument("--build-latency", type=float, default=0.2, help="Seconds per docker build and push")
+    parser.add_argument("--kubectl-latency", type=float, default=0.05, help="Seconds per kubectl apply and logs")
+    parser.add_argument("--pod-latency", type=float, default=0.1, help="Seconds until a deployed pod completes")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="codeaidapter-deploys-")
+    os.chdir(workdir)
+    # Config reads the environment on import, so the server modules are imported afterwards
+    os.environ["DOCKER_BUILDX"] = "false"
+    from bench.backends import use_fake_tools
+    use_fake_tools(
+        docker_latency=0.0,
+        sandbox_latency=0.0,
+        sandbox_fail_rate=0.0,
+        build_latency=args.build_latency,
+        kubectl_latency=args.kubectl_latency,
+        pod_latency=args.pod_latency,
+    )
+    from service.deploy.k8s import K8sService
+
+    def deploy(i: int):
+        name = f"codeaidapter-{uuid.uuid4()}"
+        service = K8sService(
+            service_name=name,
+            code_filename="app.py",
+            code_content=f"print('deploy {i}')\n",
+            dockerfile_content=DOCKERFILE,
+            config_yaml_content=CONFIG_YAML.format(name=name),
+        )
+        return name, service.run(), service.logs
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(deploy, range(args.deploys)))
+    duration = time.monotonic() - start
+
+    failed = [(name, logs) for name, ok, logs in results if not ok]
+    print(f"deploys {len(results)}  concurrency {args.concurrency}  failed {len(failed)}  duration {duration:.1f}s")
+    for name, logs in failed[:5]:
+        print(f"\n{name}:")
+        for line in list(logs)[-6:]:
+            print(f"  {line.strip()}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+"""
+End-to-end load and latency benchmark for the /api service.
+
+Drives the Flask app in process with a weighted mix of A1/A2/A3/B/deploy requests while
+the LLM, docker and kubectl are replaced by stand-ins with tunable latency, so it runs
+fully offline on a CPU-only box:
+
+    python -m bench.run --requests 200 --concurrency 8
+    python -m bench.run --baseline bench/results/<previous>.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import platform
+import subprocess
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "bench", "results")
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+# Config reads the environment on import, so the server modules (and bench.backends,
+# which imports them) are only imported once run() has set it up
+from bench import workload
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the /api service")
+    parser.add_argument("--requests", type=int, default=100, help="Number of requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--mix", default=workload.DEFAULT_MIX, help="Relative weights per request kind")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2, help="Share of byte-identical repeated requests")
+    parser.add_argument("--seed", type=int, default=0, help="Workload and latency random seed")
+    parser.add_argument("--workers", type=int, default=None, help="JOB_WORKERS of the server, defaults to the config")
+    parser.add_argument("--llm-latency", default="lognormal:-0.5,0.5", help="LLM latency spec, see utils.llm.replay.parse_latency")
+    parser.add_argument("--sandbox-latency", type=float, default=0.3, help="Seconds per sandboxed code run")
+    parser.add_argument("--sandbox-fail-rate", type=float, default=0.2, help="Share of code runs that fail and go through the fix loop")
+    parser.add_argument("--docker-latency", type=float, default=0.02, help="Seconds per docker management command")
+    parser.add_argument("--build-latency", type=float, default=1.0, help="Seconds per docker build and push")
+    parser.add_argument("--kubectl-latency", type=float, default=0.1, help="Seconds per kubectl apply and logs")
+    parser.add_argument("--pod-latency", type=float, default=1.0, help="Seconds until a deployed pod completes")
+    parser.add_argument("--output", default=None, help="Result JSON path, defaults to bench/results/<timestamp>.json")
+    parser.add_argument("--baseline", default=None, help="Earlier result JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change counted as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Show the server's own logging")
+    return parser.parse_args(argv)
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest-rank percentile, q in [0, 100].
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(q / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+_TIMING = re.compile(r"^\s*([^;]+);dur=([0-9.]+)")
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    """
+    Parse a Server-Timing header into stage -> milliseconds.
+    """
+    stages = {}
+    for metric in (header or "").split(","):
+        match = _TIMING.match(metric)
+        if match:
+            stages[match.group(1)] = float(match.group(2))
+    return stages
+
+def _git_commit() -> str:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else ""
+
+def _send(app, body: dict) -> dict:
+    client = app.test_client()
+    payload = {key: value for key, value in body.items() if key != "kind"}
+    start = time.monotonic()
+    # Each benchmark thread is its own client for the per-client limits, clients are told apart by address
+    thread = threading.get_native_id()
+    address = f"10.{thread >> 16 & 255}.{thread >> 8 & 255}.{thread & 255}"
+    response = client.post("/api", json=payload, environ_base={"REMOTE_ADDR": address})
+    latency = time.monotonic() - start
+    data = response.get_json(silent=True) or {}
+    stages = parse_server_timing(response.headers.get("Server-Timing", ""))
+    if "total" in stages and "queue" not in stages:
+        # Servers that do not report it: time spent queued for a job worker and in the HTTP layer
+        stages["queue"] = max(latency * 1000 - stages["total"], 0.0)
+    ok = response.status_code == 200 and not str(data.get("message", "")).startswith("抱歉")
+    return {
+        "kind": body["kind"],
+        "status": response.status_code,
+        "ok": ok,
+        "latency": latency,
+        "stages": stages,
+        "message": "" if ok else str(data.get("message", ""))[-500:],
+    }
+
+def run(args: argparse.Namespace) -> dict:
+    """
+    Start the app against the stand-in backends, replay the workload and collect the results.
+    """
+    import random
+    random.seed(args.seed)
+
+    # Relative paths of the server (deploy workspaces, traces, build cache) land in a scratch dir
+    workdir = tempfile.mkdtemp(prefix="codeaidapter-bench-")
+    os.chdir(workdir)
+    if args.workers:
+        os.environ["JOB_WORKERS"] = str(args.workers)
+    os.environ.setdefault("IMAGE_PREPULL", "")
+    from bench.backends import SyntheticChat, use_fake_tools
+    use_fake_tools(
+        docker_latency=args.docker_latency,
+        sandbox_latency=args.sandbox_latency,
+        sandbox_fail_rate=args.sandbox_fail_rate,
+        build_latency=args.build_latency,
+        kubectl_latency=args.kubectl_latency,
+        pod_latency=args.pod_latency,
+    )
+
+    import app as server
+    from config import Config
+    from utils.llm import OpenAIChat
+    OpenAIChat.use_backend(SyntheticChat(args.llm_latency))
+
+    bodies = workload.build(args.requests, args.mix, args.duplicate_ratio, args.seed)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        samples = list(pool.map(lambda body: _send(server.app, body), bodies))
+    duration = time.monotonic() - start
+
+    by_kind: Dict[str, List[dict]] = {}
+    for sample in samples:
+        by_kind.setdefault(sample["kind"], []).append(sample)
+    stage_names = sorted({name for sample in samples for name in sample["stages"]})
+    stages = {}
+    for name in stage_names:
+        values = [sample["stages"].get(name, 0.0) for sample in samples]
+        stages[name] = {**summarize(values), "share": sum(values) / max(sum(s["stages"].get("total", 0.0) for s in samples), 1e-9)}
+
+    return {
+        "meta": {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "job_workers": Config.JOB_WORKERS,
+            "sandbox_pool_size": Config.SANDBOX_POOL_SIZE,
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "verbose")},
+        },
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if not sample["ok"]),
+        "duration_s": duration,
+        "throughput_rps": len(samples) / duration if duration else 0.0,
+        "latency_s": summarize([sample["latency"] for sample in samples]),
+        "latency_by_kind_s": {kind: summarize([s["latency"] for s in items]) for kind, items in sorted(by_kind.items())},
+        "errors_by_kind": {kind: sum(1 for s in items if not s["ok"]) for kind, items in sorted(by_kind.items())},
+        "stages_ms": stages,
+        "failures": [{"kind": s["kind"], "status": s["status"], "message": s["message"]} for s in samples if not s["ok"]][:20],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "rss_before_run_mb": rss_before / 1024,
+        "server_stats": server.app.test_client().get("/api/stats").get_json(),
+    }
+
+REGRESSION_CHECKS = [
+    ("throughput_rps", lambda r: r["throughput_rps"], -1),
+    ("latency p50", lambda r: r["latency_s"]["p50"], 1),
+    ("latency p95", lambda r: r["latency_s"]["p95"], 1),
+    ("latency p99", lambda r: r["latency_s"]["p99"], 1),
+    ("peak_rss_mb", lambda r: r["peak_rss_mb"], 1),
+]
+
+def compare(result: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Compare a run against a baseline.
+
+    Returns:
+        List[str]: One line per metric that got worse by more than `threshold`.
+    """
+    regressions = []
+    for name, metric, direction in REGRESSION_CHECKS:
+        before, after = metric(baseline), metric(result)
+        if not before:
+            continue
+        change = (after - before) / before
+        if change * direction > threshold:
+            regressions.append(f"{name}: {before:.3f} -> {after:.3f} ({change:+.1%})")
+    return regressions
+
+def report(result: dict, out) -> None:
+    latency = result["latency_s"]
+    print(f"requests {result['requests']}  errors {result['errors']}  "
+          f"duration {result['duration_s']:.1f}s  throughput {result['throughput_rps']:.2f} req/s", file=out)
+    print(f"latency  p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  p99 {latency['p99']:.3f}s  "
+          f"max {latency['max']:.3f}s", file=out)
+    print(f"peak RSS {result['peak_rss_mb']:.1f} MB", file=out)
+    print("\nby kind            n   err     p50     p95     p99", file=out)
+    for kind, stats in result["latency_by_kind_s"].items():
+        print(f"  {kind:<12} {stats['count']:>5} {result['errors_by_kind'][kind]:>5} "
+              f"{stats['p50']:>7.3f} {stats['p95']:>7.3f} {stats['p99']:>7.3f}", file=out)
+    print("\nstage (ms/request)         mean      p95   share", file=out)
+    for name, stats in sorted(result["stages_ms"].items(), key=lambda item: -item[1]["mean"]):
+        print(f"  {name:<22} {stats['mean']:>8.1f} {stats['p95']:>8.1f} {stats['share']:>7.1%}", file=out)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    output = os.path.abspath(args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    baseline = None
+    if args.baseline:
+        with open(os.path.abspath(args.baseline), "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    out = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        quiet = contextlib.ExitStack()
+        if not args.verbose:
+            quiet.enter_context(contextlib.redirect_stdout(devnull))
+            quiet.enter_context(contextlib.redirect_stderr(devnull))
+        with quiet:
+            result = run(args)
+
+    report(result, out)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\nresults saved to {output}", file=out)
+
+    if baseline is not None:
+        regressions = compare(result, baseline, args.threshold)
+        if regressions:
+            print(f"\nregressions against {args.baseline}:", file=out)
+            for line in regressions:
+                print(f"  {line}", file=out)
+            return 1
+        print(f"\nno regressions against {args.baseline} (threshold {args.threshold:.0%})", file=out)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import random
+from dataclasses import dataclass
+from typing import Dict, List
+
+PYTHON2_SOURCE = """# Python 2.7
+def average(values):
+    total = 0
+    for v in values:
+        total += v
+    return total / len(values)
+
+print "average:", average([1, 2, 3, 4])
+"""
+
+PYTHON_SOURCE = """import sys
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+print([fib(i) for i in range(20)])
+"""
+
+PYTHON_BUGGY_SOURCE = """def parse(items):
+    result = {}
+    for item in items:
+        key, value = item.split("=")
+        result[key] = int(valu)
+    return result
+
+print(parse(["a=1", "b=2"]))
+"""
+
+JAVA_SOURCE = """import java.util.*;
+
+public class Main {
+    public static void main(String[] args) {
+        List<Integer> values = new ArrayList<>();
+        for (int i = 0; i < 10; i++) values.add(i * i);
+        System.out.println(values);
+    }
+}
+"""
+
+SERVICE_SOURCE = """import time
+
+while True:
+    print("heartbeat", time.time(), flush=True)
+    time.sleep(5)
+"""
+
+@dataclass
+class Template:
+    kind: str
+    prompt: str
+    filename: str
+    file: str
+
+TEMPLATES: Dict[str, List[Template]] = {
+    "A1": [
+        Template("A1", "Convert this code to Python 3.12 version", "legacy.py", PYTHON2_SOURCE),
+        Template("A1", "幫我把這段程式改成 Java 8 相容的版本", "Main.java", JAVA_SOURCE),
+    ],
+    "A2": [
+        Template("A2", "Convert this python code to java", "fib.py", PYTHON_SOURCE),
+        Template("A2", "Translate this Java program to Python", "Main.java", JAVA_SOURCE),
+    ],
+    "A3": [
+        Template("A3", "Optimize this code, it is too slow", "fib.py", PYTHON_SOURCE),
+        Template("A3", "請幫我優化這段程式的效能", "Main.java", JAVA_SOURCE),
+    ],
+    "B": [
+        Template("B", "Fix the error in this code", "parse.py", PYTHON_BUGGY_SOURCE),
+        Template("B", "這段程式跑不動，幫我看看", "parse.py", PYTHON_BUGGY_SOURCE),
+    ],
+    "deploy": [
+        Template("deploy", "Deploy this service to kubernetes", "app.py", SERVICE_SOURCE),
+        Template("deploy", "幫我把這個程式部署上線", "app.py", SERVICE_SOURCE),
+    ],
+}
+
+DEFAULT_MIX = "A1=2,A2=3,A3=2,B=2,deploy=1"
+
+def build(requests: int, mix: str = DEFAULT_MIX, duplicate_ratio: float = 0.2, seed: int = 0) -> List[dict]:
+    """
+    Build a shuffled list of /api request bodies following the weighted mix.
+    Unique requests get a distinct trailing comment so the classification cache only
+    hits on the requested share of duplicates.
+
+    Args:
+        requests (int): Number of requests.
+        mix (str): Relative weights per kind, "A1=2,A2=3,...".
+        duplicate_ratio (float): Share of requests that repeat an earlier request byte for byte.
+        seed (int): Random seed, the same seed yields the same workload.
+
+    Returns:
+        List[dict]: Request bodies, each with the request kind under "kind".
+    """
+    rng = random.Random(seed)
+    # Parsed here rather than with config._task_map, importing config would freeze the environment
+    weights = {kind.strip(): float(weight) for kind, weight in (item.split("=", 1) for item in mix.split(",") if "=" in item)}
+    unknown = set(weights) - set(TEMPLATES)
+    if unknown:
+        raise ValueError(f"Unknown request kinds in mix: {', '.join(sorted(unknown))}")
+    kinds = list(weights)
+    bodies: List[dict] = []
+    for i in range(requests):
+        if bodies and rng.random() < duplicate_ratio:
+            bodies.append(dict(rng.choice(bodies)))
+            continue
+        kind = rng.choices(kinds, weights=[weights[k] for k in kinds])[0]
+        template = rng.choice(TEMPLATES[kind])
+        comment = "//" if template.filename.endswith(".java") else "#"
+        bodies.append({
+            "kind": kind,
+            "prompt": template.prompt,
+            "filename": template.filename,
+            "file": f"{template.file}{comment} request {i}\n",
+        })
+    return bodies
@@ -3,6 +3,13 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def _task_map(value: str) -> dict:
+    """
+    Parse "A1=1,A2=2" style per-task settings into a dict of ints.
+    """
+    items = (item.split("=", 1) for item in value.split(",") if "=" in item)
+    return {task.strip(): int(number) for task, number in items}
+
 class Config:
     GCP_CREDENTIALS = os.environ.get("GCP_CREDENTIALS")
     GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
@@ -10,4 +17,78 @@ class Config:
     GCP_CLUSTER_NAME = os.environ.get("GCP_CLUSTER_NAME")
     GCP_CLUSTER_ZONE = os.environ.get("GCP_CLUSTER_ZONE")
     GCP_ARTIFACT_REGISTRY = os.environ.get("GCP_ARTIFACT_REGISTRY")
-    GCP_ARTIFACT_REGISTRY_REPO = os.environ.get("GCP_ARTIFACT_REGISTRY_REPO")
\ No newline at end of file
+    GCP_ARTIFACT_REGISTRY_REPO = os.environ.get("GCP_ARTIFACT_REGISTRY_REPO")
+
+    JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+    JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", "3600"))
+    JOB_QUEUE = int(os.environ.get("JOB_QUEUE", "32"))
+    JOB_LANE_WORKERS = _task_map(os.environ.get("JOB_LANE_WORKERS", "deploy=2"))
+    JOB_LANE_QUEUE = _task_map(os.environ.get("JOB_LANE_QUEUE", "deploy=8"))
+    CLIENT_MAX_INFLIGHT = int(os.environ.get("CLIENT_MAX_INFLIGHT", "8"))
+    TRUSTED_PROXIES = {p.strip() for p in os.environ.get("TRUSTED_PROXIES", "").split(",") if p.strip()}
+    JOB_DEDUP = os.environ.get("JOB_DEDUP", "true").lower() == "true"
+    JOB_DEDUP_TTL = float(os.environ.get("JOB_DEDUP_TTL", "30"))
+    CLASSIFY_CACHE_SIZE = int(os.environ.get("CLASSIFY_CACHE_SIZE", "1024"))
+    CLASSIFY_CACHE_TTL = float(os.environ.get("CLASSIFY_CACHE_TTL", "86400"))
+    CLASSIFY_CACHE_DIR = os.environ.get("CLASSIFY_CACHE_DIR", "")
+    CLASSIFY_CACHE_DISK_MB = int(os.environ.get("CLASSIFY_CACHE_DISK_MB", "256"))
+    CLASSIFY_FAST_PATH_THRESHOLD = float(os.environ.get("CLASSIFY_FAST_PATH_THRESHOLD", "0.85"))
+    CLASSIFY_SHADOW_RATE = float(os.environ.get("CLASSIFY_SHADOW_RATE", "0.05"))
+    CLASSIFY_BATCH_SIZE = int(os.environ.get("CLASSIFY_BATCH_SIZE", "20"))
+    BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "100"))
+    BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+    SANDBOX_POOL_SIZE = int(os.environ.get("SANDBOX_POOL_SIZE", "2"))
+    SANDBOX_MAX_USES = int(os.environ.get("SANDBOX_MAX_USES", "20"))
+    SANDBOX_POOL_MAX_IDLE = int(os.environ.get("SANDBOX_POOL_MAX_IDLE", "8"))
+    SANDBOX_TIMEOUT = float(os.environ.get("SANDBOX_TIMEOUT", "20"))
+    SANDBOX_PULL_TIMEOUT = float(os.environ.get("SANDBOX_PULL_TIMEOUT", "600"))
+    SANDBOX_CPUS = os.environ.get("SANDBOX_CPUS", "1")
+    SANDBOX_MEMORY = os.environ.get("SANDBOX_MEMORY", "512m")
+    SANDBOX_PIDS = int(os.environ.get("SANDBOX_PIDS", "128"))
+    SANDBOX_NETWORK = os.environ.get("SANDBOX_NETWORK", "none")
+    SANDBOX_OUTPUT_LIMIT_KB = int(os.environ.get("SANDBOX_OUTPUT_LIMIT_KB", "64"))
+    RUN_CACHE = os.environ.get("RUN_CACHE", "true").lower() == "true"
+    RUN_CACHE_SIZE = int(os.environ.get("RUN_CACHE_SIZE", "1024"))
+    RUN_CACHE_MAX_MB = int(os.environ.get("RUN_CACHE_MAX_MB", "64"))
+    RUN_CACHE_TTL = float(os.environ.get("RUN_CACHE_TTL", "86400"))
+    IMAGE_CATALOG = os.environ.get("IMAGE_CATALOG", "")
+    IMAGE_PREPULL = os.environ.get("IMAGE_PREPULL", "python:3.12,python:2.7,java:21,java:8")
+    IMAGE_STORE_BUDGET_MB = int(os.environ.get("IMAGE_STORE_BUDGET_MB", "4096"))
+    SPECULATIVE_CANDIDATES = _task_map(os.environ.get("SPECULATIVE_CANDIDATES", "A1=1,A2=1,A3=1,B=1"))
+    SPECULATIVE_BUDGET = _task_map(os.environ.get("SPECULATIVE_BUDGET", "A1=4,A2=8,A3=8,B=8"))
+    FIX_MAX_ROUNDS = int(os.environ.get("FIX_MAX_ROUNDS", "3"))
+    FIX_ERROR_TOKENS = int(os.environ.get("FIX_ERROR_TOKENS", "400"))
+    KUBECTL = os.environ.get("KUBECTL", "kubectl")
+    POD_WAIT_TIMEOUT = float(os.environ.get("POD_WAIT_TIMEOUT", "60"))
+    DEPLOY_OUTPUT_LIMIT_KB = int(os.environ.get("DEPLOY_OUTPUT_LIMIT_KB", "64"))
+    DOCKER_BUILDX = os.environ.get("DOCKER_BUILDX", "true").lower() == "true"
+    DOCKER_BUILDER = os.environ.get("DOCKER_BUILDER", "codeaidapter")
+    DOCKER_BUILD_CACHE_DIR = os.environ.get("DOCKER_BUILD_CACHE_DIR", ".cache/buildkit")
+    DOCKER_BUILD_CACHE_TTL = float(os.environ.get("DOCKER_BUILD_CACHE_TTL", "604800"))
+    DOCKER_BUILD_CACHE_QUOTA_MB = int(os.environ.get("DOCKER_BUILD_CACHE_QUOTA_MB", "10240"))
+    DOCKER_REGISTRY_CACHE = os.environ.get("DOCKER_REGISTRY_CACHE", "true").lower() == "true"
+    DOCKER_PREWARM_IMAGES = os.environ.get("DOCKER_PREWARM_IMAGES", "python:3.12-slim,eclipse-temurin:21-jdk,node:20-slim")
+    WORKSPACE_TTL = float(os.environ.get("WORKSPACE_TTL", "86400"))
+    WORKSPACE_QUOTA_MB = int(os.environ.get("WORKSPACE_QUOTA_MB", "1024"))
+    DEPLOY_TTL = float(os.environ.get("DEPLOY_TTL", "0"))
+    DEPLOY_MAX_ACTIVE = int(os.environ.get("DEPLOY_MAX_ACTIVE", "50"))
+    DEPLOY_IMAGE_TTL = float(os.environ.get("DEPLOY_IMAGE_TTL", "3600"))
+    DEPLOY_IMAGE_QUOTA_MB = int(os.environ.get("DEPLOY_IMAGE_QUOTA_MB", "8192"))
+    DEPLOY_REGISTRY_CLEANUP = os.environ.get("DEPLOY_REGISTRY_CLEANUP", "false").lower() == "true"
+    LIFECYCLE_INTERVAL = float(os.environ.get("LIFECYCLE_INTERVAL", "300"))
+    ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+    DEPLOY_LEGACY_CHAIN = os.environ.get("DEPLOY_LEGACY_CHAIN", "false").lower() == "true"
+    LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+    LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "180"))
+    LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+    LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "16"))
+    LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "32"))
+    LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE", "500"))
+    LLM_TOKENS_PER_MINUTE = float(os.environ.get("LLM_TOKENS_PER_MINUTE", "200000"))
+    LLM_COMPLETION_TOKENS_ESTIMATE = int(os.environ.get("LLM_COMPLETION_TOKENS_ESTIMATE", "512"))
+    TRACE_FILE = os.environ.get("TRACE_FILE", ".cache/traces.jsonl")
+    TRACE_FILE_MAX_MB = int(os.environ.get("TRACE_FILE_MAX_MB", "100"))
+    OTLP_ENDPOINT = os.environ.get("OTLP_ENDPOINT", "")
+    LLM_BACKEND = os.environ.get("LLM_BACKEND", "openai")
+    LLM_FIXTURE_DIR = os.environ.get("LLM_FIXTURE_DIR", "fixtures/llm")
+    LLM_REPLAY_LATENCY = os.environ.get("LLM_REPLAY_LATENCY", "")
@@ -3,69 +3,254 @@ import json
 import tempfile
 import os
 import re
+import ast
 import sys
+import time
+import uuid
+import threading
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 sys.path.append("..")
+from config import Config
 from utils.llm.openai import OpenAIChat
 from utils.utils import CodeResponse
+from utils import metrics
+from utils import tracing
+from utils.cache import LRUCache, make_key, normalize_code
+from service import sandbox
+from service import images
+from service import progress
+from service import extract
+from service import detect
+from service.fixloop import FixSession, usage_report
 
 import subprocess
 import json
 
 def detect_language(code):
-    if re.search(r"class\s+\w+|public\s+static\s+void\s+main", code):
-        return "java"
-    elif re.search(r"def\s+\w+|import\s+|print\s*\(", code):
-        return "python"
-    return "unknown"
+    return detect.detect(code).language
 
 
 
-def run_code(response_json):
+def _code_command(language, file_name, workdir):
+    if language == "java":
+        # For Java, we assume the docker image contains the necessary tools to compile and run Java code
+        return ["bash", "-c", f"javac {workdir}/{file_name} && java -cp {workdir} {file_name.replace('.java', '')}"]
+    # For Python, the Docker image should contain Python
+    return ["python", f"{workdir}/{file_name}"]
+
+run_cache = LRUCache(
+    max_entries=Config.RUN_CACHE_SIZE,
+    ttl=Config.RUN_CACHE_TTL,
+    max_bytes=Config.RUN_CACHE_MAX_MB * 1024 * 1024,
+    sizeof=lambda value: len(value["output"].encode("utf-8")) + 64,
+)
+
+# Programs whose output can change between runs (clock, randomness, environment, input, network)
+_NONDETERMINISTIC_MODULES = {
+    "time", "random", "datetime", "uuid", "secrets", "socket", "threading", "multiprocessing", "asyncio", "subprocess",
+}
+_NONDETERMINISTIC_ATTRIBUTES = {
+    "os": {"urandom", "environ", "getenv", "getpid"},
+    "sys": {"stdin"},
+    "numpy": {"random"},
+}
+_NONDETERMINISTIC_CALLS = {"input", "id", "hash"}
+_MODULES = "|".join(sorted(_NONDETERMINISTIC_MODULES))
+# Python that does not parse is matched textually, `import a, b` lists included
+_PYTHON_NONDETERMINISTIC = re.compile(
+    rf"\bimport\s+(?:[\w.]+(?:\s+as\s+\w+)?\s*,\s*)*(?:{_MODULES})\b|\bfrom\s+(?:{_MODULES})(?:\.\w+)*\s+import\b|"
+    r"\binput\s*\(|sys\.stdin|os\.(?:urandom|environ|getenv|getpid)|\bid\s*\(|\bhash\s*\(|\b(?:np|numpy)\.random\b"
+)
+_JAVA_NONDETERMINISTIC = re.compile(
+    r"System\.(?:currentTimeMillis|nanoTime|getenv|in\b)|Math\.random|\bnew\s+(?:Random|Scanner|Thread|Date)\b|"
+    r"java\.(?:time|net|util\.concurrent)\b|ThreadLocalRandom|SecureRandom|UUID\.|LocalDate|Instant\.now|hashCode\s*\("
+)
+_NO_CACHE = re.compile(r"codeaidapter:\s*no-cache")
+_COMPILE_ERRORS = {
+    "python": re.compile(r"^\s*(?:SyntaxError|IndentationError|TabError)\b", re.M),
+    "java": re.compile(r"\.java:\d+: error:"),
+}
+
+def _python_nondeterministic(code):
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return bool(_PYTHON_NONDETERMINISTIC.search(code))
+    # Local names bound to the modules whose attributes are checked, `import numpy as np` binds np
+    bound = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                root = alias.name.split(".")[0]
+                if root in _NONDETERMINISTIC_MODULES or alias.name.startswith("numpy.random"):
+                    return True
+                if root in _NONDETERMINISTIC_ATTRIBUTES:
+                    bound[alias.asname or root] = root
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            root = node.module.split(".")[0]
+            if root in _NONDETERMINISTIC_MODULES or node.module.startswith("numpy.random"):
+                return True
+            if any(alias.name in _NONDETERMINISTIC_ATTRIBUTES.get(node.module, ()) for alias in node.names):
+                return True
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            module = bound.get(node.value.id)
+            if module and node.attr in _NONDETERMINISTIC_ATTRIBUTES[module]:
+                return True
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _NONDETERMINISTIC_CALLS:
+            return True
+    return False
+
+def is_cacheable_code(code, language="python"):
+    """
+    Whether the output of a program only depends on its source. Python is checked on its
+    syntax tree (imports, including `import a, b` lists and aliases, module attributes such
+    as os.environ or np.random, and calls such as input()), Java textually.
+
+    A program whose output changes between runs in a way these checks miss, for example
+    because it reads a file that changes, opts out of the cache with a comment anywhere
+    in the source:
+
+        # codeaidapter: no-cache
+        // codeaidapter: no-cache
+    """
+    if not Config.RUN_CACHE or _NO_CACHE.search(code):
+        return False
+    if language == "java":
+        return not _JAVA_NONDETERMINISTIC.search(code)
+    if language == "python":
+        return not _python_nondeterministic(code)
+    return not (_PYTHON_NONDETERMINISTIC.search(code) or _JAVA_NONDETERMINISTIC.search(code))
+
+def is_cacheable_result(language, result, status):
+    """
+    Only successful runs and compile errors are reproducible, runtime failures may be
+    timeouts, OOM kills or infrastructure errors.
+    """
+    if status == 0:
+        return True
+    pattern = _COMPILE_ERRORS.get(language)
+    return bool(pattern and pattern.search(result or ""))
+
+def _metric_labels(language, docker_image):
+    # Both come from the LLM, so anything outside the catalog shares one "other" series
+    return {
+        "language": language if language in images.CATALOG else "other",
+        "image": docker_image if images.is_pinned(docker_image) else "other",
+    }
+
+def run_code(response_json, runtime=None, cancel=None):
+    # runtime is an optional (language, image) pinned from local detection, used when the answer is in that language
+    # cancel is an optional threading.Event that kills the sandbox once it is set
 
     response_dict = json.loads(response_json)  # Parse the JSON string into a dictionary
     code = response_dict["code"]
     language = response_dict["language"]
-    docker_image = response_dict["docker_image"]
+    # Prefer the pinned runtime image over the one suggested by the LLM
+    docker_image = images.resolve(language, response_dict["docker_image"])
+    if runtime and runtime[0] == language and runtime[1]:
+        docker_image = runtime[1]
     java_class_name = response_dict["class_name"]
     
+    # Determine the file name based on the language
+    file_name = f"{java_class_name}.java" if language == "java" else "output.py"
+
+    cacheable = is_cacheable_code(code, language)
+    key = make_key(normalize_code(code), language, docker_image, java_class_name)
+    if cacheable:
+        cached = run_cache.get(key)
+        if cached is not None:
+            with tracing.span("sandbox", language=language, image=docker_image, cached=True) as span:
+                span.set(exit_code=cached["status"], saved_ms=round(cached["duration"] * 1000, 1))
+            metrics.SANDBOX_RUN_CACHE.labels(result="hit").inc()
+            return cached["output"], cached["status"]
+        metrics.SANDBOX_RUN_CACHE.labels(result="miss").inc()
+
+    start = time.monotonic()
+    with tracing.span("sandbox", language=language, image=docker_image) as span, images.store.use(docker_image):
+        result, status, cancelled = _execute(code, language, docker_image, file_name, cancel)
+        span.set(exit_code=status, cancelled=cancelled)
+    duration = time.monotonic() - start
+    labels = _metric_labels(language, docker_image)
+    metrics.SANDBOX_RUN_SECONDS.labels(**labels).observe(duration)
+    metrics.SANDBOX_EXIT_CODES.labels(**labels, exit_code=str(status)).inc()
+    if cacheable and not cancelled and is_cacheable_result(language, result, status):
+        run_cache.set(key, {"output": result, "status": status, "duration": duration})
+    return result, status
+
+# Exit code of `docker run` when the image cannot be found or pulled
+PULL_FAILED_EXIT_CODE = 125
+
+def _execute(code, language, docker_image, file_name, cancel=None):
+    if sandbox.pool.enabled:
+        # Run in a warm container, falling back to a cold run if the pool cannot serve the image
+        print("start_running (warm)")
+        try:
+            run_result = sandbox.pool.run(
+                language, docker_image, {file_name: code}, _code_command(language, file_name, "."), cancel=cancel
+            )
+            return _run_output(run_result), run_result.returncode, run_result.cancelled
+        except RuntimeError as e:
+            print("[TSID.py] Sandbox pool unavailable:", e, file=sys.stderr)
+
     # Create a temporary directory to save the code
     with tempfile.TemporaryDirectory() as temp_dir:
-        # Determine the file name based on the language
-        file_name = f"{java_class_name}.java" if language == "java" else "output.py"
         file_path = os.path.join(temp_dir, file_name)
         
         # Write the code to the file
         with open(file_path, "w") as f:
             f.write(code)
 
-        
-        # Build the Docker command to run the code
-        if language == "java":
-            # For Java, we assume the docker image contains the necessary tools to compile and run Java code
-            docker_command = [
-                "docker", "run", "--rm", 
-                "-v", f"{temp_dir}:/workspace", 
-                docker_image, "bash", "-c", f"javac /workspace/{file_name} && java -cp /workspace {file_name.replace('.java', '')}"
-            ]
-        else:
-            # For Python, the Docker image should contain Python
-            docker_command = [
-                "docker", "run", "--rm", 
-                "-v", f"{temp_dir}:/workspace", 
-                docker_image, "python", f"/workspace/{file_name}"
-            ]
+        # The pull is not part of the run, so a slow pull is not reported as a timeout of the code
+        try:
+            images.ensure(docker_image)
+        except RuntimeError as e:
+            print("[TSID.py]", e, file=sys.stderr)
+            return str(e), PULL_FAILED_EXIT_CODE, False
+
+        # Build the Docker command to run the code, named so it can be killed on timeout
+        container_name = f"codeaidapter-run-{uuid.uuid4().hex[:12]}"
+        docker_command = [
+            "docker", "run", "--rm", "--pull", "never", "--name", container_name,
+            *sandbox.resource_flags(),
+            "-v", f"{temp_dir}:/workspace", 
+            docker_image, *_code_command(language, file_name, "/workspace")
+        ]
         
         # Run the Docker command
         print("start_running")
-        run_result = subprocess.run(docker_command, capture_output=True, text=True)
-        
-        if run_result.returncode == 0:
-            return run_result.stdout, run_result.returncode
-        else:
-            return run_result.stderr, run_result.returncode
+        run_result = sandbox.run_bounded(
+            docker_command,
+            on_timeout=lambda: subprocess.run(["docker", "kill", container_name], capture_output=True, text=True),
+            cancel=cancel,
+        )
+        return _run_output(run_result), run_result.returncode, run_result.cancelled
+
+def _run_output(run_result):
+    if run_result.returncode == 0:
+        return run_result.stdout
+    stderr = run_result.stderr.rstrip()
+    # Say how the run ended, a timeout or an OOM kill leaves no traceback behind. A plain
+    # exit code stays out of the error, it would become the fingerprint of every failure
+    if run_result.aborted or not stderr:
+        return f"{stderr}\n{run_result.outcome()}".lstrip()
+    return stderr
+
+# Comments that name a version tell the LLM which runtime to target, they stay in the prompt
+_VERSION_HINT = re.compile(r"\b(?:python|py|java|jdk)\s*\d|version|版本", re.I)
+
+def _prompt_code(code, language, task):
+    # A3 prompts ask the LLM to refer to the comments, the other tasks only need version hints
+    if task[0] == 'A' and task[1] == '3':
+        return code
+    return extract.shrink(code, language, keep=lambda comment: bool(_VERSION_HINT.search(comment)))
 
 def processing_tasks(code, language, task,user_prompt):
 
+    code = _prompt_code(code, language, task)
+
     fixed_promt = (
         "Please provide the following in response to the user's request:\n"
         "1. The executable code remove all comments(Be aware of the infinite loop and memory leak)\n"
@@ -128,45 +313,22 @@ def processing_tasks(code, language, task,user_prompt):
                 f"{fixed_promt}"
             )
 
-    response_text = OpenAIChat.chat(dev_prompt,user_prompt)
+    with tracing.span("generate", task=task):
+        response_text = OpenAIChat.chat(dev_prompt,user_prompt,site="processing_tasks")
     response_json = re.sub(r"```(?:\w+)?\n?", "", response_text).strip("`")
     return response_json
 
-def fix_code_with_llm(response_json, error_message,usr_prompt):
-
-
-    response_dict = json.loads(response_json)  
-    code = response_dict["code"]
-    language = response_dict["language"]
-
-    fixed_promt = (
-        "Please provide the following in response to the user's request:\n"
-        "1. The executable code remove all comments(Be aware of the infinite loop and memory leak)\n"
-        "2. The programming language of the code in all lowercase letters\n"
-        "3. Find the name of the Docker image in Docker Hub that can run the code you return, with the version if specified by the user's prompt or comments in code I provided"
-        "(otherwise, use the latest executable version available).\n"
-        "4. The public class name of Java code,If the code language you return is python just return the word : output\n"
-        "The format of the response should only be json and inluding(code, language, docker_image,class_name)"
-    )
-
-    prompt = (
-        f"This {language} code contains an error. Please help me fix it.\n\n"
-        f"Code:\n{code}\n\n"
-        f"Error:\n{error_message}\n\n"
-        f"{fixed_promt}"
-        
-    )
-
-    response_text = OpenAIChat.chat(prompt,usr_prompt)
-    response_json = re.sub(r"```(?:\w+)?\n?", "", response_text).strip("`")
-    return response_json
+def fix_code_with_llm(response_json, error_message,usr_prompt, session=None, status=1):
+    # Without a session this is a single-turn fix, the session keeps the conversation across rounds
+    if session is None:
+        session = FixSession(usr_prompt, json.loads(response_json)["language"])
+    return session.fix(response_json, error_message, status)
 
 def return_code_response(code_response,response_json,result,status):
     response_dict = json.loads(response_json)  
     code = response_dict["code"]
     language = response_dict["language"]
     java_class_name = response_dict["class_name"]
-    docker_image = response_dict["docker_image"]
 
     code_response.file = code
     if language == "java":
@@ -179,38 +341,160 @@ def return_code_response(code_response,response_json,result,status):
     else:
         code_response.error_msg = result
         code_response.status = False
-    # subprocess.run(f"docker rmi -f $(docker images --filter=reference='{docker_image}' -q)", shell=True)
-    subprocess.run(f"docker rmi -f $(docker images -q)", shell=True)
     return code_response
 
 
+def _candidate(generate, session, cancelled, runtime=None):
+    # A candidate that lost stops before each LLM call and sandbox run, and its running sandbox is killed
+    if cancelled.is_set():
+        return None, None, None
+    response_json = generate()
+    if cancelled.is_set() or not session.new_code(response_json):
+        return response_json, None, None
+    result, status = run_code(response_json, runtime, cancel=cancelled)
+    if cancelled.is_set():
+        return response_json, None, None
+    return response_json, result, status
+
+def speculate(code, language, task, usr_prompt, candidates, budget, runtime=None):
+    """
+    Generate several candidates concurrently and run them in parallel sandboxes. The first
+    candidate that exits with 0 wins and the rest are cancelled, killing their sandboxes and
+    skipping their remaining LLM calls; if none succeeds, the failed
+    candidates are repaired in parallel for up to three rounds.
+
+    Args:
+        code (str): Source code from the user.
+        language (str): Detected source language.
+        task (str): Task type (A1, A2, A3 or B).
+        usr_prompt (str): The user's prompt.
+        candidates (int): Candidates generated or repaired per round.
+        budget (int): Total LLM calls allowed, each followed by at most one sandbox run.
+        runtime (tuple): Optional (language, image) to run answers in that language with.
+
+    Returns:
+        tuple: (response_json, result, status) of the winning or last failed candidate.
+    """
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=candidates, thread_name_prefix="candidate")
+    count = min(candidates, budget)
+    generators = [partial(processing_tasks, code, language, task, usr_prompt)] * count
+    sessions = [FixSession(usr_prompt, language) for _ in range(count)]
+    calls = 0
+    last = None
+    last_error = None
+    try:
+        for round_no in range(Config.FIX_MAX_ROUNDS + 1):
+            if not generators:
+                break
+            calls += len(generators)
+            progress.emit("speculate", f"Round {round_no}: {len(generators)} candidates", round=round_no, candidates=len(generators))
+            # Each candidate gets its own copy of the context so progress events reach the job
+            futures = {
+                executor.submit(contextvars.copy_context().run, _candidate, g, session, cancelled, runtime): session
+                for g, session in zip(generators, sessions)
+            }
+            failed = []
+            for future in as_completed(futures):
+                session = futures[future]
+                try:
+                    response_json, result, status = future.result()
+                except Exception as e:
+                    print("[TSID.py] Candidate failed:", e, file=sys.stderr)
+                    last_error = e
+                    continue
+                if status is None:
+                    # Cancelled, or the fix repeated code this line already tried
+                    continue
+                progress.emit("sandbox_run", f"Candidate exited with {status}", round=round_no, exit_code=status, output=result)
+                if status == 0:
+                    cancelled.set()
+                    for f in futures:
+                        f.cancel()
+                    metrics.FIX_LOOP_ITERATIONS.labels(task=task, mode="speculative").observe(round_no)
+                    return response_json, result, status
+                last = (response_json, result, status)
+                if session.new_error(result, status):
+                    failed.append((response_json, result, status, session))
+
+            remaining = budget - calls
+            # Spread the repairs over the failed candidates so every round fans out to K calls
+            repairs = [failed[i % len(failed)] for i in range(min(candidates, remaining))] if failed else []
+            sessions = [session.fork() for *_, session in repairs]
+            generators = [
+                partial(fix_code_with_llm, response_json, result, usr_prompt, session, status)
+                for (response_json, result, status, _), session in zip(repairs, sessions)
+            ]
+            if generators:
+                progress.emit("fix_attempt", f"Fix round {round_no + 1}", attempt=round_no + 1)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    metrics.FIX_LOOP_ITERATIONS.labels(task=task, mode="speculative").observe(round_no)
+    if last is None:
+        raise last_error or RuntimeError("No candidate could be generated.")
+    return last
+
 def StartProcess(code, task, usr_prompt):
     
     count = 0
     
     code_response = CodeResponse(file="", filename="", success_msg="", error_msg="", status=False)
 
-    language = detect_language(code)
+    detection = detect.detect(code)
+    language = detection.language
     if language == "unknown":
         code_response.error_msg = "Could not determine the programming language."
         code_response.status = False
         return code_response
     else:
 
+        progress.emit(
+            "detected", f"Source language: {language} {detection.version or ''}".strip(),
+            language=language, version=detection.version, confidence=detection.confidence, task=task
+        )
+        # Fixing and optimizing keep the source runtime, so it is picked locally instead of trusting the LLM
+        runtime = (language, detection.image()) if task in ("B", "A3") else None
+
+        candidates = Config.SPECULATIVE_CANDIDATES.get(task, 1)
+        if candidates > 1:
+            budget = Config.SPECULATIVE_BUDGET.get(task, candidates * 4)
+            response_json, result, status = speculate(code, language, task, usr_prompt, candidates, budget, runtime)
+            code_response = return_code_response(code_response,response_json,result,status)
+            code_response.usage = usage_report(tracing.current())
+            progress.emit("report_ready", "Result ready", status=code_response.status)
+            return code_response
+
         response_json = processing_tasks(code, language, task,usr_prompt)
+        progress.emit("code_generated", "Code generated")
 
-        result,status = run_code(response_json)
+        result,status = run_code(response_json, runtime)
+        progress.emit("sandbox_run", f"Sandbox run 1 exited with {status}", attempt=1, exit_code=status, output=result)
         
     
         print("result:",result,"status:",status)
 
-        while status  == 1 and count < 3:
+        session = FixSession(usr_prompt, language)
+        session.new_code(response_json)
+        # Any nonzero exit is worth a fix, not only exit code 1
+        while status != 0 and count < Config.FIX_MAX_ROUNDS and session.new_error(result, status):
             count += 1
             print("Fixing error...")
-            response_json = fix_code_with_llm(response_json,result,usr_prompt)
-            result,status = run_code(response_json)
+            progress.emit("fix_attempt", f"Fix attempt {count}", attempt=count)
+            fixed_json = fix_code_with_llm(response_json,result,usr_prompt,session,status)
+            if not session.new_code(fixed_json):
+                break
+            response_json = fixed_json
+            result,status = run_code(response_json, runtime)
+            progress.emit("sandbox_run", f"Sandbox run {count + 1} exited with {status}", attempt=count + 1, exit_code=status, output=result)
+        if session.stop_reason:
+            progress.emit("fix_stopped", f"Stopped fixing: {session.stop_reason}", reason=session.stop_reason)
         
-        return return_code_response(code_response,response_json,result,status)
+        metrics.FIX_LOOP_ITERATIONS.labels(task=task, mode="serial").observe(count)
+        code_response = return_code_response(code_response,response_json,result,status)
+        code_response.usage = usage_report(tracing.current())
+        progress.emit("report_ready", "Result ready", status=code_response.status)
+        return code_response
 
 
 
@@ -235,10 +519,10 @@ if __name__ == "__main__":
     
         print("result:",result,"status:",status)
 
-        while status  == 1 and count < 3:
+        while status != 0 and count < Config.FIX_MAX_ROUNDS:
             count += 1
             print("Fixing error...")
-            response_json = fix_code_with_llm(response_json,result,usr_prompt)
+            response_json = fix_code_with_llm(response_json,result,usr_prompt,status=status)
             result,status = run_code(response_json)
 
          
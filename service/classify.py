@@ -0,0 +1,350 @@
+import re
+import sys
+import json
+import random
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from config import Config
+from utils import CodeRequest
+from utils.cache import LRUCache, make_key, normalize_code
+from utils.llm.openai import OpenAIChat
+from service.TSID import detect_language
+
+CLASSES = {
+    1: "版本轉換",
+    2: "語言轉換：不同程式語言之間的轉換",
+    3: "效能優化",
+    4: "程式debug：找出程式的錯誤，並回傳可以成功執行的程式",
+    5: "部署請求",
+}
+
+_cs_str = "\n".join([f"{key}: {value}" for key, value in CLASSES.items()])
+DEV_PROMPT = (
+    "請幫我將使用者的需求分類為以下幾項，只能回傳需求的編號，不能包含任何其他字串\n"
+    "若非程式相關技術問題請回傳-1\n"
+    "若為技術問題，請根據使用者附的程式分析來源程式是什麼語言，再根據使用者的prompt分析目標程式分別是什麼語言，若其中任一為python, java外的語言，請回傳0\n"
+    "若為以下未條列的技術問題也請回傳0：\n"
+    f'{_cs_str}\n'
+)
+
+BATCH_DEV_PROMPT = (
+    "使用者會一次送出多個需求，每個需求以「### 需求 <編號>」開頭，請分別將每個需求分類為以下幾項\n"
+    + DEV_PROMPT.split("\n", 1)[1]
+    + "請以 JSON 回傳，classes 依照需求的順序列出每個需求的分類結果，數量必須與需求數量相同\n"
+)
+BATCH_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "classify_batch",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "classes": {"type": "array", "items": {"type": "integer"}},
+            },
+            "required": ["classes"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+cache = LRUCache(
+    max_entries=Config.CLASSIFY_CACHE_SIZE,
+    ttl=Config.CLASSIFY_CACHE_TTL,
+    disk_dir=Config.CLASSIFY_CACHE_DIR or None,
+    disk_max_bytes=Config.CLASSIFY_CACHE_DISK_MB * 1024 * 1024 or None,
+)
+
+@dataclass
+class Prediction:
+    class_code: int
+    confidence: float
+    reason: str
+
+_LANGUAGES = {
+    "python": re.compile(r"\bpython\s*[23]?\b|\bpy[23]?\b", re.I),
+    "java": re.compile(r"\bjava\b|\bjdk\b", re.I),
+}
+_OTHER_LANGUAGES = re.compile(
+    r"c\+\+|\bc#|\bcpp\b|javascript|typescript|\bnode\.?js\b|\bgolang\b|\brust\b|"
+    r"\bkotlin\b|\bruby\b|\bphp\b|\bswift\b|\bscala\b|\bc語言|\bc language\b",
+    re.I,
+)
+_CONVERT = re.compile(r"convert|translat|rewrite|\bport\b|migrat|\bto\b|轉|改寫|改成|換成", re.I)
+_VERSION = re.compile(r"\b(?:python|py)\s*[23](?:\.\d+)?\b|\b(?:java|jdk)\s*\d+\b|version|版本|相容|compatible", re.I)
+_RULES = [
+    (5, 0.9, re.compile(r"deploy|部署|kubernetes|\bk8s\b|kubectl|上線", re.I)),
+    (4, 0.85, re.compile(r"\bfix|\bbug|debug|\berror|exception|traceback|錯誤|修正|修復|除錯|報錯|跑不動", re.I)),
+    (3, 0.85, re.compile(r"optimi[sz]|faster|speed\s*up|performance|efficien|優化|效能|加速", re.I)),
+]
+
+def fast_classify(code_request: CodeRequest) -> Optional[Prediction]:
+    """
+    Cheap keyword/regex pre-classifier that runs before the LLM router.
+
+    Args:
+        code_request (CodeRequest): The user's request.
+
+    Returns:
+        Optional[Prediction]: The guessed class code and its confidence, or None if no rule applies.
+    """
+    prompt = code_request.prompt or ""
+    if not code_request.file or not prompt.strip():
+        return None
+    source = detect_language(code_request.file)
+    if source == "unknown":
+        return None
+
+    candidates: List[Prediction] = []
+    targets = [lang for lang, pattern in _LANGUAGES.items() if pattern.search(prompt)]
+    if _CONVERT.search(prompt):
+        if _OTHER_LANGUAGES.search(prompt):
+            candidates.append(Prediction(0, 0.9, "target language is not python or java"))
+        elif any(lang != source for lang in targets):
+            candidates.append(Prediction(2, 0.9, f"{source} to {[lang for lang in targets if lang != source][0]}"))
+        elif _VERSION.search(prompt) and source in targets:
+            candidates.append(Prediction(1, 0.9, f"{source} version change"))
+    for class_code, confidence, pattern in _RULES:
+        match = pattern.search(prompt)
+        if match:
+            candidates.append(Prediction(class_code, confidence, f"keyword '{match.group(0)}'"))
+
+    if not candidates:
+        return None
+    best = max(candidates, key=lambda p: p.confidence)
+    if len({p.class_code for p in candidates}) > 1:
+        # Conflicting rules, still report the guess so agreement can be measured
+        best = Prediction(best.class_code, best.confidence / 2, f"ambiguous: {best.reason}")
+    return best
+
+class AgreementStats:
+    def __init__(self):
+        """
+        Track how often the fast path agrees with the LLM, bucketed by confidence.
+        """
+        self._lock = threading.Lock()
+        self.fast_path_hits = 0
+        self.buckets: Dict[str, Dict[str, int]] = {}
+
+    def record_hit(self):
+        with self._lock:
+            self.fast_path_hits += 1
+
+    def record(self, prediction: Prediction, class_code: int):
+        agree = prediction.class_code == class_code
+        bucket = f"{min(int(prediction.confidence * 10), 9) / 10:.1f}"
+        with self._lock:
+            counts = self.buckets.setdefault(bucket, {"agree": 0, "total": 0})
+            counts["total"] += 1
+            counts["agree"] += int(agree)
+        print(
+            f'[classify.py] Fast path agreement: predicted={prediction.class_code} llm={class_code} '
+            f'confidence={prediction.confidence:.2f} agree={agree} ({prediction.reason})',
+            file=sys.stderr
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "threshold": Config.CLASSIFY_FAST_PATH_THRESHOLD,
+                "fast_path_hits": self.fast_path_hits,
+                "agreement": {
+                    bucket: {**counts, "rate": counts["agree"] / counts["total"]}
+                    for bucket, counts in sorted(self.buckets.items())
+                },
+            }
+
+agreement = AgreementStats()
+
+def _normalize_prompt(text: Optional[str]) -> str:
+    if not text:
+        return ""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+def cache_key(code_request: CodeRequest, model: str) -> str:
+    """
+    Content-addressed key for a classification, insensitive to whitespace noise
+    and invalidated whenever the model or the classification instructions change.
+    """
+    return make_key(
+        model,
+        make_key(DEV_PROMPT),
+        _normalize_prompt(code_request.prompt),
+        (code_request.filename or "").strip(),
+        normalize_code(code_request.file),
+    )
+
+def build_user_prompt(code_request: CodeRequest) -> str:
+    usr_prot = f'{code_request.prompt}\n'
+    if code_request.filename: usr_prot += f'source file name: {code_request.filename}\n'
+    if code_request.file: usr_prot += f'source code: \n{code_request.file}\n'
+    return usr_prot
+
+def parse_class_code(response: str) -> int:
+    if not isinstance(response, str):
+        raise ValueError(f'Invalid response by llm: {response}')
+    class_code = int(response)
+    if class_code > 0 and class_code not in CLASSES:
+        raise ValueError(f'Invalid class code: {class_code}')
+    return class_code
+
+def classify(code_request: CodeRequest) -> int:
+    """
+    Map a request to its class code (-1 to 5). Confident fast-path guesses skip the LLM,
+    other requests reuse earlier answers for identical inputs before calling the LLM.
+
+    Args:
+        code_request (CodeRequest): The user's request.
+
+    Returns:
+        int: -1 for non-technical requests, 0 for unsupported ones, otherwise a key of CLASSES.
+    """
+    class_code = quick_classify(code_request)
+    if class_code is not None:
+        return class_code
+    return slow_classify(code_request)
+
+def quick_classify(code_request: CodeRequest) -> Optional[int]:
+    """
+    Class code from a confident fast-path guess or an earlier answer for identical inputs,
+    without calling the LLM. Cheap enough to run before a request is queued.
+
+    Returns:
+        Optional[int]: The class code, or None if only the LLM can tell (see `slow_classify`).
+    """
+    prediction = fast_classify(code_request)
+    if prediction is not None and prediction.confidence >= Config.CLASSIFY_FAST_PATH_THRESHOLD:
+        # A small sample of confident guesses is still checked against the LLM
+        if random.random() >= Config.CLASSIFY_SHADOW_RATE:
+            print(f'[classify.py] Fast path: {prediction.class_code} ({prediction.reason})', file=sys.stderr)
+            agreement.record_hit()
+            return prediction.class_code
+
+    class_code = cache.get(cache_key(code_request, OpenAIChat.DEFAULT_MODEL))
+    if class_code is not None:
+        print(f'[classify.py] Cache hit: {class_code}', file=sys.stderr)
+        if prediction is not None:
+            agreement.record(prediction, class_code)
+    return class_code
+
+def slow_classify(code_request: CodeRequest) -> int:
+    """
+    Classify a request `quick_classify` could not answer with the LLM, and score the
+    fast-path guess against the answer.
+    """
+    class_code = llm_classify(code_request)
+    prediction = fast_classify(code_request)
+    if prediction is not None:
+        agreement.record(prediction, class_code)
+    return class_code
+
+def llm_classify(code_request: CodeRequest) -> int:
+    """
+    Classify a request with the LLM, reusing earlier answers for identical inputs.
+    """
+    model = OpenAIChat.DEFAULT_MODEL
+    key = cache_key(code_request, model)
+    class_code = cache.get(key)
+    if class_code is not None:
+        print(f'[classify.py] Cache hit: {class_code}', file=sys.stderr)
+        return class_code
+
+    usr_prot = build_user_prompt(code_request)
+
+    print('[dev prompt]', file=sys.stderr)
+    print(DEV_PROMPT+'\n', file=sys.stderr)
+    print('[user prompt]', file=sys.stderr)
+    print(usr_prot+'\n', file=sys.stderr)
+
+    response = OpenAIChat.chat(DEV_PROMPT, usr_prot, model=model, site="classifier")
+    print('[gpt response]', file=sys.stderr)
+    print(f'{response}\n', file=sys.stderr)
+
+    class_code = parse_class_code(response)
+    cache.set(key, class_code)
+    return class_code
+
+def build_batch_prompt(code_requests: List[CodeRequest]) -> str:
+    return "\n".join(f"### 需求 {i}\n{build_user_prompt(r)}" for i, r in enumerate(code_requests, 1))
+
+def llm_classify_batch(code_requests: List[CodeRequest], model: Optional[str] = None) -> List[int]:
+    """
+    Classify several requests with a single LLM call.
+
+    Args:
+        code_requests (List[CodeRequest]): The requests, in the order of the returned codes.
+        model (Optional[str]): Model used, defaults to OpenAIChat.DEFAULT_MODEL.
+
+    Returns:
+        List[int]: One class code per request.
+
+    Raises:
+        ValueError: If the answer does not hold exactly one valid class code per request.
+    """
+    response = OpenAIChat.chat(
+        BATCH_DEV_PROMPT,
+        build_batch_prompt(code_requests),
+        model=model or OpenAIChat.DEFAULT_MODEL,
+        response_format=BATCH_FORMAT,
+        site="classifier_batch"
+    )
+    print(f'[classify.py] Batch response: {response}', file=sys.stderr)
+    classes = json.loads(response)["classes"]
+    if len(classes) != len(code_requests):
+        raise ValueError(f'Expected {len(code_requests)} class codes, got {len(classes)}')
+    return [parse_class_code(str(class_code)) for class_code in classes]
+
+def classify_many(code_requests: List[CodeRequest]) -> List[Optional[int]]:
+    """
+    Classify a batch of requests. Each request first goes through the fast path and the
+    cache like in `classify`, the rest share one LLM call per Config.CLASSIFY_BATCH_SIZE
+    distinct requests.
+
+    Args:
+        code_requests (List[CodeRequest]): The requests.
+
+    Returns:
+        List[Optional[int]]: Class code per request, None where the batched call failed and
+            the request has to be classified on its own.
+    """
+    model = OpenAIChat.DEFAULT_MODEL
+    class_codes: List[Optional[int]] = [None] * len(code_requests)
+    # Identical requests in one batch are classified once
+    pending: Dict[str, List[int]] = {}
+    predictions: Dict[int, Prediction] = {}
+    for i, code_request in enumerate(code_requests):
+        prediction = fast_classify(code_request)
+        if prediction is not None and prediction.confidence >= Config.CLASSIFY_FAST_PATH_THRESHOLD:
+            if random.random() >= Config.CLASSIFY_SHADOW_RATE:
+                agreement.record_hit()
+                class_codes[i] = prediction.class_code
+                continue
+        if prediction is not None:
+            predictions[i] = prediction
+        key = cache_key(code_request, model)
+        class_codes[i] = cache.get(key)
+        if class_codes[i] is None:
+            pending.setdefault(key, []).append(i)
+        elif prediction is not None:
+            agreement.record(prediction, class_codes[i])
+
+    keys = list(pending)
+    for start in range(0, len(keys), max(Config.CLASSIFY_BATCH_SIZE, 1)):
+        chunk = keys[start:start + max(Config.CLASSIFY_BATCH_SIZE, 1)]
+        if len(chunk) == 1:
+            # Nothing to share the call with, the request's own job asks the LLM
+            continue
+        try:
+            codes = llm_classify_batch([code_requests[pending[key][0]] for key in chunk], model)
+        except Exception as e:
+            print(f'[classify.py] Batch classification of {len(chunk)} requests failed, classifying them one by one:', e, file=sys.stderr)
+            continue
+        for key, class_code in zip(chunk, codes):
+            cache.set(key, class_code)
+            for i in pending[key]:
+                class_codes[i] = class_code
+                if i in predictions:
+                    agreement.record(predictions[i], class_code)
+    return class_codes
@@ -1,44 +1,96 @@
 import os
-import uuid
+import re
+import sys
 import time
-from typing import Optional, List
-from contextlib import contextmanager
-
-import pexpect
+import uuid
+import threading
+import subprocess
+from typing import Dict, Optional, List
 
 from config import Config
+from service import progress
+from service import extract
 from utils import CodeResponse
+from utils import metrics
+from utils import tracing
+from . import lifecycle
+from .runner import run_command
+from .watch import PodWaiter, READY, COMPLETED
 from .utils import (
     code_extract,
     generate_dockerfile,
     generate_config_yaml,
-    generate_report
+    generate_report,
+    generate_deploy_bundle,
+    render_report,
+    normalize_dockerfile
 )
 
-SAVE_DIR = "tmp"
+SAVE_DIR = lifecycle.WORKSPACE_ROOT
 DEFAULT_DOCKERFILE = "Dockerfile"
-DEFAULT_CONFIG_YAML = "config.yaml"
+DEFAULT_CONFIG_YAML = lifecycle.CONFIG_YAML
 TIMEOUT = 120
+POD_WAIT_TIMEOUT = Config.POD_WAIT_TIMEOUT
+
+_builder_lock = threading.Lock()
+_builder_ready = False
+
+def ensure_builder() -> bool:
+    """
+    Create the BuildKit builder once. The docker-container driver is required for
+    exporting build caches to a local directory or to the registry.
+
+    Returns:
+        bool: True if the builder is available.
+    """
+    global _builder_ready
+    with _builder_lock:
+        if _builder_ready:
+            return True
+        builder = Config.DOCKER_BUILDER
+        inspect = subprocess.run(["sudo", "docker", "buildx", "inspect", builder], capture_output=True, text=True)
+        if inspect.returncode != 0:
+            create = subprocess.run(
+                ["sudo", "docker", "buildx", "create", "--name", builder, "--driver", "docker-container"],
+                capture_output=True, text=True
+            )
+            if create.returncode != 0:
+                print(f'[k8s.py] Failed to create buildx builder: {create.stderr.strip()}', file=sys.stderr)
+                return False
+        _builder_ready = True
+        return True
 
-@contextmanager
-def change_dir(path: str):
+def prewarm_base_images():
     """
-    Context manager to change the current working directory and then restore it.
+    Pull the common FROM images into the builder in the background so the first
+    deploy that uses them does not pay for the pull.
     """
-    original_dir = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(original_dir)
+    def _prewarm():
+        if not Config.DOCKER_BUILDX or not ensure_builder():
+            return
+        for image in filter(None, (i.strip() for i in Config.DOCKER_PREWARM_IMAGES.split(","))):
+            result = subprocess.run(
+                ["sudo", "docker", "buildx", "build", "--builder", Config.DOCKER_BUILDER, "-"],
+                input=f"FROM {image}\n", capture_output=True, text=True
+            )
+            if result.returncode != 0:
+                print(f'[k8s.py] Failed to prewarm {image}: {result.stderr.strip()[-500:]}', file=sys.stderr)
+
+    threading.Thread(target=_prewarm, daemon=True).start()
+
+def _base_image(dockerfile_content: str) -> str:
+    match = re.search(r"^\s*FROM\s+(?:--\S+\s+)*(\S+)", dockerfile_content, re.I | re.M)
+    return match.group(1) if match else "scratch"
 
 def deploy_handle(prompt: str, filename: str, file_content: str) -> CodeResponse:
     """
     Handle deployment request:
-      1. Extract code content from the file.
-      2. Generate a Dockerfile and a Kubernetes deployment config.yaml.
-      3. Build and push the Docker image, then deploy it.
-      4. Generate a deployment report.
+      1. Generate a Dockerfile and a Kubernetes deployment config.yaml in one structured LLM call.
+      2. Build and push the Docker image, then deploy it.
+      3. Render a deployment report from the image tag, pod name and pod logs.
+
+    With Config.DEPLOY_LEGACY_CHAIN set, the original chain of separate LLM calls for code
+    extraction, Dockerfile, config.yaml and report is used instead.
 
     Args:
         prompt (str): Deployment prompt message.
@@ -49,16 +101,29 @@ def deploy_handle(prompt: str, filename: str, file_content: str) -> CodeResponse
         CodeResponse: A response object containing deployment status, logs, and file information.
     """
     service_name = f"codeaidapter-{uuid.uuid4()}"  # Unique service name using UUID
-
-    # Extract code content (can be further customized by the extraction function)
-    code_content = code_extract(filename=filename, code_content=file_content)
-    dockerfile_content = generate_dockerfile(filename=filename, code_content=code_content, prompt=prompt)
-    config_yaml_content = generate_config_yaml(
-        docker_image_tag=f"{Config.GCP_ARTIFACT_REGISTRY}/{Config.GCP_PROJECT_ID}/{Config.GCP_ARTIFACT_REGISTRY_REPO}/{service_name}:latest",
-        dockerfile_content=dockerfile_content,
-        pod_name=service_name,
-        prompt=prompt
-    )
+    docker_image_tag = f"{Config.GCP_ARTIFACT_REGISTRY}/{Config.GCP_PROJECT_ID}/{Config.GCP_ARTIFACT_REGISTRY_REPO}/{service_name}:latest"
+
+    if Config.DEPLOY_LEGACY_CHAIN:
+        # Extract code content (can be further customized by the extraction function)
+        code_content = code_extract(filename=filename, code_content=file_content)
+        dockerfile_content = generate_dockerfile(filename=filename, code_content=code_content, prompt=prompt)
+        config_yaml_content = generate_config_yaml(
+            docker_image_tag=docker_image_tag,
+            dockerfile_content=dockerfile_content,
+            pod_name=service_name,
+            prompt=prompt
+        )
+    else:
+        dockerfile_content, config_yaml_content = generate_deploy_bundle(
+            filename=filename,
+            # Comments only cost prompt tokens here, the original file is what gets deployed
+            code_content=extract.shrink(file_content, filename=filename),
+            docker_image_tag=docker_image_tag,
+            pod_name=service_name,
+            prompt=prompt
+        )
+    # Keep dependency layers ahead of the code so they stay cached between deploys
+    dockerfile_content = normalize_dockerfile(dockerfile_content, filename)
     
     # Create a Kubernetes service and perform deployment
     service = K8sService(
@@ -68,17 +133,27 @@ def deploy_handle(prompt: str, filename: str, file_content: str) -> CodeResponse
         dockerfile_content=dockerfile_content,
         config_yaml_content=config_yaml_content
     )
-    status = service.run()
+    with tracing.span("deploy", service=service_name):
+        status = service.run()
     # import objprint
     # with open('run.log', 'w') as f:
     #     f.write(objprint.objstr(service))
 
     # Generate a deployment report
-    report = generate_report(
-        dockerfile_content=dockerfile_content,
-        config_yaml_content=config_yaml_content,
-        logs=service.logs
-    )
+    if Config.DEPLOY_LEGACY_CHAIN:
+        report = generate_report(
+            dockerfile_content=dockerfile_content,
+            config_yaml_content=config_yaml_content,
+            logs=service.logs
+        )
+    else:
+        report = render_report(
+            docker_image_tag=docker_image_tag,
+            pod_name=service.pod_name or service_name,
+            pod_output=service.pod_output,
+            logs=None if status else service.logs
+        )
+    progress.emit("report_ready", "Deployment report ready", status=status)
     success_msg = report if status else None
     error_msg = report if not status else None
 
@@ -117,7 +192,7 @@ class K8sService:
         self.config_yaml_content = config_yaml_content
 
         # Create the service directory (intermediate directories will be created if missing)
-        self.service_dir = os.path.join(SAVE_DIR, self.service_name)
+        self.service_dir = os.path.abspath(os.path.join(SAVE_DIR, self.service_name))
         os.makedirs(self.service_dir, exist_ok=True)
 
         # Write the Dockerfile
@@ -134,43 +209,67 @@ class K8sService:
         with open(os.path.join(self.service_dir, self.code_filename), "w", encoding="utf-8") as f:
             f.write(self.code_content)
 
-        self.logs: List[str] = []
+        # Every log line is also streamed to the progress events of the running job
+        self.logs: List[str] = progress.ProgressLog()
+        self.timings: Dict[str, float] = {}
+        self.pod_name: Optional[str] = None
+        self.pod_output: Optional[str] = None
+        self.last_output: str = ""
+        # Keep the reaper away from this deploy until run() has finished. A workspace whose
+        # setup failed above is not held, so the reaper cleans it up like any other.
+        lifecycle.reaper.acquire(self.service_name)
 
     def _execute_command(self, command: str, max_size: Optional[int] = None) -> bool:
         """
         Execute a shell command using pexpect within the service directory and log its output.
+        The directory is passed to the command rather than entered with os.chdir, so
+        deploys running in parallel threads each build and apply from their own directory.
 
         Args:
             command (str): The command to execute.
+            max_size (Optional[int]): Characters of output kept, only the tail is logged.
 
         Returns:
             bool: True if the command executes successfully; otherwise, False.
         """
         try:
             self.logs.append(f"Executing command: {command}")
-            
-            # Change to the service directory using the context manager
-            with change_dir(self.service_dir):
-                p = pexpect.spawn(command, encoding="utf-8", timeout=TIMEOUT)
-                p.expect(pexpect.EOF)
-                if max_size:
-                    output = p.before[-max_size:]
-                else:
-                    output = p.before
-                self.logs.append(f"Output:\n{output}")
-                p.close()
-                if p.exitstatus != 0:
-                    self.logs.append(f"Error: Command '{command}' exited with status {p.exitstatus}")
-                    return False
-            return True
-
-        except pexpect.TIMEOUT as e:
-            self.logs.append(f"Command '{command}' timed out after {TIMEOUT}s: {str(e)}")
-            return False
+            result = run_command(command, cwd=self.service_dir, timeout=TIMEOUT, limit=max_size)
         except Exception as e:
             self.logs.append(f"Exception while executing command '{command}': {str(e)}")
             return False
 
+        self.last_output = result.output
+        self.logs.append(f"Output:\n{result.output}")
+        if result.timed_out:
+            self.logs.append(f"Command '{command}' timed out after {TIMEOUT}s")
+            return False
+        if result.exitstatus != 0:
+            self.logs.append(f"Error: Command '{command}' exited with status {result.exitstatus}")
+            return False
+        return True
+
+    def _timed_command(self, stage: str, command: str, max_size: Optional[int] = None) -> bool:
+        """
+        Execute a command as a named stage and record how long it took.
+
+        Args:
+            stage (str): Stage name used for progress events and timings.
+            command (str): The command to execute.
+
+        Returns:
+            bool: True if the command executes successfully; otherwise, False.
+        """
+        progress.emit(stage, command)
+        start = time.monotonic()
+        with tracing.span(stage, command=command) as span:
+            ok = self._execute_command(command, max_size=max_size)
+            span.set(ok=ok)
+        self.timings[stage] = time.monotonic() - start
+        metrics.DEPLOY_STAGE_SECONDS.labels(stage=stage, outcome=metrics.outcome(ok)).observe(self.timings[stage])
+        self.logs.append(f"Stage {stage} took {self.timings[stage]:.2f}s")
+        return ok
+
     def __docker_push(self) -> bool:
         """
         Build, tag, and push the Docker image to the container registry.
@@ -178,22 +277,38 @@ class K8sService:
         Returns:
             bool: True if all steps succeed; otherwise, False.
         """
-        image_tag = f"{self.service_name}:latest"
-        registry_tag = (
-            f"{Config.GCP_ARTIFACT_REGISTRY}/"
-            f"{Config.GCP_PROJECT_ID}/"
-            f"{Config.GCP_ARTIFACT_REGISTRY_REPO}/{image_tag}"
-        )
-        commands = [
-            f"sudo docker build --quiet -t {image_tag} .",
-            f"sudo docker tag {image_tag} {registry_tag}",
-            f"sudo docker push {registry_tag}"
-        ]
-
-        for cmd in commands:
-            if not self._execute_command(cmd, max_size=500):
-                self.logs.append(f"Failed executing: {cmd}")
-                return False
+        image_tag, registry_tag = lifecycle.image_tags(self.service_name)
+        registry_repo = registry_tag.rsplit("/", 1)[0]
+        # One registry cache per base image, shared by every deploy built on it
+        cache_tag = re.sub(r"[^a-zA-Z0-9_.-]", "-", _base_image(self.dockerfile_content))[:128]
+        cache_ref = f"{registry_repo}/buildcache:{cache_tag}"
+
+        # Each build exports the local cache to a directory of its own, seeded from the newest export of its base image
+        with lifecycle.reaper.build_cache(cache_tag) as (cache_src, cache_dest):
+            if Config.DOCKER_BUILDX and ensure_builder():
+                build_cmd = f"sudo docker buildx build --builder {Config.DOCKER_BUILDER} --load --progress=plain "
+                if cache_src:
+                    build_cmd += f"--cache-from type=local,src={cache_src} "
+                build_cmd += f"--cache-to type=local,dest={cache_dest},mode=max "
+                if Config.DOCKER_REGISTRY_CACHE:
+                    build_cmd += (
+                        f"--cache-from type=registry,ref={cache_ref} "
+                        f"--cache-to type=registry,ref={cache_ref},mode=max "
+                    )
+                build_cmd += f"-t {image_tag} ."
+            else:
+                build_cmd = f"sudo DOCKER_BUILDKIT=1 docker build --quiet -t {image_tag} ."
+
+            commands = [
+                ("docker_build", build_cmd),
+                ("docker_tag", f"sudo docker tag {image_tag} {registry_tag}"),
+                ("docker_push", f"sudo docker push {registry_tag}")
+            ]
+
+            for stage, cmd in commands:
+                if not self._timed_command(stage, cmd, max_size=500):
+                    self.logs.append(f"Failed executing: {cmd}")
+                    return False
         return True
 
     def __docker_deploy(self) -> bool:
@@ -204,48 +319,39 @@ class K8sService:
             bool: True if the deployment is successful; otherwise, False.
         """
         # Apply the configuration first
-        apply_cmd = f"kubectl apply -f {DEFAULT_CONFIG_YAML}"
-        if not self._execute_command(apply_cmd):
+        apply_cmd = f"{Config.KUBECTL} apply -f {DEFAULT_CONFIG_YAML}"
+        if not self._timed_command("kubectl_apply", apply_cmd):
             self.logs.append(f"Failed executing: {apply_cmd}")
             return False
 
-        # Wait for the pod to appear (check up to 5 times, every 2 seconds)
-        pod_found = False
-        search_pod_name = ""
-        for _ in range(15):
-            # Use a bash shell to handle the pipe
-            command = f"kubectl get pods | grep {self.service_name}"
-            p = pexpect.spawn("/bin/bash", ["-c", command], encoding="utf-8")
-            try:
-                p.expect(pexpect.EOF, timeout=5)
-            except pexpect.exceptions.TIMEOUT:
-                p.close()
-                time.sleep(2)
-                continue
-
-            output = p.before.strip()
-            p.close()
-
-            if output:
-                # Check if the output contains "CrashLoopBackOff" or "Completed"
-                if ("CrashLoopBackOff" in output) or ("Completed" in output):
-                    pod_found = True
-                    search_pod_name = output.split()[0]
-                    self.logs.append(f"Pod {search_pod_name} found.")
-                    break
-
-            time.sleep(2)
-
-        if not pod_found:
-            self.logs.append(f"Search pod name: {search_pod_name} not found.")
-            self.logs.append(f"Pod {self.service_name} not found.")
+        # Watch the pod until it is ready, has run to completion or has failed
+        selector = f"app={self.service_name}" if f"app: {self.service_name}" in self.config_yaml_content else None
+        start = time.monotonic()
+        with tracing.span("pod_wait", selector=selector or "") as span:
+            result = PodWaiter().wait(
+                deadline=POD_WAIT_TIMEOUT,
+                selector=selector,
+                name_prefix=self.service_name,
+                on_state=lambda state: progress.emit("pod_state", str(state)),
+            )
+            span.set(outcome=result.outcome, reason=result.reason)
+        self.timings["pod_wait"] = time.monotonic() - start
+        metrics.DEPLOY_STAGE_SECONDS.labels(
+            stage="pod_wait", outcome=metrics.outcome(result.outcome in (READY, COMPLETED))
+        ).observe(self.timings["pod_wait"])
+        if result.outcome not in (READY, COMPLETED):
+            self.logs.append(f"Pod {result.pod_name or self.service_name} {result.outcome}: {result.reason}")
             return False
+        search_pod_name = result.pod_name
+        self.pod_name = search_pod_name
+        self.logs.append(f"Pod {search_pod_name} found ({result.reason}).")
 
         # Now that the pod exists, retrieve its logs
-        logs_cmd = f"kubectl logs {search_pod_name}"
-        if not self._execute_command(logs_cmd):
+        logs_cmd = f"{Config.KUBECTL} logs {search_pod_name}"
+        if not self._timed_command("kubectl_logs", logs_cmd):
             self.logs.append(f"Failed executing: {logs_cmd}")
             return False
+        self.pod_output = self.last_output
 
         return True
 
@@ -256,15 +362,18 @@ class K8sService:
         Returns:
             bool: True if both push and deploy are successful; otherwise, False.
         """
-        self.logs.append("Starting Docker push process...")
-        if not self.__docker_push():
-            self.logs.append("Docker push failed. Aborting deployment.")
-            return False
+        try:
+            self.logs.append("Starting Docker push process...")
+            if not self.__docker_push():
+                self.logs.append("Docker push failed. Aborting deployment.")
+                return False
 
-        self.logs.append("Docker push successful. Starting deployment process...")
-        if not self.__docker_deploy():
-            self.logs.append("Deployment process failed.")
-            return False
+            self.logs.append("Docker push successful. Starting deployment process...")
+            if not self.__docker_deploy():
+                self.logs.append("Deployment process failed.")
+                return False
 
-        self.logs.append("Deployment successful.")
-        return True
\ No newline at end of file
+            self.logs.append("Deployment successful.")
+            return True
+        finally:
+            lifecycle.reaper.release(self.service_name)
@@ -0,0 +1,441 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import threading
+import subprocess
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from config import Config
+from utils import metrics
+
+WORKSPACE_ROOT = "tmp"
+WORKSPACE_PREFIX = "codeaidapter-"
+CONFIG_YAML = "config.yaml"
+
+# Marker files, so what was already reclaimed survives a restart of the server
+IMAGES_REMOVED = ".images-removed"
+DEPLOYMENT_REMOVED = ".deployment-removed"
+
+# BuildKit local caches, one directory per base image holding one export per build
+BUILD_CACHE_ROOT = os.path.abspath(Config.DOCKER_BUILD_CACHE_DIR)
+# Written by BuildKit once an export is complete
+BUILD_CACHE_INDEX = "index.json"
+# Seconds an unfinished export is left alone, in case a build outside this process still writes it
+BUILD_CACHE_GRACE = 600
+
+WORKSPACE = "workspace"
+IMAGE = "image"
+DEPLOYMENT = "deployment"
+BUILD_CACHE = "build_cache"
+
+def image_tags(service_name: str) -> Tuple[str, str]:
+    """
+    Local and registry tags of the image built for a deploy.
+    """
+    registry_repo = f"{Config.GCP_ARTIFACT_REGISTRY}/{Config.GCP_PROJECT_ID}/{Config.GCP_ARTIFACT_REGISTRY_REPO}"
+    image_tag = f"{service_name}:latest"
+    return image_tag, f"{registry_repo}/{image_tag}"
+
+def _du(path: str) -> Tuple[int, int]:
+    size = files = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            files += 1
+    return size, files
+
+def _remove_tree(path: str) -> bool:
+    # Cache exports are written by `sudo docker`, so they belong to root
+    result = subprocess.run(["sudo", "rm", "-rf", path], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f'[lifecycle.py] Failed to remove {path}: {result.stderr.strip()}', file=sys.stderr)
+    return result.returncode == 0
+
+def _image_size(tag: str) -> int:
+    result = subprocess.run(["sudo", "docker", "image", "inspect", "--format", "{{.Size}}", tag], capture_output=True, text=True)
+    try:
+        return int(result.stdout.strip())
+    except ValueError:
+        return 0
+
+@dataclass
+class Workspace:
+    name: str
+    path: str
+    created_at: float
+    size: int
+    files: int
+    images_removed: bool
+    deployment_removed: bool
+    image_size: int = 0
+
+@dataclass
+class BuildCache:
+    name: str
+    path: str
+    created_at: float
+    size: int
+    complete: bool
+
+def _select(items: list, ttl: float, quota: Optional[float], size: Callable, now: float, everything: bool) -> list:
+    """
+    Pick the items to reclaim, oldest first: everything past its TTL, then the oldest
+    of the rest until the total fits the quota. A TTL of 0 or a quota of None disables
+    that limit, a quota of 0 reclaims everything not past its TTL too.
+    """
+    chosen = []
+    kept = []
+    for item in sorted(items, key=lambda w: w.created_at):
+        if everything:
+            chosen.append((item, "manual"))
+        elif ttl and now - item.created_at > ttl:
+            chosen.append((item, "ttl"))
+        else:
+            kept.append(item)
+    total = sum(size(item) for item in kept)
+    for item in kept:
+        if quota is None or total <= quota:
+            break
+        chosen.append((item, "quota"))
+        total -= size(item)
+    return chosen
+
+def _quota_bytes(megabytes: int) -> Optional[int]:
+    # A quota of 0 in the config means no quota
+    return megabytes * 1024 * 1024 if megabytes else None
+
+class Lifecycle:
+    def __init__(self, root: str = WORKSPACE_ROOT):
+        """
+        Reclaim what deploys leave behind: the tmp/codeaidapter-<uuid> workspaces, the images
+        built and pushed for them and the Kubernetes objects applied from their config.yaml.
+        Each kind has its own TTL and quota. Deployments and images are removed before the
+        workspace that describes them, and deploys still running are never touched.
+
+        Args:
+            root (str): Directory the deploy workspaces are created in.
+        """
+        self.root = root
+        self._active: Set[str] = set()
+        # Build cache exports read or written by running builds, with the number of builds using them
+        self._caches: Dict[str, int] = {}
+        self._image_sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._totals = {"sweeps": 0, "workspaces": 0, "images": 0, "deployments": 0, "build_caches": 0, "bytes": 0, "errors": 0}
+        self.last_sweep: Optional[dict] = None
+
+    def acquire(self, service_name: str):
+        """
+        Mark a deploy as running so its workspace, image and deployment are left alone.
+        """
+        with self._lock:
+            self._active.add(service_name)
+
+    def release(self, service_name: str):
+        with self._lock:
+            self._active.discard(service_name)
+
+    @contextmanager
+    def build_cache(self, cache_tag: str) -> Iterator[Tuple[Optional[str], str]]:
+        """
+        Hand a build the newest complete cache export of its base image to import from and
+        a new directory of its own to export to, so concurrent builds never write the same
+        directory. Both are left alone by the sweep until the block exits, and an export that
+        did not complete is removed then.
+
+        Args:
+            cache_tag (str): Name of the base image, safe to use as a directory name.
+
+        Yields:
+            Tuple[Optional[str], str]: The export to import from, None if there is none yet,
+            and the directory to export to.
+        """
+        root = os.path.join(BUILD_CACHE_ROOT, cache_tag)
+        with self._lock:
+            exports = [c for c in self._scan_build_caches(cache_tag) if c.complete]
+            source = max(exports, key=lambda c: c.created_at).path if exports else None
+            dest = os.path.join(root, f"{time.time_ns()}-{uuid.uuid4().hex[:8]}")
+            used = [path for path in (source, dest) if path]
+            for path in used:
+                self._caches[path] = self._caches.get(path, 0) + 1
+        try:
+            yield source, dest
+        finally:
+            with self._lock:
+                for path in used:
+                    self._caches[path] -= 1
+                    if not self._caches[path]:
+                        del self._caches[path]
+            if os.path.isdir(dest) and not os.path.exists(os.path.join(dest, BUILD_CACHE_INDEX)):
+                _remove_tree(dest)
+
+    def start(self, interval: Optional[float] = None):
+        """
+        Sweep in a background thread every `interval` seconds, defaults to Config.LIFECYCLE_INTERVAL.
+        An interval of 0 leaves only the on-demand sweep.
+        """
+        interval = Config.LIFECYCLE_INTERVAL if interval is None else interval
+        if interval <= 0 or self._thread is not None:
+            return
+
+        def _loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print('[lifecycle.py] Sweep failed:', e, file=sys.stderr)
+
+        self._thread = threading.Thread(target=_loop, name="lifecycle", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def sweep(self, everything: bool = False) -> dict:
+        """
+        Reclaim expired and over-quota deployments, images, workspaces and build caches once.
+
+        Args:
+            everything (bool): Reclaim every deploy that is not running, ignoring TTLs and quotas.
+
+        Returns:
+            dict: Counts and bytes reclaimed per kind, with the deploys that were touched.
+        """
+        with self._sweep_lock:
+            start = time.monotonic()
+            now = time.time()
+            report = {
+                "deployments": 0, "objects": 0, "images": 0, "image_bytes": 0,
+                "workspaces": 0, "workspace_bytes": 0, "files": 0,
+                "build_caches": 0, "build_cache_bytes": 0, "errors": 0, "reclaimed": [],
+            }
+            workspaces = self._scan()
+
+            live = [w for w in workspaces if not w.deployment_removed]
+            with self._lock:
+                running = len(self._active)
+            # Running deploys count against the quota but are never picked
+            quota = max(Config.DEPLOY_MAX_ACTIVE - running, 0) if Config.DEPLOY_MAX_ACTIVE else None
+            for workspace, reason in _select(live, Config.DEPLOY_TTL, quota, lambda w: 1, now, everything):
+                self._remove_deployment(workspace, reason, report)
+
+            built = [w for w in workspaces if not w.images_removed]
+            for w in built:
+                w.image_size = self._image_size(w.name)
+            for workspace, reason in _select(built, Config.DEPLOY_IMAGE_TTL, _quota_bytes(Config.DEPLOY_IMAGE_QUOTA_MB),
+                                             lambda w: w.image_size, now, everything):
+                self._remove_images(workspace, reason, report)
+
+            for workspace, reason in _select(workspaces, Config.WORKSPACE_TTL, _quota_bytes(Config.WORKSPACE_QUOTA_MB),
+                                             lambda w: w.size, now, everything):
+                self._remove_workspace(workspace, reason, report)
+
+            self._sweep_build_caches(now, everything, report)
+
+            report["duration_s"] = time.monotonic() - start
+            with self._lock:
+                self._totals["sweeps"] += 1
+                self._totals["workspaces"] += report["workspaces"]
+                self._totals["images"] += report["images"]
+                self._totals["deployments"] += report["deployments"]
+                self._totals["build_caches"] += report["build_caches"]
+                self._totals["bytes"] += report["image_bytes"] + report["workspace_bytes"] + report["build_cache_bytes"]
+                self._totals["errors"] += report["errors"]
+                self.last_sweep = {key: value for key, value in report.items() if key != "reclaimed"}
+                self.last_sweep["at"] = now
+            if report["reclaimed"]:
+                print(f'[lifecycle.py] Reclaimed {len(report["reclaimed"])} items, '
+                      f'{report["image_bytes"] + report["workspace_bytes"] + report["build_cache_bytes"]} bytes', file=sys.stderr)
+            return report
+
+    def stats(self) -> dict:
+        workspaces = self._scan()
+        caches = self._scan_build_caches()
+        with self._lock:
+            return {
+                "build_caches": len(caches),
+                "build_cache_bytes": sum(c.size for c in caches),
+                "workspaces": len(workspaces),
+                "workspace_bytes": sum(w.size for w in workspaces),
+                "deployments": sum(1 for w in workspaces if not w.deployment_removed),
+                "images": sum(1 for w in workspaces if not w.images_removed),
+                "running": len(self._active),
+                "reclaimed": dict(self._totals),
+                "last_sweep": self.last_sweep,
+            }
+
+    def _scan(self) -> List[Workspace]:
+        try:
+            names = [name for name in os.listdir(self.root) if name.startswith(WORKSPACE_PREFIX)]
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            active = set(self._active)
+        workspaces = []
+        for name in names:
+            path = os.path.join(self.root, name)
+            if name in active or not os.path.isdir(path):
+                continue
+            try:
+                # Marker files touch the directory, the config.yaml is written once when the deploy starts
+                config_yaml = os.path.join(path, CONFIG_YAML)
+                created_at = os.path.getmtime(config_yaml if os.path.exists(config_yaml) else path)
+            except OSError:
+                continue
+            size, files = _du(path)
+            workspaces.append(Workspace(
+                name=name,
+                path=path,
+                created_at=created_at,
+                size=size,
+                files=files,
+                images_removed=os.path.exists(os.path.join(path, IMAGES_REMOVED)),
+                deployment_removed=os.path.exists(os.path.join(path, DEPLOYMENT_REMOVED)),
+            ))
+        return workspaces
+
+    def _scan_build_caches(self, cache_tag: Optional[str] = None) -> List[BuildCache]:
+        """
+        List the cache exports of one base image, or of all of them.
+        """
+        try:
+            tags = [cache_tag] if cache_tag else os.listdir(BUILD_CACHE_ROOT)
+        except FileNotFoundError:
+            return []
+        caches = []
+        for tag in tags:
+            root = os.path.join(BUILD_CACHE_ROOT, tag)
+            try:
+                names = os.listdir(root)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for name in names:
+                path = os.path.join(root, name)
+                if not os.path.isdir(path):
+                    continue
+                index = os.path.join(path, BUILD_CACHE_INDEX)
+                complete = os.path.exists(index)
+                try:
+                    created_at = os.path.getmtime(index if complete else path)
+                except OSError:
+                    continue
+                caches.append(BuildCache(name=f"{tag}/{name}", path=path, created_at=created_at,
+                                         size=_du(path)[0] if cache_tag is None else 0, complete=complete))
+        return caches
+
+    def _sweep_build_caches(self, now: float, everything: bool, report: dict):
+        """
+        Remove unfinished exports, exports superseded by a newer one of the same base image,
+        then the newest exports past their TTL or over the quota. Exports in use are kept.
+        """
+        caches = self._scan_build_caches()
+        with self._lock:
+            in_use = set(self._caches)
+        caches = [c for c in caches if c.path not in in_use]
+        newest: Dict[str, BuildCache] = {}
+        for cache in caches:
+            tag = cache.name.split("/", 1)[0]
+            if cache.complete and (tag not in newest or cache.created_at > newest[tag].created_at):
+                newest[tag] = cache
+        latest = list(newest.values())
+        for cache in caches:
+            if not cache.complete:
+                if now - cache.created_at > BUILD_CACHE_GRACE:
+                    self._remove_build_cache(cache, "incomplete", report)
+            elif cache not in latest:
+                self._remove_build_cache(cache, "superseded", report)
+        for cache, reason in _select(latest, Config.DOCKER_BUILD_CACHE_TTL, _quota_bytes(Config.DOCKER_BUILD_CACHE_QUOTA_MB),
+                                     lambda c: c.size, now, everything):
+            self._remove_build_cache(cache, reason, report)
+
+    def _remove_build_cache(self, cache: BuildCache, reason: str, report: dict):
+        if not _remove_tree(cache.path):
+            report["errors"] += 1
+            return
+        report["build_caches"] += 1
+        report["build_cache_bytes"] += cache.size
+        report["reclaimed"].append({"kind": BUILD_CACHE, "name": cache.name, "reason": reason, "bytes": cache.size})
+        metrics.LIFECYCLE_RECLAIMED_OBJECTS.labels(kind=BUILD_CACHE, reason=reason).inc()
+        metrics.LIFECYCLE_RECLAIMED_BYTES.labels(kind=BUILD_CACHE).inc(cache.size)
+
+    def _image_size(self, service_name: str) -> int:
+        if service_name not in self._image_sizes:
+            self._image_sizes[service_name] = _image_size(image_tags(service_name)[0])
+        return self._image_sizes[service_name]
+
+    @staticmethod
+    def _mark(workspace: Workspace, marker: str):
+        with open(os.path.join(workspace.path, marker), "w", encoding="utf-8") as f:
+            f.write(str(time.time()))
+
+    def _remove_deployment(self, workspace: Workspace, reason: str, report: dict):
+        if not os.path.exists(os.path.join(workspace.path, CONFIG_YAML)):
+            self._mark(workspace, DEPLOYMENT_REMOVED)
+            workspace.deployment_removed = True
+            return
+        result = subprocess.run(
+            [Config.KUBECTL, "delete", "-f", CONFIG_YAML, "--ignore-not-found", "--wait=false"],
+            cwd=workspace.path, capture_output=True, text=True, timeout=60
+        )
+        if result.returncode != 0:
+            print(f'[lifecycle.py] Failed to delete deployment {workspace.name}: {result.stderr.strip()}', file=sys.stderr)
+            report["errors"] += 1
+            return
+        objects = sum(1 for line in result.stdout.splitlines() if line.rstrip().endswith("deleted"))
+        self._mark(workspace, DEPLOYMENT_REMOVED)
+        workspace.deployment_removed = True
+        report["deployments"] += 1
+        report["objects"] += objects
+        report["reclaimed"].append({"kind": DEPLOYMENT, "name": workspace.name, "reason": reason, "objects": objects})
+        metrics.LIFECYCLE_RECLAIMED_OBJECTS.labels(kind=DEPLOYMENT, reason=reason).inc(objects)
+
+    def _remove_images(self, workspace: Workspace, reason: str, report: dict):
+        image_tag, registry_tag = image_tags(workspace.name)
+        # rmi fails for tags that were never built, which is fine
+        subprocess.run(["sudo", "docker", "rmi", image_tag, registry_tag], capture_output=True, text=True)
+        if Config.DEPLOY_REGISTRY_CLEANUP:
+            result = subprocess.run(
+                ["gcloud", "artifacts", "docker", "images", "delete", registry_tag, "--quiet", "--delete-tags"],
+                capture_output=True, text=True
+            )
+            if result.returncode != 0:
+                print(f'[lifecycle.py] Failed to delete {registry_tag} from the registry: {result.stderr.strip()}', file=sys.stderr)
+                report["errors"] += 1
+        size = workspace.image_size
+        self._image_sizes.pop(workspace.name, None)
+        self._mark(workspace, IMAGES_REMOVED)
+        workspace.images_removed = True
+        report["images"] += 1
+        report["image_bytes"] += size
+        report["reclaimed"].append({"kind": IMAGE, "name": image_tag, "reason": reason, "bytes": size})
+        metrics.LIFECYCLE_RECLAIMED_OBJECTS.labels(kind=IMAGE, reason=reason).inc()
+        metrics.LIFECYCLE_RECLAIMED_BYTES.labels(kind=IMAGE).inc(size)
+
+    def _remove_workspace(self, workspace: Workspace, reason: str, report: dict):
+        # The workspace holds the config.yaml needed to delete the deployment, so it goes last
+        if not workspace.deployment_removed:
+            self._remove_deployment(workspace, reason, report)
+            if not workspace.deployment_removed:
+                return
+        if not workspace.images_removed:
+            workspace.image_size = self._image_size(workspace.name)
+            self._remove_images(workspace, reason, report)
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        report["workspaces"] += 1
+        report["workspace_bytes"] += workspace.size
+        report["files"] += workspace.files
+        report["reclaimed"].append({"kind": WORKSPACE, "name": workspace.name, "reason": reason, "bytes": workspace.size})
+        metrics.LIFECYCLE_RECLAIMED_OBJECTS.labels(kind=WORKSPACE, reason=reason).inc()
+        metrics.LIFECYCLE_RECLAIMED_BYTES.labels(kind=WORKSPACE).inc(workspace.size)
+
+reaper = Lifecycle()
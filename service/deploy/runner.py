@@ -0,0 +1,103 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Optional
+
+import pexpect
+
+from config import Config
+
+class OutputTail:
+    def __init__(self, limit: int):
+        """
+        Ring buffer that keeps the last `limit` characters of a command's output,
+        so a chatty build cannot grow the server's memory without bound.
+
+        Args:
+            limit (int): Characters kept.
+        """
+        self.limit = limit
+        self.dropped = 0
+        self._chunks: Deque[str] = deque()
+        self._size = 0
+
+    def append(self, chunk: str):
+        if len(chunk) >= self.limit:
+            self.dropped += self._size + len(chunk) - self.limit
+            self._chunks.clear()
+            self._chunks.append(chunk[-self.limit:])
+            self._size = self.limit
+            return
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        while self._size > self.limit:
+            head = self._chunks[0]
+            excess = self._size - self.limit
+            if len(head) <= excess:
+                self._chunks.popleft()
+                self._size -= len(head)
+                self.dropped += len(head)
+            else:
+                self._chunks[0] = head[excess:]
+                self._size -= excess
+                self.dropped += excess
+
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+@dataclass
+class CommandResult:
+    exitstatus: Optional[int]
+    output: str
+    timed_out: bool = False
+    # Characters of output dropped from the front of the buffer
+    dropped: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return not self.timed_out and self.exitstatus == 0
+
+def run_command(
+    command: str,
+    cwd: str,
+    timeout: float,
+    limit: Optional[int] = None,
+) -> CommandResult:
+    """
+    Run a command in a pseudo terminal in the given directory. The working directory is
+    passed to the child only, so concurrent calls from different threads do not interfere.
+
+    Args:
+        command (str): The command line to run.
+        cwd (str): Working directory of the command.
+        timeout (float): Seconds before the command is killed.
+        limit (Optional[int]): Characters of output kept, defaults to Config.DEPLOY_OUTPUT_LIMIT_KB.
+
+    Returns:
+        CommandResult: Exit status and the tail of the output.
+    """
+    tail = OutputTail(limit or Config.DEPLOY_OUTPUT_LIMIT_KB * 1024)
+    deadline = time.monotonic() + timeout
+    p = pexpect.spawn(command, cwd=cwd, encoding="utf-8", codec_errors="replace", timeout=timeout)
+    timed_out = False
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            try:
+                chunk = p.read_nonblocking(65536, timeout=min(remaining, 1.0))
+            except pexpect.TIMEOUT:
+                continue
+            except pexpect.EOF:
+                break
+            tail.append(chunk)
+    finally:
+        p.close(force=True)
+    return CommandResult(
+        exitstatus=None if timed_out else p.exitstatus,
+        output=tail.text(),
+        timed_out=timed_out,
+        dropped=tail.dropped,
+    )
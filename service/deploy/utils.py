@@ -1,8 +1,23 @@
-from typing import List
+import os
+import re
+import sys
+import json
+from typing import List, Optional, Tuple
 
 from utils.llm import OpenAIChat
+from service import extract
 
-def code_extract(filename: str, code_content: str) -> str:        
+def code_extract(filename: str, code_content: str) -> str:
+    """
+    Remove comments from the source code. Python and Java are handled locally,
+    the LLM is only asked for other languages or sources the lexers reject.
+    """
+    language = extract.language_of(filename)
+    if language is not None:
+        try:
+            return extract.strip_comments(code_content, language)
+        except ValueError as e:
+            print(f'[utils.py] Local comment stripping failed, asking the LLM: {e}', file=sys.stderr)
     response = OpenAIChat.chat(
         dev_prompt="""
         Please only give me the code content from the source code.
@@ -13,7 +28,8 @@ def code_extract(filename: str, code_content: str) -> str:
         File: {filename}
         Code content: 
         {code_content}
-        """
+        """,
+        site="code_extract"
     )
     return response
 
@@ -46,7 +62,8 @@ def generate_dockerfile(
         {code_content}
         --------------------------------
         {prompt}
-        """
+        """,
+        site="generate_dockerfile"
     )
     return response
 
@@ -60,6 +77,7 @@ def generate_config_yaml(
         dev_prompt="""
         I will give you with the content of the Dockerfile and its full name of Docker image that pushed to the registry and the pod name.
         Please give me the content of the config.yaml file based on the Dockerfile content and the pod name.
+        The pod and its template must carry the label "app: <pod name>".
         Don't include any comments or other information.
         Don't use Markdown or any other formatting.
         """,
@@ -70,10 +88,95 @@ def generate_config_yaml(
         Pod name: {pod_name}
         --------------------------------
         {prompt}
-        """
+        """,
+        site="generate_config_yaml"
     )
     return response
 
+DEPLOY_BUNDLE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "deploy_bundle",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "dockerfile": {"type": "string"},
+                "config_yaml": {"type": "string"},
+            },
+            "required": ["dockerfile", "config_yaml"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+def generate_deploy_bundle(
+    filename: str,
+    code_content: str,
+    docker_image_tag: str,
+    pod_name: str,
+    prompt: str = ""
+) -> Tuple[str, str]:
+    """
+    Generate the Dockerfile and the Kubernetes config.yaml in a single schema-constrained call.
+
+    Returns:
+        Tuple[str, str]: The Dockerfile content and the config.yaml content.
+    """
+    dockerfile_template = \
+    """
+    FROM <image>
+    WORKDIR /app
+    COPY <file> .
+    RUN <command> # if needed
+    CMD <command>
+    """
+
+    response = OpenAIChat.chat(
+        dev_prompt=f"""
+        I will give you source code content, the full name of the Docker image that will be pushed to the registry and the pod name.
+        Please give me the Dockerfile content that runs the code and the content of the Kubernetes config.yaml that deploys that image.
+        The source code may contain comments, ignore them.
+        Don't include any comments or other information in either file.
+        Don't use Markdown or any other formatting.
+        The pod and its template in config.yaml must carry the label "app: <pod name>".
+        There is a template for Dockerfile:
+        {dockerfile_template}
+        """,
+        usr_prompt=f"""
+        File: {filename}
+        Code content: 
+        {code_content}
+        Docker image tag: {docker_image_tag}
+        Pod name: {pod_name}
+        --------------------------------
+        {prompt}
+        """,
+        response_format=DEPLOY_BUNDLE_FORMAT,
+        site="generate_deploy_bundle"
+    )
+    bundle = json.loads(response)
+    return bundle["dockerfile"], bundle["config_yaml"]
+
+def render_report(
+    docker_image_tag: str,
+    pod_name: str,
+    pod_output: Optional[str],
+    logs: Optional[List[str]] = None
+) -> str:
+    """
+    Build the deployment report locally from data the deploy already captured.
+    Logs are appended when given, which is used for failed deployments.
+    """
+    report = (
+        f"Docker Image tag: {docker_image_tag}\n"
+        f"Pod Name: {pod_name}\n"
+        f"Pod Output: {(pod_output or '').strip()}\n"
+    )
+    if logs:
+        report += "Logs:\n" + "\n".join(logs) + "\n"
+    return report
+
 def generate_report(
     dockerfile_content: str,
     config_yaml_content: str,
@@ -98,6 +201,71 @@ def generate_report(
         {config_yaml_content}
         Logs:
         {log_str}
-        """
+        """,
+        site="generate_report"
     )
-    return response
\ No newline at end of file
+    return response
+
+_MOVABLE = {"RUN", "EXPOSE", "LABEL"}
+
+def _split_instructions(content: str) -> List[str]:
+    """
+    Split Dockerfile content into instructions, keeping continuation lines and
+    preceding comments together with the instruction they belong to.
+    """
+    instructions = []
+    current = []
+    for line in content.splitlines():
+        if not line.strip() and not current:
+            continue
+        current.append(line)
+        stripped = line.strip()
+        if stripped.startswith("#") or stripped.endswith("\\"):
+            continue
+        instructions.append("\n".join(current))
+        current = []
+    if current:
+        instructions.append("\n".join(current))
+    return instructions
+
+def _keyword(instruction: str) -> str:
+    for line in instruction.splitlines():
+        stripped = line.strip()
+        if stripped and not stripped.startswith("#"):
+            return stripped.split(None, 1)[0].upper()
+    return ""
+
+def _copies_code(instruction: str, code_filename: str) -> bool:
+    sources = [arg for arg in instruction.split()[1:-1] if not arg.startswith("--")]
+    return any(src in (code_filename, f"./{code_filename}", ".", "./") or "*" in src for src in sources)
+
+def _uses_code(instruction: str, code_filename: str) -> bool:
+    stem = os.path.splitext(code_filename)[0]
+    words = set(re.split(r"[\s;&|'\"]+", instruction))
+    return code_filename in instruction or stem in words or "." in words or "./" in words or "*" in instruction
+
+def normalize_dockerfile(content: str, code_filename: str) -> str:
+    """
+    Reorder a Dockerfile so dependency-install layers come before the COPY of the code file.
+    Those layers then stay cached across deploys that only change the code.
+
+    Args:
+        content (str): The generated Dockerfile content.
+        code_filename (str): Name of the code file copied into the image.
+
+    Returns:
+        str: The reordered Dockerfile content.
+    """
+    deferred: List[str] = []
+    normalized: List[str] = []
+    for instruction in _split_instructions(content):
+        keyword = _keyword(instruction)
+        if keyword in ("COPY", "ADD") and _copies_code(instruction, code_filename):
+            deferred.append(instruction)
+            continue
+        if deferred and (keyword not in _MOVABLE or _uses_code(instruction, code_filename)):
+            normalized.extend(deferred)
+            deferred = []
+        normalized.append(instruction)
+    normalized.extend(deferred)
+    return "\n".join(normalized) + "\n"
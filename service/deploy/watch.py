@@ -0,0 +1,174 @@
+import time
+import queue
+import threading
+import subprocess
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from config import Config
+
+READY = "ready"
+COMPLETED = "completed"
+FAILED = "failed"
+TIMEOUT = "timeout"
+
+# Container reasons that will never recover on their own
+FAILURE_REASONS = {
+    "ImagePullBackOff",
+    "ErrImagePull",
+    "ErrImageNeverPull",
+    "InvalidImageName",
+    "CreateContainerConfigError",
+    "CreateContainerError",
+    "RunContainerError",
+}
+# The program has run (and possibly exited), so its logs are available
+COMPLETED_REASONS = {"CrashLoopBackOff", "Completed", "Error", "OOMKilled"}
+COMPLETED_PHASES = {"Succeeded", "Failed"}
+
+JSONPATH = (
+    '{.metadata.name}{"\\t"}{.status.phase}{"\\t"}'
+    '{.status.containerStatuses[*].state.waiting.reason}{"\\t"}'
+    '{.status.containerStatuses[*].state.terminated.reason}{"\\t"}'
+    '{.status.containerStatuses[*].ready}{"\\n"}'
+)
+
+@dataclass
+class PodState:
+    name: str
+    phase: str
+    waiting_reasons: List[str]
+    terminated_reasons: List[str]
+    ready: List[bool]
+
+    def __str__(self) -> str:
+        reasons = " ".join(self.waiting_reasons + self.terminated_reasons)
+        return f"{self.name} {self.phase} {reasons}".strip()
+
+@dataclass
+class WaitResult:
+    outcome: str
+    pod_name: Optional[str]
+    state: Optional[PodState]
+    reason: str
+
+def parse_line(line: str) -> Optional[PodState]:
+    """
+    Parse one line printed by `kubectl get pods --watch -o jsonpath=JSONPATH`.
+    """
+    fields = line.rstrip("\n").split("\t")
+    if not fields or not fields[0].strip():
+        return None
+    fields += [""] * (5 - len(fields))
+    name, phase, waiting, terminated, ready = (f.strip() for f in fields[:5])
+    return PodState(
+        name=name,
+        phase=phase,
+        waiting_reasons=waiting.split(),
+        terminated_reasons=terminated.split(),
+        ready=[r == "true" for r in ready.split()],
+    )
+
+def evaluate(state: PodState) -> Optional[WaitResult]:
+    """
+    Decide whether a pod state ends the wait.
+
+    Returns:
+        Optional[WaitResult]: The outcome, or None while the pod is still starting.
+    """
+    reasons = state.waiting_reasons + state.terminated_reasons
+    failure = next((r for r in reasons if r in FAILURE_REASONS), None)
+    if failure:
+        return WaitResult(FAILED, state.name, state, failure)
+    completed = next((r for r in reasons if r in COMPLETED_REASONS), None)
+    if completed or state.phase in COMPLETED_PHASES:
+        return WaitResult(COMPLETED, state.name, state, completed or state.phase)
+    if state.phase == "Running" and state.ready and all(state.ready):
+        return WaitResult(READY, state.name, state, "Running")
+    return None
+
+class PodWaiter:
+    def __init__(self, kubectl: Optional[str] = None):
+        """
+        Wait for pods through a `kubectl get pods --watch` stream instead of polling.
+
+        Args:
+            kubectl (Optional[str]): kubectl executable, defaults to Config.KUBECTL.
+        """
+        self.kubectl = kubectl or Config.KUBECTL
+
+    def wait(
+        self,
+        deadline: float,
+        selector: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        on_state: Optional[Callable[[PodState], None]] = None,
+    ) -> WaitResult:
+        """
+        Block until a matching pod is ready, has completed or has failed, or the deadline passes.
+
+        Args:
+            deadline (float): Overall time budget in seconds.
+            selector (Optional[str]): Label selector passed to kubectl, e.g. "app=my-service".
+            name_prefix (Optional[str]): Only consider pods whose name starts with this prefix.
+            on_state (Optional[Callable[[PodState], None]]): Called for every observed pod state.
+
+        Returns:
+            WaitResult: The outcome with the pod name and its last observed state.
+        """
+        end = time.monotonic() + deadline
+        last_state: Optional[PodState] = None
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            # The API server closes watches now and then, so reopen until the deadline
+            result, last_state = self._watch(remaining, selector, name_prefix, on_state, last_state)
+            if result is not None:
+                return result
+            time.sleep(min(0.5, max(end - time.monotonic(), 0)))
+
+        return WaitResult(
+            TIMEOUT,
+            last_state.name if last_state else None,
+            last_state,
+            f"Pod did not become ready within {deadline:g}s",
+        )
+
+    def _watch(self, remaining, selector, name_prefix, on_state, last_state):
+        command = [self.kubectl, "get", "pods", "--watch", "-o", f"jsonpath={JSONPATH}"]
+        if selector:
+            command += ["-l", selector]
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        lines: "queue.Queue[Optional[str]]" = queue.Queue()
+
+        def _read():
+            for line in proc.stdout:
+                lines.put(line)
+            lines.put(None)
+
+        threading.Thread(target=_read, daemon=True).start()
+        end = time.monotonic() + remaining
+        try:
+            while True:
+                timeout = end - time.monotonic()
+                if timeout <= 0:
+                    return None, last_state
+                try:
+                    line = lines.get(timeout=timeout)
+                except queue.Empty:
+                    return None, last_state
+                if line is None:
+                    return None, last_state
+                state = parse_line(line)
+                if state is None or (name_prefix and not state.name.startswith(name_prefix)):
+                    continue
+                last_state = state
+                if on_state:
+                    on_state(state)
+                result = evaluate(state)
+                if result is not None:
+                    return result, last_state
+        finally:
+            proc.kill()
+            proc.wait()
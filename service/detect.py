@@ -0,0 +1,220 @@
+import io
+import re
+import ast
+import tokenize
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from service import extract
+from service import images
+from utils.cache import LRUCache, make_key
+
+UNKNOWN = "unknown"
+
+@dataclass
+class Detection:
+    language: str
+    # Oldest version the code needs, e.g. "3.10", "2" or "16"; None when nothing narrows it down
+    version: Optional[str]
+    confidence: float
+    features: List[str] = field(default_factory=list)
+
+    @property
+    def runtime_version(self) -> Optional[str]:
+        """
+        Catalog version to run the code with. Newer runtimes still run code written for an
+        older minor version, so only Python 2 needs its own runtime; the rest uses the latest.
+        """
+        if self.language == "python" and self.version == "2":
+            return "2"
+        return None
+
+    def image(self) -> Optional[str]:
+        return images.catalog_image(self.language, self.runtime_version)
+
+cache = LRUCache(max_entries=4096)
+
+# Node types that need at least the given Python version, looked up by name as older hosts lack some
+_PY_NODES: List[Tuple[str, Tuple[int, int], str]] = [
+    ("TypeAlias", (3, 12), "type alias statement"),
+    ("TryStar", (3, 11), "except* clause"),
+    ("Match", (3, 10), "match statement"),
+    ("NamedExpr", (3, 8), "assignment expression"),
+    ("JoinedStr", (3, 6), "f-string"),
+    ("AnnAssign", (3, 6), "variable annotation"),
+    ("AsyncFunctionDef", (3, 5), "async def"),
+    ("Await", (3, 5), "await"),
+]
+
+def _python3_features(tree: ast.AST) -> List[Tuple[Tuple[int, int], str]]:
+    node_types = {type(node).__name__ for node in ast.walk(tree)}
+    found = [(version, name) for node, version, name in _PY_NODES if node in node_types]
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if node.args.posonlyargs:
+                found.append(((3, 8), "positional-only parameters"))
+            if getattr(node, "type_params", None):
+                found.append(((3, 12), "type parameters"))
+    return found
+
+_PY2_EXCEPT = re.compile(r"^\s*except\s+[\w.]+\s*,\s*\w+\s*:", re.M)
+_PY2_RAISE = re.compile(r"^\s*raise\s+[\w.]+\s*,\s*\S", re.M)
+_PY2_STATEMENTS = {"print", "exec"}
+
+def _python2_features(code: str) -> List[str]:
+    found = []
+    if _PY2_EXCEPT.search(code):
+        found.append("except X, e")
+    if _PY2_RAISE.search(code):
+        found.append("raise E, msg")
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(code).readline))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return found
+    line_start = True
+    for token, following in zip(tokens, tokens[1:]):
+        if line_start and token.type == tokenize.NAME and token.string in _PY2_STATEMENTS:
+            if following.type in (tokenize.STRING, tokenize.NAME, tokenize.NUMBER) or following.string == ">>":
+                found.append(f"{token.string} statement")
+        if token.type == tokenize.OP and token.string == "<>":
+            found.append("<> operator")
+        if token.type == tokenize.ERRORTOKEN and token.string == "`":
+            found.append("backtick repr")
+        if token.type == tokenize.NUMBER and following.type == tokenize.NAME and following.string in ("L", "l") \
+                and token.end == following.start:
+            found.append("long literal")
+        # Statements start a logical line or follow the colon of a one-line block
+        line_start = token.type in (tokenize.NEWLINE, tokenize.NL, tokenize.INDENT, tokenize.DEDENT) or \
+            (token.type == tokenize.OP and token.string == ":")
+    return sorted(set(found))
+
+_PY_HINTS = re.compile(r"^\s*(?:def\s+\w+\s*\(.*\)\s*:|import\s+\w+|from\s+[\w.]+\s+import\s|class\s+\w+\s*(?:\(.*\))?\s*:|if\s+__name__\s*==)", re.M)
+
+# Weaker signals for Python too broken for the hints above, only used when nothing looks like Java
+_PY_LOOSE = [
+    (re.compile(r"^\s*print\s*\(", re.M), "print call"),
+    (re.compile(r"^\s*def\s+\w+", re.M), "def"),
+    (re.compile(r"^\s*(?:import\s+\w|from\s+[\w.]+\s+import\b)", re.M), "import"),
+    (re.compile(r"^\s*(?:if|elif|else|for|while|try|except|finally|with|class)\b[^\n]*:\s*$", re.M), "block header"),
+    (re.compile(r"^\s*[\w.]+\s*\([^\n]*$", re.M), "call statement"),
+    (re.compile(r"^\s*[\w.\[\]]+\s*[-+*/]?=\s*\S", re.M), "assignment"),
+]
+
+def _python_loose(code: str) -> List[str]:
+    lines = [line for line in code.splitlines() if line.strip()]
+    # Braces and semicolons at the end of lines belong to C-like languages
+    if any(line.rstrip().endswith((";", "{", "}")) for line in lines):
+        return []
+    signals = [name for pattern, name in _PY_LOOSE if pattern.search(code)]
+    if any(line[0] in " \t" for line in lines):
+        signals.append("indentation")
+    # A call, an assignment or an indented line alone is too common in prose to say much
+    return signals if set(signals) - {"call statement", "assignment", "indentation"} or len(signals) > 1 else []
+
+_JAVA_STRINGS = re.compile(r'"""[\s\S]*?"""|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'')
+_JAVA_SIGNALS = [
+    (re.compile(r"\b(?:class|interface|enum|record)\s+\w+[^;{]*\{"), "type declaration"),
+    (re.compile(r"\bpublic\s+static\s+void\s+main\s*\(\s*(?:final\s+)?String"), "main method"),
+    (re.compile(r"^\s*(?:import|package)\s+[\w.]+(?:\.\*)?\s*;", re.M), "import/package"),
+    (re.compile(r"\bSystem\.(?:out|err)\.print"), "System.out"),
+    (re.compile(r"\b(?:public|private|protected)\s+(?:static\s+)?[\w<>\[\], ]+\s+\w+\s*\([^)]*\)\s*(?:throws\s+[\w., ]+)?\{"), "method declaration"),
+    (re.compile(r"\b(?:int|long|double|boolean|char|String)(?:\[\])?\s+\w+\s*[=;]"), "typed variable"),
+]
+_JAVA_FEATURES = [
+    (re.compile(r"\bcase\s+[A-Z]\w*(?:<[^>]*>)?\s+\w+\s*(?:when\b.*)?->"), "21", "pattern matching for switch"),
+    (re.compile(r"\bsealed\s+(?:class|interface)\b|\bpermits\s+\w+"), "17", "sealed types"),
+    (re.compile(r"\brecord\s+\w+\s*(?:<[^>]*>)?\s*\("), "16", "record"),
+    (re.compile(r"\binstanceof\s+[A-Z][\w.]*(?:<[^>]*>)?\s+\w+\s*[)&|;]"), "16", "pattern matching for instanceof"),
+    (re.compile(r"\bcase\s+[^:;\n]+->|\byield\s+\w"), "14", "switch expression"),
+    (re.compile(r"\bvar\s+\w+\s*="), "10", "var"),
+    (re.compile(r"\b(?:List|Set|Map)\.of\s*\("), "9", "collection factory"),
+    (re.compile(r"->|::|\.stream\(\)"), "8", "lambda/stream"),
+    (re.compile(r"\w<>\s*\(|\btry\s*\("), "7", "diamond/try-with-resources"),
+]
+
+def _java(code: str) -> Optional[Detection]:
+    try:
+        stripped = extract.strip_comments(code, "java")
+    except ValueError:
+        return None
+    text_block = '"""' in stripped
+    body = _JAVA_STRINGS.sub('""', stripped)
+    signals = [name for pattern, name in _JAVA_SIGNALS if pattern.search(body)]
+    if not signals:
+        return None
+    statements = [line for line in body.splitlines() if line.strip()]
+    java_like = sum(1 for line in statements if line.rstrip().endswith((";", "{", "}")))
+    balanced = body.count("{") == body.count("}") and body.count("(") == body.count(")")
+    confidence = min(0.95, 0.35 + 0.15 * len(signals) + 0.2 * java_like / max(len(statements), 1))
+    if not balanced:
+        confidence *= 0.7
+    features = [(version, name) for pattern, version, name in _JAVA_FEATURES if pattern.search(body)]
+    if text_block:
+        features.append(("15", "text block"))
+    version = max((version for version, _ in features), key=int, default=None)
+    return Detection("java", version, round(confidence, 2), signals + [name for _, name in features])
+
+def _is_bare_expression(node: ast.AST) -> bool:
+    return isinstance(node, ast.Expr) and isinstance(node.value, (ast.Name, ast.Constant, ast.Attribute))
+
+def _detect(code: str) -> Detection:
+    if not code or not code.strip():
+        return Detection(UNKNOWN, None, 0.0)
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        tree = None
+    if tree is not None and all(_is_bare_expression(node) for node in tree.body):
+        # Prose such as "hello" parses as a Python name, that alone says nothing
+        tree = None if not _PY_HINTS.search(code) else tree
+        if tree is None:
+            return _java(code) or Detection(UNKNOWN, None, 0.0)
+    if tree is not None:
+        java = _java(code)
+        # A handful of Java statements can also be valid Python expressions, the Java signals decide
+        if java is not None and java.confidence >= 0.8:
+            return java
+        features = _python3_features(tree)
+        version = max(features)[0] if features else None
+        return Detection(
+            "python",
+            f"{version[0]}.{version[1]}" if version else "3",
+            0.95,
+            [name for _, name in features],
+        )
+
+    java = _java(code)
+    if java is not None and java.confidence >= 0.6:
+        return java
+    python2 = _python2_features(code)
+    if python2:
+        return Detection("python", "2", 0.9, python2)
+    if _PY_HINTS.search(code):
+        # Python that does not compile, e.g. the broken code of a debugging request
+        return Detection("python", None, 0.6, ["python syntax with errors"])
+    if java is not None:
+        return java
+    loose = _python_loose(code)
+    if loose:
+        return Detection("python", None, 0.4, ["python syntax with errors"] + loose)
+    return Detection(UNKNOWN, None, 0.0)
+
+def detect(code: str) -> Detection:
+    """
+    Detect the language of source code and the oldest version it needs. Python is parsed
+    with `ast` (falling back to Python 2 syntax checks), Java is lexed without comments
+    and strings and scored on declarations and version-specific features.
+    Results are memoized by content hash.
+
+    Args:
+        code (str): The source code.
+
+    Returns:
+        Detection: Language ("python", "java" or "unknown"), minimum version, confidence and the features found.
+    """
+    key = make_key(code)
+    detection = cache.get(key)
+    if detection is None:
+        detection = _detect(code)
+        cache.set(key, detection)
+    return detection
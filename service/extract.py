@@ -0,0 +1,123 @@
+import io
+import os
+import tokenize
+from typing import Callable, List, Optional, Tuple
+
+EXTENSIONS = {
+    ".py": "python",
+    ".pyw": "python",
+    ".java": "java",
+}
+
+def language_of(filename: Optional[str]) -> Optional[str]:
+    """
+    Language of a source file by its extension, None if the extractor does not support it.
+    """
+    return EXTENSIONS.get(os.path.splitext(filename or "")[1].lower())
+
+# (start, end) offsets of a comment in the source
+Span = Tuple[int, int]
+
+def _python_comments(code: str) -> List[Span]:
+    # Rows as tokenize sees them, str.splitlines also breaks on form feeds and other separators
+    line_offsets = [0]
+    for line in io.StringIO(code).readlines():
+        line_offsets.append(line_offsets[-1] + len(line))
+    spans = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(code).readline):
+            if token.type == tokenize.COMMENT:
+                (start_row, start_col), (end_row, end_col) = token.start, token.end
+                spans.append((line_offsets[start_row - 1] + start_col, line_offsets[end_row - 1] + end_col))
+    except (tokenize.TokenError, IndentationError, SyntaxError) as e:
+        raise ValueError(f"Cannot tokenize Python source: {e}")
+    return spans
+
+def _java_comments(code: str) -> List[Span]:
+    spans = []
+    i = 0
+    n = len(code)
+    while i < n:
+        c = code[i]
+        if code.startswith('"""', i):
+            # Text block, ends at the next unescaped """
+            end = i + 3
+            while end < n and not code.startswith('"""', end):
+                end += 2 if code[end] == "\\" else 1
+            if end >= n:
+                raise ValueError("Unterminated text block in Java source")
+            i = end + 3
+        elif c in "\"'":
+            end = i + 1
+            while end < n and code[end] != c:
+                if code[end] == "\n":
+                    raise ValueError("Unterminated literal in Java source")
+                end += 2 if code[end] == "\\" else 1
+            if end >= n:
+                raise ValueError("Unterminated literal in Java source")
+            i = end + 1
+        elif code.startswith("//", i):
+            end = code.find("\n", i)
+            end = n if end == -1 else end
+            spans.append((i, end))
+            i = end
+        elif code.startswith("/*", i):
+            end = code.find("*/", i + 2)
+            if end == -1:
+                raise ValueError("Unterminated block comment in Java source")
+            spans.append((i, end + 2))
+            i = end + 2
+        else:
+            i += 1
+    return spans
+
+def strip_comments(code: str, language: str, keep: Optional[Callable[[str], bool]] = None) -> str:
+    """
+    Remove comments from source code without changing anything else. Strings that look
+    like comments are kept, lines that only held a comment are dropped.
+
+    Args:
+        code (str): The source code.
+        language (str): "python" or "java".
+        keep (Optional[Callable[[str], bool]]): Comments for which this returns True are kept.
+
+    Returns:
+        str: The code without comments.
+
+    Raises:
+        ValueError: If the language is not supported or the source cannot be lexed.
+    """
+    if language == "python":
+        spans = _python_comments(code)
+    elif language == "java":
+        spans = _java_comments(code)
+    else:
+        raise ValueError(f"No comment stripper for language: {language}")
+
+    if keep is not None:
+        spans = [(start, end) for start, end in spans if not keep(code[start:end])]
+    pieces = []
+    last = 0
+    for start, end in spans:
+        pieces.append(code[last:start])
+        # Keep the line breaks of block comments so lines stay aligned with the original
+        pieces.append("\n" * code.count("\n", start, end))
+        last = end
+    pieces.append(code[last:])
+    stripped = "".join(pieces)
+
+    lines = []
+    for original, line in zip(code.split("\n"), stripped.split("\n")):
+        if line.strip() or not original.strip():
+            lines.append(line.rstrip())
+    return "\n".join(lines).strip("\n") + "\n"
+
+def shrink(code: str, language: Optional[str] = None, filename: Optional[str] = None, keep: Optional[Callable[[str], bool]] = None) -> str:
+    """
+    Strip comments to shrink an LLM prompt, returning the code unchanged when it cannot be done locally.
+    """
+    language = language or language_of(filename)
+    try:
+        return strip_comments(code, language, keep)
+    except ValueError:
+        return code
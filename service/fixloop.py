@@ -0,0 +1,260 @@
+import re
+import json
+from typing import Dict, List, Optional
+
+from config import Config
+from utils.cache import make_key
+from utils.llm.openai import OpenAIChat
+from utils import tracing
+
+FIX_DEV_PROMPT = (
+    "You fix code that failed when it was run in a Docker container.\n"
+    "The user gives the original request, your previous answers and the errors they produced.\n"
+    "Earlier answers that were superseded are omitted; only your latest answer is shown in full.\n"
+    "Please provide the following in response to the user's request:\n"
+    "1. The executable code remove all comments(Be aware of the infinite loop and memory leak)\n"
+    "2. The programming language of the code in all lowercase letters\n"
+    "3. Find the name of the Docker image in Docker Hub that can run the code you return, with the version if specified by the user's prompt or comments in code I provided"
+    "(otherwise, use the latest executable version available).\n"
+    "4. The public class name of Java code,If the code language you return is python just return the word : output\n"
+    "The format of the response should only be json and inluding(code, language, docker_image,class_name)"
+)
+OMITTED = "(superseded answer omitted)"
+
+_PY_FRAME = re.compile(r'^\s*File "([^"]+)", line \d+')
+_PY_LIBRARY = re.compile(r"/lib/python[\d.]*/|site-packages|<frozen ")
+_JAVAC_ERROR = re.compile(r"^\S+\.java:\d+: (error|warning):")
+_JAVA_LIBRARY_FRAME = re.compile(r"^\s*at (?:java|javax|jdk|sun|com\.sun)\.")
+# Last line of the output of a run the sandbox ended, see sandbox.RunResult.outcome
+_OUTCOME = re.compile(r"^(?:Cancelled, the sandbox was killed\.|Timed out after \S+, the sandbox was killed\.|Killed \(exit code \d+\), .*|Exited with code -?\d+\.)$")
+
+def _collapse_repeats(lines: List[str]) -> List[str]:
+    collapsed = []
+    repeats = 0
+    for line in lines:
+        if collapsed and line == collapsed[-1]:
+            repeats += 1
+            continue
+        if repeats:
+            collapsed.append(f"[previous line repeated {repeats} more times]")
+            repeats = 0
+        collapsed.append(line)
+    if repeats:
+        collapsed.append(f"[previous line repeated {repeats} more times]")
+    return collapsed
+
+def _compact_python(lines: List[str]) -> Optional[List[str]]:
+    starts = [i for i, line in enumerate(lines) if line.startswith("Traceback (most recent call last)")]
+    if not starts:
+        return None
+    block = lines[starts[-1]:]
+    frames: List[List[str]] = []
+    tail: List[str] = []
+    for line in block[1:]:
+        if _PY_FRAME.match(line):
+            frames.append([line])
+        elif line.startswith((" ", "\t")) and frames and not tail:
+            frames[-1].append(line)
+        else:
+            tail.append(line)
+    # Frames in the user's code explain the error, library internals rarely do
+    kept = [frame for frame in frames[:-1] if not _PY_LIBRARY.search(frame[0])] + frames[-1:]
+    compacted = [block[0]]
+    if len(kept) < len(frames):
+        compacted.append(f"  [{len(frames) - len(kept)} library frames omitted]")
+    for frame in kept:
+        compacted.extend(frame[:2])
+    return compacted + tail
+
+def _compact_javac(lines: List[str]) -> Optional[List[str]]:
+    if not any(_JAVAC_ERROR.match(line) for line in lines):
+        return None
+    compacted = []
+    seen = set()
+    keep = 0
+    for line in lines:
+        match = _JAVAC_ERROR.match(line)
+        if match:
+            message = line.split(":", 2)[-1].strip()
+            keep = 0 if match.group(1) == "warning" or message in seen else 5
+            seen.add(message)
+            if keep:
+                compacted.append(line)
+                keep -= 1
+        elif keep:
+            compacted.append(line)
+            keep -= 1
+        elif re.match(r"^\d+ errors?$", line.strip()):
+            compacted.append(line)
+    return compacted
+
+def _compact_java_runtime(lines: List[str]) -> Optional[List[str]]:
+    start = next((i for i, line in enumerate(lines) if line.startswith("Exception in thread")), None)
+    if start is None:
+        return None
+    compacted = [lines[start]]
+    frames = 0
+    for line in lines[start + 1:]:
+        if line.lstrip().startswith("Caused by:"):
+            compacted.append(line)
+            frames = 0
+        elif line.lstrip().startswith("at ") and not _JAVA_LIBRARY_FRAME.match(line) and frames < 5:
+            compacted.append(line)
+            frames += 1
+    return compacted
+
+def _truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    return f"{text[:head]}\n[... {len(text) - max_chars} characters omitted ...]\n{text[-tail:]}"
+
+def compact_error(language: str, output: str, max_tokens: Optional[int] = None) -> str:
+    """
+    Reduce a traceback or compiler output to the lines that help fixing the code:
+    frames in the user's code, the exception, and each distinct javac error.
+
+    Args:
+        language (str): Language of the code that produced the output.
+        output (str): Raw stderr/stdout of the run.
+        max_tokens (Optional[int]): Budget for the result, defaults to Config.FIX_ERROR_TOKENS.
+
+    Returns:
+        str: The compacted error, at most roughly `max_tokens` tokens long.
+    """
+    max_tokens = max_tokens or Config.FIX_ERROR_TOKENS
+    lines = (output or "").rstrip().splitlines()
+    # The compactors only keep what they recognize, the outcome is put back after them
+    outcome = lines[-1:] if lines and _OUTCOME.match(lines[-1]) else []
+    lines = lines[:len(lines) - len(outcome)]
+    if language == "java":
+        compacted = _compact_javac(lines) or _compact_java_runtime(lines)
+    else:
+        compacted = _compact_python(lines)
+    text = "\n".join(_collapse_repeats(compacted if compacted is not None else lines) + outcome)
+    # Roughly four characters per token
+    return _truncate(text, max_tokens * 4)
+
+def fingerprint(language: str, output: str) -> str:
+    """
+    Identify an error independently of line numbers, addresses and file paths, so the
+    same failure is recognized after the code around it changed.
+    """
+    lines = compact_error(language, output).splitlines()
+    if language == "java" and any(_JAVAC_ERROR.match(line) for line in lines):
+        key = sorted({line.split(":", 2)[-1].strip() for line in lines if _JAVAC_ERROR.match(line)})
+    else:
+        key = [line for line in lines if line.strip() and not line.startswith((" ", "\t", "["))][-1:]
+    normalized = re.sub(r"0x[0-9a-fA-F]+|\d+", "N", "\n".join(key))
+    return make_key(language, normalized)
+
+def _parse_answer(response_json: str) -> dict:
+    try:
+        answer = json.loads(response_json)
+    except ValueError:
+        return {"code": response_json}
+    return answer if isinstance(answer, dict) else {"code": response_json}
+
+class FixSession:
+    def __init__(self, usr_prompt: str, language: str = "python"):
+        """
+        Multi-turn repair conversation for one line of candidates. Each round only sends the
+        latest answer in full plus the compacted errors, and the loop stops once it stops
+        making progress.
+
+        Args:
+            usr_prompt (str): The user's original request.
+            language (str): Language of the code being fixed, used to compact errors.
+        """
+        self.usr_prompt = usr_prompt
+        self.language = language
+        self.turns: List[Dict[str, str]] = []
+        self.iteration = 0
+        self.stop_reason: Optional[str] = None
+        self._codes = set()
+        self._errors = set()
+
+    def fork(self) -> "FixSession":
+        session = FixSession(self.usr_prompt, self.language)
+        session.turns = list(self.turns)
+        session.iteration = self.iteration
+        session._codes = set(self._codes)
+        session._errors = set(self._errors)
+        return session
+
+    def new_code(self, response_json: str) -> bool:
+        """
+        Record an answer before running it.
+
+        Returns:
+            bool: False when the answer repeats code that was already tried.
+        """
+        answer = _parse_answer(response_json)
+        # The answer may be in another language than the source, e.g. for conversions
+        self.language = answer.get("language") or self.language
+        code_key = make_key("\n".join(line.rstrip() for line in (answer.get("code") or "").strip().splitlines()))
+        if code_key in self._codes:
+            self.stop_reason = "the fix returned code that was already tried"
+            return False
+        self._codes.add(code_key)
+        return True
+
+    def new_error(self, result: str, status: int) -> bool:
+        """
+        Record the outcome of a run.
+
+        Returns:
+            bool: False when the run failed with an error that was already seen.
+        """
+        if status == 0:
+            return True
+        error_key = fingerprint(self.language, result)
+        if error_key in self._errors:
+            self.stop_reason = "the same error repeated after a fix"
+            return False
+        self._errors.add(error_key)
+        return True
+
+    def messages(self) -> List[Dict[str, str]]:
+        history = [{"role": "user", "content": f"Request: {self.usr_prompt}"}]
+        for i, turn in enumerate(self.turns):
+            latest = i == len(self.turns) - 1
+            history.append({"role": "assistant", "content": turn["answer"] if latest else OMITTED})
+            history.append({"role": "user", "content": f"Running it failed with exit code {turn['status']}:\n{turn['error']}"})
+        return history
+
+    def fix(self, response_json: str, result: str, status: int = 1) -> str:
+        """
+        Ask for a fixed version of the latest answer.
+
+        Returns:
+            str: The new response JSON.
+        """
+        self.turns.append({"answer": response_json, "error": compact_error(self.language, result), "status": str(status)})
+        self.iteration += 1
+        history = self.messages()
+        with tracing.span("fix", iteration=self.iteration):
+            response_text = OpenAIChat.chat(FIX_DEV_PROMPT, history[-1]["content"], history=history[:-1], site="fix_code_with_llm")
+        return re.sub(r"```(?:\w+)?\n?", "", response_text).strip("`")
+
+def usage_report(root: Optional[tracing.Span]) -> List[dict]:
+    """
+    Token usage of each generate/fix iteration below `root`, taken from the LLM spans.
+    """
+    report = []
+    if root is None:
+        return report
+    for s in root.walk():
+        if s.name not in ("generate", "fix"):
+            continue
+        calls = [c for c in s.walk() if c.name.startswith("llm:")]
+        report.append({
+            "stage": s.name,
+            "iteration": s.attributes.get("iteration", 0),
+            "prompt_tokens": sum(int(c.attributes.get("prompt_tokens", 0)) for c in calls),
+            "cached_tokens": sum(int(c.attributes.get("cached_tokens", 0)) for c in calls),
+            "completion_tokens": sum(int(c.attributes.get("completion_tokens", 0)) for c in calls),
+            "estimated": any(c.attributes.get("usage_estimated") for c in calls),
+        })
+    return report
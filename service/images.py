@@ -0,0 +1,227 @@
+import re
+import sys
+import json
+import time
+import threading
+import subprocess
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from config import Config
+from utils import tracing
+from service import sandbox
+
+# Pinned runtime images per language and version, kept on every node
+CATALOG: Dict[str, Dict[str, str]] = {
+    "python": {
+        "2.7": "python:2.7.18-slim",
+        "3.6": "python:3.6.15-slim",
+        "3.7": "python:3.7.17-slim",
+        "3.8": "python:3.8.20-slim",
+        "3.9": "python:3.9.20-slim",
+        "3.10": "python:3.10.15-slim",
+        "3.11": "python:3.11.10-slim",
+        "3.12": "python:3.12.7-slim",
+        "3.13": "python:3.13.0-slim",
+    },
+    "java": {
+        "8": "eclipse-temurin:8u432-b06-jdk",
+        "11": "eclipse-temurin:11.0.25_9-jdk",
+        "17": "eclipse-temurin:17.0.13_11-jdk",
+        "21": "eclipse-temurin:21.0.5_11-jdk",
+    },
+}
+if Config.IMAGE_CATALOG:
+    for _language, _versions in json.loads(Config.IMAGE_CATALOG).items():
+        CATALOG.setdefault(_language, {}).update(_versions)
+
+LATEST = {"python": "3.12", "java": "21"}
+MAJOR_DEFAULTS = {"python": {"2": "2.7", "3": LATEST["python"]}}
+
+_IMAGE_NAMES = {
+    "python": {"python", "library/python"},
+    "java": {"openjdk", "library/openjdk", "eclipse-temurin", "amazoncorretto", "adoptopenjdk", "java"},
+}
+
+def catalog_image(language: str, version: Optional[str] = None) -> Optional[str]:
+    """
+    Look up the pinned image for a language and version.
+
+    Args:
+        language (str): Programming language in lowercase letters.
+        version (Optional[str]): Version such as "3.10", "2" or "17", None picks the latest.
+
+    Returns:
+        Optional[str]: The pinned image, or None if the catalog has no match.
+    """
+    versions = CATALOG.get(language)
+    if not versions:
+        return None
+    if not version:
+        return versions.get(LATEST.get(language, ""))
+    if version in versions:
+        return versions[version]
+    major_default = MAJOR_DEFAULTS.get(language, {}).get(version)
+    if major_default:
+        return versions.get(major_default)
+    major_minor = ".".join(version.split(".")[:2])
+    if major_minor in versions:
+        return versions[major_minor]
+    major = version.split(".")[0]
+    if language == "java" and major == "1" and len(version.split(".")) > 1:
+        # Legacy "1.8" style Java versions
+        major = version.split(".")[1]
+    return versions.get(major)
+
+def resolve(language: str, image: str) -> str:
+    """
+    Map an LLM-suggested image onto the pinned catalog when it names a known runtime.
+
+    Returns:
+        str: The pinned catalog image, or the suggested image if it is outside the catalog.
+    """
+    name, _, tag = image.partition(":")
+    if name.startswith("docker.io/"):
+        name = name[len("docker.io/"):]
+    if name not in _IMAGE_NAMES.get(language, set()):
+        return image
+    match = re.match(r"(\d+(?:\.\d+)?)", tag)
+    if tag and tag != "latest" and not match:
+        return image
+    return catalog_image(language, match.group(1) if match else None) or image
+
+def is_pinned(image: str) -> bool:
+    return any(image in versions.values() for versions in CATALOG.values())
+
+# Seconds before removing an image that docker refused to remove is tried again
+RMI_RETRY_SECONDS = 60
+
+def _docker(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(["docker", *args], capture_output=True, text=True)
+
+def image_size(image: str) -> int:
+    result = _docker("image", "inspect", "--format", "{{.Size}}", image)
+    try:
+        return int(result.stdout.strip())
+    except ValueError:
+        return 0
+
+def ensure(image: str):
+    """
+    Pull an image unless it is already present, so a cold run started with `--pull never`
+    does not spend its sandbox timeout on the download.
+
+    Raises:
+        RuntimeError: If the image is missing and cannot be pulled within SANDBOX_PULL_TIMEOUT.
+    """
+    if _docker("image", "inspect", "--format", "{{.Id}}", image).returncode == 0:
+        return
+    print(f'[images.py] Pulling {image}', file=sys.stderr)
+    with tracing.span("image_pull", image=image):
+        try:
+            result = subprocess.run(
+                ["docker", "pull", "--quiet", image], capture_output=True, text=True, timeout=Config.SANDBOX_PULL_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f"Timed out pulling {image} after {Config.SANDBOX_PULL_TIMEOUT:g}s")
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to pull {image}: {result.stderr.strip()}")
+
+class ImageStore:
+    def __init__(self, budget_bytes: int):
+        """
+        LRU store for runtime images outside the catalog. Images are reference counted while
+        requests use them and only unreferenced images are removed to stay within the disk budget.
+
+        Args:
+            budget_bytes (int): Disk budget for non-catalog images.
+        """
+        self.budget_bytes = budget_bytes
+        self._entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    @contextmanager
+    def use(self, image: str):
+        """
+        Hold a reference to an image for the duration of the block.
+        """
+        if is_pinned(image):
+            yield image
+            return
+        with self._lock:
+            entry = self._entries.setdefault(image, {"refs": 0, "size": 0, "last_used": 0.0, "retry_at": 0.0})
+            entry["refs"] += 1
+            entry["last_used"] = time.time()
+        try:
+            yield image
+        finally:
+            # Image sizes do not change, so the image is inspected once it has been pulled
+            size = entry["size"] or image_size(image)
+            with self._lock:
+                entry["refs"] -= 1
+                entry["size"] = size
+                entry["last_used"] = time.time()
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": sum(entry["size"] for entry in self._entries.values()),
+                "images": len(self._entries),
+                "in_use": sum(1 for entry in self._entries.values() if entry["refs"] > 0),
+                "evictions": self.evictions,
+            }
+
+    def _evict(self):
+        while True:
+            now = time.time()
+            with self._lock:
+                used = sum(entry["size"] for entry in self._entries.values())
+                idle = [
+                    (entry["last_used"], image) for image, entry in self._entries.items()
+                    if entry["refs"] == 0 and entry["retry_at"] <= now
+                ]
+                if used <= self.budget_bytes or not idle:
+                    return
+                _, image = min(idle)
+                entry = self._entries[image]
+                # Keeps other threads from picking the same image while it is removed
+                entry["retry_at"] = now + RMI_RETRY_SECONDS
+            print(f'[images.py] Evicting {image}', file=sys.stderr)
+            sandbox.pool.drop_image(image)
+            result = _docker("rmi", image)
+            with self._lock:
+                if result.returncode == 0 or "No such image" in result.stderr:
+                    if entry["refs"] == 0:
+                        self._entries.pop(image, None)
+                    else:
+                        # Taken again while it was removed, the next run pulls it back
+                        entry["size"] = 0
+                    entry["retry_at"] = 0.0
+                    self.evictions += 1
+                    continue
+            # Still counted against the budget and retried once retry_at has passed
+            print(f'[images.py] Failed to remove {image}: {result.stderr.strip()}', file=sys.stderr)
+
+store = ImageStore(budget_bytes=Config.IMAGE_STORE_BUDGET_MB * 1024 * 1024)
+
+def prepull():
+    """
+    Pull the configured catalog images and warm the sandbox pool for them in the background.
+    """
+    def _pull():
+        for entry in filter(None, (e.strip() for e in Config.IMAGE_PREPULL.split(","))):
+            language, _, version = entry.partition(":")
+            image = catalog_image(language, version or None)
+            if image is None:
+                print(f'[images.py] No catalog image for {entry}', file=sys.stderr)
+                continue
+            result = _docker("pull", "--quiet", image)
+            if result.returncode != 0:
+                print(f'[images.py] Failed to pull {image}: {result.stderr.strip()}', file=sys.stderr)
+                continue
+            sandbox.pool.prewarm(language, image)
+
+    threading.Thread(target=_pull, daemon=True).start()
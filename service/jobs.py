@@ -0,0 +1,425 @@
+import sys
+import math
+import time
+import uuid
+import queue
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from service import progress
+from service.progress import ProgressStream
+from utils import metrics
+from utils import tracing
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+DEFAULT_LANE = "default"
+# Longest wait before a batch call that was not admitted is offered again
+ADMISSION_RETRY_SECONDS = 1.0
+
+@dataclass
+class Job:
+    id: str
+    status: str = QUEUED
+    result: Optional[Any] = None
+    error: Optional[str] = None
+    exception: Optional[BaseException] = field(default=None, repr=False)
+    created_at: float = field(default_factory=time.time)
+    # When the job last entered a lane's queue, and its total time spent waiting in queues
+    queued_at: Optional[float] = None
+    queue_seconds: float = 0.0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    progress: ProgressStream = field(default_factory=ProgressStream, repr=False)
+    trace: Optional[tracing.Span] = field(default=None, repr=False)
+    lane: str = DEFAULT_LANE
+    client: Optional[str] = None
+    # Stages timed outside the job's trace, e.g. work done before it was queued
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Called with the job once it has finished
+    on_done: Optional[Callable[["Job"], None]] = field(default=None, repr=False)
+    _done: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    def __post_init__(self):
+        if self.queued_at is None:
+            self.queued_at = self.created_at
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until the job has finished.
+
+        Args:
+            timeout (Optional[float]): Maximum seconds to wait, None waits forever.
+
+        Returns:
+            bool: True if the job finished within the timeout.
+        """
+        return self._done.wait(timeout)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "lane": self.lane,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+@dataclass
+class Handoff:
+    """
+    Returned by a job function to run the rest of the job as `fn(*args)` in another lane.
+    The job keeps its id, dedup key and client slot, and waits in the new lane's queue.
+    """
+    lane: str
+    fn: Callable[..., Any]
+    args: tuple = ()
+
+class AdmissionRejected(RuntimeError):
+    def __init__(self, message: str, retry_after: int):
+        """
+        A job was not accepted because its lane is full or its client has too many jobs in flight.
+
+        Args:
+            message (str): Why the job was rejected.
+            retry_after (int): Seconds after which a retry is likely to be accepted.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+@dataclass
+class Lane:
+    name: str
+    workers: int
+    # Jobs allowed to wait for a worker, 0 for no limit
+    max_queue: int
+    executor: ThreadPoolExecutor = field(repr=False)
+    queued: int = 0
+    running: int = 0
+    rejected: int = 0
+    # Moving average of the run time, used to estimate Retry-After
+    avg_seconds: float = 5.0
+
+    def retry_after(self, position: int) -> int:
+        return min(max(math.ceil(self.avg_seconds * position / max(self.workers, 1)), 1), 300)
+
+class JobManager:
+    def __init__(
+        self,
+        max_workers: int,
+        result_ttl: float,
+        dedup_ttl: float = 0,
+        max_queue: int = 0,
+        lane_workers: Optional[Dict[str, int]] = None,
+        lane_queue: Optional[Dict[str, int]] = None,
+        client_limit: int = 0,
+    ):
+        """
+        Run jobs on bounded worker pools and keep their results around for polling.
+        Jobs are split into lanes, each with its own workers and queue, so a burst of slow
+        jobs in one lane does not hold up the others. A full lane rejects new jobs instead
+        of queueing them without bound.
+
+        Args:
+            max_workers (int): Workers of a lane that has no entry in `lane_workers`.
+            result_ttl (float): Seconds a finished job is kept before it is forgotten.
+            dedup_ttl (float): Seconds a succeeded job still answers submissions with the same dedup key.
+            max_queue (int): Queued jobs of a lane that has no entry in `lane_queue`, 0 for no limit.
+            lane_workers (Optional[Dict[str, int]]): Workers per lane name.
+            lane_queue (Optional[Dict[str, int]]): Queued jobs allowed per lane name.
+            client_limit (int): Jobs one client may have queued or running at a time, 0 for no limit.
+        """
+        self.max_workers = max_workers
+        self.result_ttl = result_ttl
+        self.dedup_ttl = dedup_ttl
+        self.max_queue = max_queue
+        self.lane_workers = lane_workers or {}
+        self.lane_queue = lane_queue or {}
+        self.client_limit = client_limit
+        self._lanes: Dict[str, Lane] = {}
+        self._clients: Dict[str, int] = {}
+        self._jobs: Dict[str, Job] = {}
+        self._by_key: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def attach(self, dedup_key: Optional[str]) -> Optional[Job]:
+        """
+        The job that answers `dedup_key`: one with the same key that is still running or
+        succeeded less than dedup_ttl seconds ago. None if there is no such job.
+        """
+        if dedup_key is None:
+            return None
+        with self._lock:
+            self._prune()
+            return self._attach(dedup_key)
+
+    def admit(self, lane: Optional[str] = None, client: Optional[str] = None):
+        """
+        Check that a job for `client` would be accepted on `lane` right now, before doing
+        any work to prepare it. Without a lane only the client's limit is checked.
+
+        Raises:
+            AdmissionRejected: If the lane's queue is full or the client is at its limit.
+        """
+        with self._lock:
+            self._admit(self._lane(lane or DEFAULT_LANE), client, bounded=lane is not None)
+
+    def submit(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        dedup_key: Optional[str] = None,
+        lane: str = DEFAULT_LANE,
+        client: Optional[str] = None,
+        on_done: Optional[Callable[[Job], None]] = None,
+        **kwargs
+    ) -> Job:
+        """
+        Queue `fn(*args, **kwargs)` on the workers of a lane.
+
+        Args:
+            dedup_key (Optional[str]): Identifies the work. While a job with the same key runs,
+                or for dedup_ttl seconds after it succeeded, that job is returned instead of
+                starting another one.
+            lane (str): Lane the job runs in.
+            client (Optional[str]): Client the job is counted against.
+            on_done (Optional[Callable[[Job], None]]): Called with the job once it has finished,
+                not set on a job that is returned for the dedup key.
+
+        Returns:
+            Job: The job handle, returned before the function starts running.
+
+        Raises:
+            AdmissionRejected: If the lane's queue is full or the client is at its limit.
+        """
+        with self._lock:
+            self._prune()
+            existing = self._attach(dedup_key) if dedup_key is not None else None
+            if existing is not None:
+                return existing
+            target = self._lane(lane)
+            self._admit(target, client)
+            job = Job(id=str(uuid.uuid4()), lane=target.name, client=client, on_done=on_done)
+            job.progress.emit(QUEUED, job_id=job.id, lane=target.name)
+            self._jobs[job.id] = job
+            if dedup_key is not None:
+                self._by_key[dedup_key] = job
+            target.queued += 1
+            if client is not None:
+                self._clients[client] = self._clients.get(client, 0) + 1
+            metrics.JOB_QUEUE_DEPTH.labels(lane=target.name).set(target.queued)
+        target.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def submit_many(
+        self,
+        calls: List[Tuple[Callable[..., Any], tuple, str]],
+        concurrency: Optional[int] = None,
+        client: Optional[str] = None,
+    ) -> Iterator[Tuple[int, Job]]:
+        """
+        Run `fn(*args)` in its lane for every (fn, args, lane) call with at most `concurrency`
+        of them queued or running at a time, so one large batch does not take over the worker
+        pools. Every call is counted against `client` and held to its lane's queue limit like a
+        single job; a call that is not admitted waits until the batch's own calls or other jobs
+        make room.
+
+        Args:
+            calls (List[Tuple[Callable[..., Any], tuple, str]]): Function, positional arguments and lane of each call.
+            concurrency (Optional[int]): Calls in flight at a time, defaults to max_workers.
+            client (Optional[str]): Client the calls are counted against.
+
+        Yields:
+            Tuple[int, Job]: Index of the call and its finished job, in completion order.
+            Calls not submitted yet when the caller stops iterating are dropped.
+        """
+        concurrency = concurrency or self.max_workers
+        finished: "queue.Queue[Job]" = queue.Queue()
+
+        # Index of each submitted call by job id
+        submitted: Dict[str, int] = {}
+        for done in range(len(calls)):
+            while len(submitted) < len(calls) and len(submitted) - done < concurrency:
+                fn, args, lane = calls[len(submitted)]
+                try:
+                    job = self.submit(fn, *args, lane=lane, client=client, on_done=finished.put)
+                except AdmissionRejected as e:
+                    if len(submitted) > done:
+                        # Retried once one of the batch's own calls has finished
+                        break
+                    time.sleep(min(e.retry_after, ADMISSION_RETRY_SECONDS))
+                    continue
+                submitted[job.id] = len(submitted)
+            job = finished.get()
+            yield submitted[job.id], job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            lanes = {
+                name: {
+                    "workers": lane.workers,
+                    "max_queue": lane.max_queue,
+                    "queued": lane.queued,
+                    "running": lane.running,
+                    "rejected": lane.rejected,
+                    "avg_seconds": round(lane.avg_seconds, 3),
+                }
+                for name, lane in self._lanes.items()
+            }
+            clients = len(self._clients)
+        return {
+            "max_workers": self.max_workers,
+            **counts,
+            "coalesced": self.coalesced,
+            "client_limit": self.client_limit,
+            "clients_in_flight": clients,
+            "lanes": lanes,
+        }
+
+    def _lane(self, name: str) -> Lane:
+        # Caller holds the lock
+        lane = self._lanes.get(name)
+        if lane is None:
+            workers = self.lane_workers.get(name, self.max_workers)
+            lane = Lane(
+                name=name,
+                workers=workers,
+                max_queue=self.lane_queue.get(name, self.max_queue),
+                executor=ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"job-{name}"),
+            )
+            self._lanes[name] = lane
+        return lane
+
+    def _attach(self, dedup_key: str) -> Optional[Job]:
+        # Caller holds the lock and has pruned stale keys
+        existing = self._by_key.get(dedup_key)
+        if existing is not None:
+            self.coalesced += 1
+            metrics.JOBS_COALESCED.labels(state="finished" if existing.done else "running").inc()
+            print(f'[jobs.py] Attached duplicate request to job {existing.id}', file=sys.stderr)
+        return existing
+
+    def _admit(self, lane: Lane, client: Optional[str], bounded: bool = True):
+        # Caller holds the lock
+        if bounded and lane.max_queue and lane.queued >= lane.max_queue:
+            lane.rejected += 1
+            metrics.JOBS_REJECTED.labels(lane=lane.name, reason="queue_full").inc()
+            raise AdmissionRejected(
+                f"The {lane.name} queue is full ({lane.queued} waiting), please retry later",
+                lane.retry_after(lane.queued + 1),
+            )
+        if client is not None and self.client_limit and self._clients.get(client, 0) >= self.client_limit:
+            lane.rejected += 1
+            metrics.JOBS_REJECTED.labels(lane=lane.name, reason="client_limit").inc()
+            raise AdmissionRejected(
+                f"Too many requests in flight for this client (limit {self.client_limit}), please retry later",
+                lane.retry_after(1),
+            )
+
+    def _run(self, job: Job, fn: Callable[..., Any], args: tuple, kwargs: dict):
+        lane = self._lanes[job.lane]
+        now = time.time()
+        job.status = RUNNING
+        job.started_at = job.started_at or now
+        job.queue_seconds += now - job.queued_at
+        with self._lock:
+            lane.queued -= 1
+            lane.running += 1
+            metrics.JOB_QUEUE_DEPTH.labels(lane=lane.name).set(lane.queued)
+        metrics.JOB_QUEUE_WAIT_SECONDS.labels(lane=lane.name).observe(now - job.queued_at)
+        handed_off = False
+        try:
+            with progress.bind(job.progress), tracing.trace(getattr(fn, "__name__", "job"), job_id=job.id) as root:
+                job.trace = root
+                progress.emit(RUNNING, job_id=job.id, lane=lane.name)
+                result = fn(*args, **kwargs)
+            if isinstance(result, Handoff):
+                job.timings[getattr(fn, "__name__", "job")] = time.time() - now
+                self._handoff(job, lane, now, result)
+                handed_off = True
+                return
+            job.result = result
+            job.status = SUCCEEDED
+        except Exception as e:
+            print(f'[jobs.py] Job {job.id} failed:', e, file=sys.stderr)
+            job.exception = e
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            if not handed_off:
+                self._finish(job, lane, now)
+
+    def _finish(self, job: Job, lane: Lane, started: float):
+        job.finished_at = time.time()
+        with self._lock:
+            self._leave(lane, started, job.finished_at)
+            if job.client is not None:
+                remaining = self._clients.get(job.client, 1) - 1
+                if remaining > 0:
+                    self._clients[job.client] = remaining
+                else:
+                    self._clients.pop(job.client, None)
+        job.progress.emit("done", job_id=job.id, status=job.status, error=job.error)
+        job.progress.close()
+        job._done.set()
+        if job.on_done is not None:
+            job.on_done(job)
+
+    def _handoff(self, job: Job, lane: Lane, started: float, handoff: Handoff):
+        """
+        Queue the rest of a job in the lane it was handed off to. The new lane's queue limit
+        applies, a job that does not fit fails with the rejection as its error.
+        """
+        with self._lock:
+            target = self._lane(handoff.lane)
+            # The job already holds its client slot, only the queue limit is checked
+            self._admit(target, None)
+            self._leave(lane, started, time.time())
+            job.lane = target.name
+            job.status = QUEUED
+            job.queued_at = time.time()
+            target.queued += 1
+            metrics.JOB_QUEUE_DEPTH.labels(lane=target.name).set(target.queued)
+        job.progress.emit(QUEUED, job_id=job.id, lane=target.name)
+        target.executor.submit(self._run, job, handoff.fn, handoff.args, {})
+
+    def _leave(self, lane: Lane, started: float, finished: float):
+        # Caller holds the lock
+        lane.running -= 1
+        lane.avg_seconds = 0.8 * lane.avg_seconds + 0.2 * (finished - started)
+
+    def _prune(self):
+        # Caller holds the lock
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.result_ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        # Failed jobs are forgotten right away so a retry runs again
+        stale = [
+            key for key, job in self._by_key.items()
+            if job.done and (job.status != SUCCEEDED or now - job.finished_at > self.dedup_ttl)
+        ]
+        for key in stale:
+            del self._by_key[key]
@@ -0,0 +1,100 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+@dataclass
+class Event:
+    id: int
+    stage: str
+    message: str = ""
+    data: dict = field(default_factory=dict)
+    time: float = field(default_factory=time.time)
+
+    def to_sse(self) -> str:
+        payload = json.dumps({"stage": self.stage, "message": self.message, "time": self.time, **self.data}, ensure_ascii=False)
+        return f"id: {self.id}\nevent: {self.stage}\ndata: {payload}\n\n"
+
+class ProgressStream:
+    def __init__(self):
+        """
+        Append-only list of stage events that readers can follow while it grows.
+        """
+        self._events: List[Event] = []
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def emit(self, stage: str, message: str = "", **data) -> Event:
+        with self._cond:
+            event = Event(id=len(self._events) + 1, stage=stage, message=message, data=data)
+            self._events.append(event)
+            self._cond.notify_all()
+        return event
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def follow(self, after: int = 0, heartbeat: float = 15.0) -> Iterator[Optional[Event]]:
+        """
+        Yield events with an id greater than `after` as they are emitted, until the stream is closed.
+
+        Args:
+            after (int): Id of the last event the reader has already seen.
+            heartbeat (float): Seconds without events after which None is yielded as a keep-alive.
+
+        Yields:
+            Optional[Event]: The next event, or None on a heartbeat.
+        """
+        position = after
+        while True:
+            with self._cond:
+                if position >= len(self._events) and not self.closed:
+                    self._cond.wait(heartbeat)
+                pending = self._events[position:]
+                closed = self.closed
+            if pending:
+                for event in pending:
+                    yield event
+                position += len(pending)
+            elif closed:
+                return
+            else:
+                yield None
+
+_current: ContextVar[Optional[ProgressStream]] = ContextVar("progress", default=None)
+
+@contextmanager
+def bind(stream: ProgressStream):
+    """
+    Make `stream` the target of `emit` for the current thread or context.
+    """
+    token = _current.set(stream)
+    try:
+        yield stream
+    finally:
+        _current.reset(token)
+
+def emit(stage: str, message: str = "", **data):
+    """
+    Emit a stage event to the stream bound to the current context, if any.
+    """
+    stream = _current.get()
+    if stream is not None:
+        stream.emit(stage, message, **data)
+
+class ProgressLog(list):
+    """
+    Log list that also emits every appended line as a progress event.
+    """
+    def __init__(self, stage: str = "log"):
+        super().__init__()
+        self.stage = stage
+
+    def append(self, item: str):
+        super().append(item)
+        emit(self.stage, item)
@@ -0,0 +1,446 @@
+import sys
+import time
+import uuid
+import atexit
+import threading
+import subprocess
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import Config
+from service import images
+
+SANDBOX_LABEL = "codeaidapter.sandbox"
+WORKSPACE = "/workspace"
+
+# Everything a run can write to in a pool container, the rest of its filesystem is read-only
+_WRITABLE = ("/workspace", "/tmp", "/dev/shm")
+# Kills every process except init, the keeper and the shell itself, then empties the writable
+# directories. Exits non-zero if a process or file survives, the container is then discarded.
+_RESET_SCRIPT = """
+keep=" 1 $$ {keeper} "
+left=
+for round in 1 2 3 4 5 6 7 8 9 10; do
+  left=
+  for p in /proc/[0-9]*; do
+    pid=${{p#/proc/}}
+    case "$keep" in *" $pid "*) ;; *) left=1; kill -9 "$pid" 2>/dev/null;; esac
+  done
+  [ -z "$left" ] && break
+  sleep 0.05
+done
+[ -z "$left" ] || exit 1
+rm -rf {paths}
+for f in {paths}; do [ -e "$f" ] && exit 1; done
+exit 0
+"""
+_RESET_PATHS = " ".join(f"{d}/* {d}/.[!.]* {d}/..?*" for d in _WRITABLE)
+# Lists the processes other than init and the shell, right after start that is only the keeper
+_KEEPER_SCRIPT = 'for p in /proc/[0-9]*; do pid=${p#/proc/}; [ "$pid" = 1 ] || [ "$pid" = $$ ] || echo "$pid"; done'
+
+# docker exec exit codes that mean the container itself is in a bad state
+_CONTAMINATED_CODES = {125, 126, 127, 137}
+TIMEOUT_EXIT_CODE = 124
+KILLED_EXIT_CODE = 137
+
+@dataclass
+class Container:
+    id: str
+    key: Tuple[str, str]
+    # PID of the `sleep infinity` that keeps the container alive, spared by the reset
+    keeper: int = 0
+    uses: int = 0
+    created_at: float = field(default_factory=time.time)
+
+@dataclass
+class RunResult:
+    stdout: str
+    stderr: str
+    returncode: int
+    timed_out: bool = False
+    truncated: bool = False
+    timeout: Optional[float] = None
+    cancelled: bool = False
+
+    @property
+    def aborted(self) -> bool:
+        """
+        Whether the sandbox ended the run instead of the code exiting on its own.
+        """
+        return self.cancelled or self.timed_out or self.returncode == KILLED_EXIT_CODE
+
+    def outcome(self) -> str:
+        """
+        Describe how the run ended, for error messages shown to the user and the LLM.
+        """
+        if self.cancelled:
+            return "Cancelled, the sandbox was killed."
+        if self.timed_out:
+            return f"Timed out after {self.timeout:g}s, the sandbox was killed."
+        if self.returncode == KILLED_EXIT_CODE:
+            return f"Killed (exit code {KILLED_EXIT_CODE}), most likely out of memory (limit {Config.SANDBOX_MEMORY})."
+        return f"Exited with code {self.returncode}."
+
+def resource_flags() -> List[str]:
+    """
+    docker run flags that cap the CPU, memory, processes and network of a sandbox.
+    """
+    flags = ["--network", Config.SANDBOX_NETWORK]
+    if Config.SANDBOX_CPUS:
+        flags += ["--cpus", Config.SANDBOX_CPUS]
+    if Config.SANDBOX_MEMORY:
+        # Same swap limit as memory, so the limit cannot be dodged by swapping
+        flags += ["--memory", Config.SANDBOX_MEMORY, "--memory-swap", Config.SANDBOX_MEMORY]
+    if Config.SANDBOX_PIDS:
+        flags += ["--pids-limit", str(Config.SANDBOX_PIDS)]
+    return flags
+
+def run_bounded(
+    command: List[str],
+    timeout: Optional[float] = None,
+    limit: Optional[int] = None,
+    on_timeout: Optional[Callable[[], None]] = None,
+    cancel: Optional[threading.Event] = None,
+) -> RunResult:
+    """
+    Run a command with a wall-clock deadline and keep at most `limit` bytes of each output stream.
+    The rest of the output is drained and dropped so the program cannot block on a full pipe.
+
+    Args:
+        command (List[str]): The command to run.
+        timeout (Optional[float]): Seconds before the command is killed, defaults to Config.SANDBOX_TIMEOUT.
+        limit (Optional[int]): Bytes kept per stream, defaults to Config.SANDBOX_OUTPUT_LIMIT_KB.
+        on_timeout (Optional[Callable[[], None]]): Called on timeout or cancel before the local process is killed,
+            used to kill the container the command runs in.
+        cancel (Optional[threading.Event]): Stops the command like a timeout once it is set.
+
+    Returns:
+        RunResult: Output, exit code and whether the run timed out or was truncated.
+    """
+    timeout = timeout or Config.SANDBOX_TIMEOUT
+    limit = limit or Config.SANDBOX_OUTPUT_LIMIT_KB * 1024
+    proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    buffers = {"stdout": bytearray(), "stderr": bytearray()}
+    truncated = []
+
+    def _drain(stream, buffer: bytearray):
+        for chunk in iter(lambda: stream.read(65536), b""):
+            room = limit - len(buffer)
+            if room > 0:
+                buffer.extend(chunk[:room])
+            if len(chunk) > room:
+                truncated.append(True)
+        stream.close()
+
+    readers = [
+        threading.Thread(target=_drain, args=(proc.stdout, buffers["stdout"]), daemon=True),
+        threading.Thread(target=_drain, args=(proc.stderr, buffers["stderr"]), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    timed_out = cancelled = False
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = max(deadline - time.monotonic(), 0)
+        try:
+            # With a cancel event the wait is cut into short polls
+            returncode = proc.wait(timeout=remaining if cancel is None else min(remaining, 0.1))
+            break
+        except subprocess.TimeoutExpired:
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+            elif time.monotonic() >= deadline:
+                timed_out = True
+            else:
+                continue
+        if on_timeout is not None:
+            on_timeout()
+        proc.kill()
+        proc.wait()
+        returncode = TIMEOUT_EXIT_CODE
+        break
+    for reader in readers:
+        reader.join(timeout=5)
+
+    def _text(name: str) -> str:
+        text = buffers[name].decode("utf-8", errors="replace")
+        return f"{text}\n[output truncated at {limit} bytes]" if truncated and len(buffers[name]) >= limit else text
+
+    return RunResult(
+        _text("stdout"), _text("stderr"), returncode,
+        timed_out=timed_out, truncated=bool(truncated), timeout=timeout, cancelled=cancelled,
+    )
+
+class SandboxPool:
+    def __init__(self, size: int, max_uses: int, max_idle: int = 0):
+        """
+        Keep pre-started, long-lived sandbox containers per (language, image) and run code
+        in them with `docker exec` instead of paying a cold `docker run` for every attempt.
+        Containers have a read-only root filesystem, so only /workspace, /tmp and /dev/shm can
+        be written, and are reset between runs: stray processes are killed and the writable
+        directories emptied. A container whose reset fails is discarded instead of reused.
+        Past `max_idle` idle containers in total, those of the least recently used
+        (language, image) are stopped first.
+
+        Args:
+            size (int): Idle containers kept warm per (language, image), 0 disables the pool.
+            max_uses (int): Runs after which a container is recycled.
+            max_idle (int): Idle containers kept across all images, 0 for no limit.
+        """
+        self.size = size
+        self.max_uses = max_uses
+        self.max_idle = max_idle
+        self._idle: Dict[Tuple[str, str], List[Container]] = {}
+        # Last time each (language, image) was asked for, to evict the idle containers of the coldest first
+        self._used_at: Dict[Tuple[str, str], float] = {}
+        self._busy: Dict[str, Container] = {}
+        self._warming: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        self._counters = {"started": 0, "reused": 0, "recycled": 0, "contaminated": 0, "start_failures": 0, "evicted": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def run(
+        self,
+        language: str,
+        image: str,
+        files: Dict[str, str],
+        command: List[str],
+        cancel: Optional[threading.Event] = None,
+    ) -> RunResult:
+        """
+        Run a command in a warm container of the given image.
+
+        Args:
+            language (str): Language of the code, part of the pool key.
+            image (str): Docker image to run in.
+            files (Dict[str, str]): File names and contents written to the run directory.
+            command (List[str]): Command run from inside the run directory.
+            cancel (Optional[threading.Event]): Kills the container once it is set.
+
+        Returns:
+            RunResult: Output and exit code of the command.
+        """
+        key = (language, image)
+        container = self._acquire(key)
+        workdir = f"{WORKSPACE}/{uuid.uuid4().hex}"
+        contaminated = False
+        try:
+            for name, content in files.items():
+                try:
+                    write = subprocess.run(
+                        ["docker", "exec", "-i", container.id, "sh", "-c", f"mkdir -p {workdir} && cat > {workdir}/{name}"],
+                        input=content, capture_output=True, text=True, timeout=Config.SANDBOX_TIMEOUT
+                    )
+                except subprocess.TimeoutExpired:
+                    contaminated = True
+                    raise RuntimeError(f"Timed out copying {name} into sandbox")
+                if write.returncode != 0:
+                    contaminated = True
+                    raise RuntimeError(f"Failed to copy {name} into sandbox: {write.stderr}")
+
+            # Killing `docker exec` leaves the program running, so a timeout kills the whole container
+            result = run_bounded(
+                ["docker", "exec", "-w", workdir, container.id, *command],
+                on_timeout=lambda: self._kill(container),
+                cancel=cancel,
+            )
+            contaminated = result.timed_out or result.cancelled or result.returncode in _CONTAMINATED_CODES
+            return result
+        finally:
+            if not contaminated:
+                contaminated = not self._reset(container)
+            self._release(container, contaminated)
+
+    def prewarm(self, language: str, image: str):
+        """
+        Start containers in the background until the pool for (language, image) is full.
+        """
+        if not self.enabled:
+            return
+        key = (language, image)
+        with self._lock:
+            target = min(self.size, self.max_idle) if self.max_idle else self.size
+            missing = target - len(self._idle.get(key, [])) - self._warming.get(key, 0)
+            if missing <= 0:
+                return
+            self._warming[key] = self._warming.get(key, 0) + missing
+        threading.Thread(target=self._warm, args=(key, missing), daemon=True).start()
+
+    def drop_image(self, image: str):
+        """
+        Stop the idle containers of an image so the image itself can be removed.
+        """
+        with self._lock:
+            keys = [key for key in self._idle if key[1] == image]
+            containers = [c for key in keys for c in self._idle.pop(key)]
+            for key in keys:
+                self._used_at.pop(key, None)
+        for container in containers:
+            self._kill(container)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "max_uses": self.max_uses,
+                "max_idle": self.max_idle,
+                "busy": len(self._busy),
+                "idle": {f"{language}:{image}": len(idle) for (language, image), idle in self._idle.items()},
+                **self._counters,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            containers = [c for idle in self._idle.values() for c in idle] + list(self._busy.values())
+            self._idle.clear()
+            self._busy.clear()
+        for container in containers:
+            self._kill(container)
+
+    def _acquire(self, key: Tuple[str, str]) -> Container:
+        with self._lock:
+            self._used_at[key] = time.monotonic()
+            idle = self._idle.get(key)
+            container = idle.pop() if idle else None
+            if container is not None:
+                self._counters["reused"] += 1
+                self._busy[container.id] = container
+        if container is None:
+            container = self._start(key)
+            with self._lock:
+                self._busy[container.id] = container
+        # Top the pool up for the next caller while this one runs
+        self.prewarm(*key)
+        return container
+
+    def _release(self, container: Container, contaminated: bool):
+        container.uses += 1
+        keep = not contaminated and container.uses < self.max_uses
+        with self._lock:
+            self._busy.pop(container.id, None)
+            if contaminated:
+                self._counters["contaminated"] += 1
+            elif not keep:
+                self._counters["recycled"] += 1
+            idle = self._idle.setdefault(container.key, [])
+            kept = keep and len(idle) < self.size
+            if kept:
+                idle.append(container)
+            evicted = self._over_cap()
+        for stale in evicted:
+            self._kill(stale)
+        if kept:
+            return
+        self._kill(container)
+        self.prewarm(*container.key)
+
+    def _warm(self, key: Tuple[str, str], count: int):
+        for _ in range(count):
+            try:
+                container = self._start(key)
+            except RuntimeError as e:
+                print('[sandbox.py] Prewarm failed:', e, file=sys.stderr)
+                with self._lock:
+                    self._warming[key] = 0
+                return
+            with self._lock:
+                self._warming[key] -= 1
+                self._idle.setdefault(key, []).append(container)
+                evicted = self._over_cap()
+            for stale in evicted:
+                self._kill(stale)
+
+    def _over_cap(self) -> List[Container]:
+        """
+        Take idle containers out of the pool until it is within max_idle, least recently
+        used (language, image) first. Called with the lock held, the caller stops them.
+        """
+        evicted = []
+        if not self.max_idle:
+            return evicted
+        while sum(len(idle) for idle in self._idle.values()) > self.max_idle:
+            key = min((key for key, idle in self._idle.items() if idle), key=lambda k: self._used_at.get(k, 0.0))
+            evicted.append(self._idle[key].pop(0))
+            if not self._idle[key]:
+                del self._idle[key]
+                self._used_at.pop(key, None)
+        self._counters["evicted"] += len(evicted)
+        return evicted
+
+    def _start(self, key: Tuple[str, str]) -> Container:
+        _, image = key
+        try:
+            # Pulled up front with its own timeout, so a missing image cannot stall the start
+            images.ensure(image)
+        except RuntimeError:
+            with self._lock:
+                self._counters["start_failures"] += 1
+            raise
+        try:
+            result = subprocess.run(
+                [
+                    "docker", "run", "-d", "--rm", "--pull", "never",
+                    "--label", f"{SANDBOX_LABEL}=1",
+                    *resource_flags(),
+                    # init reaps the processes the reset kills, the tmpfs mounts are all a run can write to
+                    "--init", "--read-only",
+                    "--tmpfs", f"{WORKSPACE}:exec", "--tmpfs", "/tmp:exec",
+                    "-w", WORKSPACE,
+                    "--entrypoint", "sleep",
+                    image, "infinity"
+                ],
+                capture_output=True, text=True, timeout=Config.SANDBOX_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            result = subprocess.CompletedProcess([], TIMEOUT_EXIT_CODE, "", f"timed out after {Config.SANDBOX_TIMEOUT:g}s")
+        if result.returncode != 0:
+            with self._lock:
+                self._counters["start_failures"] += 1
+            raise RuntimeError(f"Failed to start sandbox for {image}: {result.stderr.strip()}")
+        container = Container(id=result.stdout.strip(), key=key)
+        try:
+            keeper = subprocess.run(
+                ["docker", "exec", container.id, "sh", "-c", _KEEPER_SCRIPT],
+                capture_output=True, text=True, timeout=Config.SANDBOX_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            keeper = subprocess.CompletedProcess([], TIMEOUT_EXIT_CODE, "", f"timed out after {Config.SANDBOX_TIMEOUT:g}s")
+        pids = keeper.stdout.split()
+        if keeper.returncode != 0 or len(pids) != 1 or not pids[0].isdigit():
+            self._kill(container)
+            with self._lock:
+                self._counters["start_failures"] += 1
+            raise RuntimeError(f"Failed to find the keeper process of the sandbox for {image}: {keeper.stderr.strip()}")
+        container.keeper = int(pids[0])
+        with self._lock:
+            self._counters["started"] += 1
+        return container
+
+    def _reset(self, container: Container) -> bool:
+        """
+        Kill what the last run left running and empty the writable directories.
+
+        Returns:
+            bool: Whether the container is clean again.
+        """
+        script = _RESET_SCRIPT.format(keeper=container.keeper, paths=_RESET_PATHS)
+        try:
+            result = subprocess.run(
+                ["docker", "exec", container.id, "sh", "-c", script],
+                capture_output=True, text=True, timeout=Config.SANDBOX_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            return False
+        if result.returncode != 0:
+            print(f'[sandbox.py] Failed to reset sandbox {container.id[:12]}: {result.stderr.strip()}', file=sys.stderr)
+            return False
+        return True
+
+    def _kill(self, container: Container):
+        subprocess.run(["docker", "rm", "-f", container.id], capture_output=True, text=True)
+
+pool = SandboxPool(size=Config.SANDBOX_POOL_SIZE, max_uses=Config.SANDBOX_MAX_USES, max_idle=Config.SANDBOX_POOL_MAX_IDLE)
+atexit.register(pool.shutdown)
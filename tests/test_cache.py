@@ -0,0 +1,11 @@
+from utils.cache import normalize_code
+
+
+def test_normalize_code_ignores_line_endings_and_trailing_whitespace():
+    assert normalize_code("x = 1  \r\ny = 2\r\rz = 3\t\n\n") == "x = 1\ny = 2\n\nz = 3"
+    assert normalize_code("\n    indented\n") == "    indented"
+
+
+def test_normalize_code_of_nothing_is_empty():
+    assert normalize_code(None) == ""
+    assert normalize_code("") == ""
@@ -0,0 +1,25 @@
+import pytest
+
+from service.detect import UNKNOWN, _detect
+
+
+@pytest.mark.parametrize("code", [
+    "x = [1, 2]\nprint(sum(x)\n",
+    "def add(a, b)\n    return a + b\n",
+    "x = 1\n  y = 2\nz = x + y\n",
+    'name = "bob\nprint(name)\n',
+    "for i in range(3):\nprint(i)\n",
+    "import numpy as np\nnp.array([1, 2)\n",
+])
+def test_broken_python_is_still_python(code):
+    assert _detect(code).language == "python"
+
+
+@pytest.mark.parametrize("code", ["hello world", "Please fix my code, it fails:\n", ""])
+def test_prose_is_unknown(code):
+    assert _detect(code).language == UNKNOWN
+
+
+def test_broken_java_is_not_taken_for_python():
+    code = "public class Main {\n    public static void main(String[] args) {\n        int x = 1\n    }\n}\n"
+    assert _detect(code).language == "java"
@@ -0,0 +1,11 @@
+from service.extract import strip_comments
+
+
+def test_python_comment_offsets_ignore_form_feeds():
+    code = 'x = 1\n\x0c\ny = "a"  # c\nz = 2\n'
+    assert strip_comments(code, "python") == 'x = 1\n\ny = "a"\nz = 2\n'
+
+
+def test_python_comment_offsets_ignore_line_separators_in_strings():
+    code = 's = "a b"  # note\nt = 1  # other\n'
+    assert strip_comments(code, "python") == 's = "a b"\nt = 1\n'
@@ -0,0 +1,133 @@
+from service.TSID import _run_output
+from service.fixloop import FixSession, compact_error, fingerprint
+from service.sandbox import RunResult
+
+NAME_ERROR = """Traceback (most recent call last):
+  File "/workspace/main.py", line 3, in <module>
+    print(total)
+NameError: name 'total' is not defined
+"""
+
+TYPE_ERROR = """Traceback (most recent call last):
+  File "/workspace/main.py", line 5, in <module>
+    print(sum(x) + "1")
+TypeError: unsupported operand type(s) for +: 'int' and 'str'
+"""
+
+
+def test_different_python_tracebacks_get_different_fingerprints():
+    first = _run_output(RunResult(stdout="", stderr=NAME_ERROR, returncode=1))
+    second = _run_output(RunResult(stdout="", stderr=TYPE_ERROR, returncode=1))
+    assert fingerprint("python", first) != fingerprint("python", second)
+
+    session = FixSession("sum a list")
+    assert session.new_error(first, 1)
+    assert session.new_error(second, 1)
+    assert not session.new_error(first, 1)
+
+
+def test_run_output_keeps_the_outcome_of_aborted_runs():
+    timed_out = RunResult(stdout="", stderr="", returncode=124, timed_out=True, timeout=5)
+    assert _run_output(timed_out).startswith("Timed out after 5s")
+    assert _run_output(RunResult(stdout="", stderr="", returncode=3)) == "Exited with code 3."
+    assert "Exited with code" not in _run_output(RunResult(stdout="", stderr=NAME_ERROR, returncode=1))
+
+
+LIBRARY_TRACEBACK = """Traceback (most recent call last):
+  File "/workspace/main.py", line 4, in <module>
+    main()
+  File "/usr/local/lib/python3.12/json/__init__.py", line 346, in loads
+    return _default_decoder.decode(s)
+  File "/usr/local/lib/python3.12/json/decoder.py", line 355, in raw_decode
+    raise JSONDecodeError("Expecting value", s, err.value) from None
+json.decoder.JSONDecodeError: Expecting value: line 1 column 1 (char 0)
+"""
+
+JAVAC = """Main.java:3: error: cannot find symbol
+        int y = x + 1;
+                ^
+  symbol:   variable x
+  location: class Main
+Main.java:7: error: cannot find symbol
+        int z = x + 2;
+                ^
+  symbol:   variable x
+  location: class Main
+Main.java:9: warning: [removal] Integer(int) in Integer has been deprecated
+2 errors
+"""
+
+JAVA_RUNTIME = """Exception in thread "main" java.lang.ArrayIndexOutOfBoundsException: Index 5 out of bounds for length 3
+\tat Main.get(Main.java:8)
+\tat java.base/java.util.ArrayList.forEach(ArrayList.java:1596)
+\tat Main.main(Main.java:4)
+"""
+
+
+def test_compact_python_omits_library_frames():
+    compacted = compact_error("python", LIBRARY_TRACEBACK)
+    assert "  [1 library frames omitted]" in compacted
+    assert "json/__init__.py" not in compacted
+    assert 'File "/workspace/main.py", line 4' in compacted
+    assert compacted.endswith("json.decoder.JSONDecodeError: Expecting value: line 1 column 1 (char 0)")
+
+
+def test_compact_javac_keeps_each_distinct_error_once():
+    compacted = compact_error("java", JAVAC)
+    assert compacted.count("cannot find symbol") == 1
+    assert "warning" not in compacted
+    assert compacted.endswith("2 errors")
+
+
+def test_compact_java_runtime_keeps_user_frames():
+    compacted = compact_error("java", JAVA_RUNTIME)
+    assert compacted.splitlines() == [
+        'Exception in thread "main" java.lang.ArrayIndexOutOfBoundsException: Index 5 out of bounds for length 3',
+        "\tat Main.get(Main.java:8)",
+        "\tat Main.main(Main.java:4)",
+    ]
+
+
+def test_compact_error_keeps_the_outcome_line():
+    timed_out = JAVA_RUNTIME + "Timed out after 20s, the sandbox was killed."
+    assert compact_error("java", timed_out).endswith("Timed out after 20s, the sandbox was killed.")
+    assert compact_error("python", "Exited with code 3.") == "Exited with code 3."
+
+
+def test_compact_error_truncates_to_the_token_budget():
+    compacted = compact_error("python", "\n".join(f"line {i}" for i in range(1000)), max_tokens=50)
+    assert len(compacted) < 300
+    assert "characters omitted" in compacted
+
+
+def test_fingerprint_ignores_line_numbers_and_paths():
+    moved = NAME_ERROR.replace("line 3", "line 30").replace("/workspace/main.py", "/tmp/other.py")
+    assert fingerprint("python", NAME_ERROR) == fingerprint("python", moved)
+    assert fingerprint("java", JAVAC) == fingerprint("java", JAVAC.replace("Main.java:3", "Main.java:13"))
+    assert fingerprint("java", JAVA_RUNTIME) == fingerprint("java", JAVA_RUNTIME.replace("Index 5", "Index 6"))
+
+
+def test_fingerprint_tells_languages_and_outcomes_apart():
+    assert fingerprint("python", NAME_ERROR) != fingerprint("python", TYPE_ERROR)
+    assert fingerprint("java", JAVAC) != fingerprint("java", JAVA_RUNTIME)
+    timed_out = "Timed out after 20s, the sandbox was killed."
+    killed = "Killed (exit code 137), most likely out of memory (limit 512m)."
+    assert fingerprint("python", timed_out) != fingerprint("python", killed)
+
+
+def test_new_error_stops_on_a_repeated_error():
+    session = FixSession("read a list", language="java")
+    assert session.new_error("", 0)
+    assert session.new_error(JAVAC, 1)
+    assert session.new_error(JAVA_RUNTIME, 1)
+    assert not session.new_error(JAVAC.replace("Main.java:3", "Main.java:4"), 1)
+    assert session.stop_reason == "the same error repeated after a fix"
+
+
+def test_forked_sessions_share_the_errors_seen_so_far():
+    session = FixSession("sum a list")
+    session.new_error(NAME_ERROR, 1)
+    fork = session.fork()
+    assert not fork.new_error(NAME_ERROR, 1)
+    assert fork.new_error(TYPE_ERROR, 1)
+    assert session.new_error(TYPE_ERROR, 1)
@@ -0,0 +1,34 @@
+from dataclasses import dataclass
+
+from service.deploy.lifecycle import _select
+
+
+@dataclass
+class Item:
+    name: str
+    created_at: float
+    size: int = 1
+
+
+def names(chosen):
+    return [(item.name, reason) for item, reason in chosen]
+
+
+def test_zero_quota_evicts_everything_not_running():
+    items = [Item("a", 1), Item("b", 2)]
+    assert names(_select(items, 0, 0, lambda i: i.size, 10, False)) == [("a", "quota"), ("b", "quota")]
+
+
+def test_no_quota_keeps_everything():
+    items = [Item("a", 1), Item("b", 2)]
+    assert _select(items, 0, None, lambda i: i.size, 10, False) == []
+
+
+def test_quota_evicts_oldest_down_to_the_cap():
+    items = [Item("c", 3), Item("a", 1), Item("b", 2)]
+    assert names(_select(items, 0, 1, lambda i: i.size, 10, False)) == [("a", "quota"), ("b", "quota")]
+
+
+def test_ttl_comes_before_quota():
+    items = [Item("a", 1), Item("b", 8), Item("c", 9)]
+    assert names(_select(items, 5, 1, lambda i: i.size, 10, False)) == [("a", "ttl"), ("b", "quota")]
@@ -0,0 +1,12 @@
+from service import images
+from service.TSID import _metric_labels
+
+
+def test_catalog_images_keep_their_label():
+    image = images.catalog_image("python")
+    assert _metric_labels("python", image) == {"language": "python", "image": image}
+
+
+def test_images_outside_the_catalog_share_one_label():
+    assert _metric_labels("python", "someone/custom:1") == {"language": "python", "image": "other"}
+    assert _metric_labels("cobol", "cobol:latest") == {"language": "other", "image": "other"}
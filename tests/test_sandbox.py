@@ -0,0 +1,42 @@
+import itertools
+
+from service.sandbox import Container, SandboxPool
+
+clock = itertools.count(1)
+
+
+class FakePool(SandboxPool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.killed = []
+
+    def _kill(self, container):
+        self.killed.append(container.id)
+
+    def prewarm(self, language, image):
+        pass
+
+
+def use(pool, key, name):
+    pool._used_at[key] = next(clock)
+    container = Container(id=name, key=key)
+    pool._busy[container.id] = container
+    pool._release(container, contaminated=False)
+
+
+def test_idle_cap_evicts_the_least_recently_used_image():
+    pool = FakePool(size=2, max_uses=10, max_idle=3)
+    use(pool, ("python", "old"), "a")
+    use(pool, ("python", "old"), "b")
+    use(pool, ("python", "new"), "c")
+    use(pool, ("java", "newest"), "d")
+    assert pool.killed == ["a"]
+    assert pool.stats()["idle"] == {"python:old": 1, "python:new": 1, "java:newest": 1}
+    assert pool.stats()["evicted"] == 1
+
+
+def test_no_idle_cap_keeps_every_image_warm():
+    pool = FakePool(size=2, max_uses=10)
+    for i, image in enumerate(["a", "b", "c", "d"]):
+        use(pool, ("python", image), str(i))
+    assert pool.killed == []
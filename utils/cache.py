@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+def make_key(*parts: Any) -> str:
+    """
+    Build a stable content-addressed key from the given parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        data = "" if part is None else str(part)
+        digest.update(str(len(data)).encode())
+        digest.update(b":")
+        digest.update(data.encode("utf-8"))
+    return digest.hexdigest()
+
+def normalize_code(code: Optional[str]) -> str:
+    """
+    Code with line endings unified and trailing whitespace removed, so keys built from
+    it do not change with the editor the code came from.
+    """
+    if not code:
+        return ""
+    lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+class LRUCache:
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: Optional[float] = None,
+        disk_dir: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Optional[Callable[[Any], int]] = None,
+        disk_max_bytes: Optional[int] = None,
+    ):
+        """
+        Thread-safe LRU cache with an optional time-to-live and an optional on-disk tier.
+
+        Args:
+            max_entries (int): Maximum number of entries kept in memory.
+            ttl (Optional[float]): Seconds an entry stays valid, None never expires.
+            disk_dir (Optional[str]): Directory for the persistent tier, values must be JSON serializable.
+            max_bytes (Optional[int]): Maximum total size of the entries kept in memory, None for no limit.
+            sizeof (Optional[Callable[[Any], int]]): Size of a value in bytes, defaults to the length of its JSON encoding.
+            disk_max_bytes (Optional[int]): Maximum total size of the files in the disk tier, None for no limit.
+                Expired files are removed first, then the least recently used ones.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: len(json.dumps(value, default=str)))
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._sizes: dict = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_evictions = 0
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        self._disk_swept_at = 0.0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_sweep()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+
+        entry = self._disk_get(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.disk_hits += 1
+            self._put(key, *entry)
+        return entry[0]
+
+    def set(self, key: str, value: Any):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._put(key, value, expires_at)
+        self._disk_set(key, value, expires_at)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > time.time())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "disk_bytes": self._disk_bytes,
+                "disk_max_bytes": self.disk_max_bytes,
+                "disk_evictions": self.disk_evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _put(self, key: str, value: Any, expires_at: Optional[float]):
+        # Caller holds the lock
+        self._remove(key)
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._data[key] = (value, expires_at)
+        self._sizes[key] = size
+        self._bytes += size
+        while len(self._data) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        # Caller holds the lock
+        if self._data.pop(key, None) is not None:
+            self._bytes -= self._sizes.pop(key, 0)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _disk_get(self, key: str, now: float) -> Optional[tuple]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        expires_at = record.get("expires_at")
+        if expires_at is not None and expires_at <= now:
+            self._disk_remove(path)
+            return None
+        try:
+            # The sweep removes the least recently used files first, so a hit counts as a use
+            os.utime(path)
+        except OSError:
+            pass
+        return record.get("value"), expires_at
+
+    def _disk_set(self, key: str, value: Any, expires_at: Optional[float]):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"value": value, "expires_at": expires_at}, f)
+            size = os.path.getsize(tmp_path)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except (OSError, TypeError):
+            return
+        with self._lock:
+            self._disk_bytes += size - replaced
+            over = self.disk_max_bytes is not None and self._disk_bytes > self.disk_max_bytes
+        # Expired files are only found by a sweep, so sweep at least once per TTL even under the cap
+        if over or (self.ttl is not None and time.time() - self._disk_swept_at > self.ttl):
+            self._disk_sweep()
+
+    def _disk_remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes -= size
+
+    def _disk_sweep(self):
+        """
+        Remove the expired files of the disk tier, then the least recently used ones until the
+        tier is back under 90% of disk_max_bytes, so a full tier is not swept on every write.
+        """
+        if not self._disk_lock.acquire(blocking=False):
+            # Another thread is already sweeping
+            return
+        try:
+            now = time.time()
+            self._disk_swept_at = now
+            files = []
+            for root, _, names in os.walk(self.disk_dir):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if name.endswith(".tmp"):
+                        # Left behind by a write that died, unless it is still being written
+                        if now - stat.st_mtime > 60:
+                            self._unlink(path)
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+            total = 0
+            live = []
+            for mtime, size, path in files:
+                if self._disk_expired(path, now):
+                    self._unlink(path)
+                    continue
+                total += size
+                live.append((mtime, size, path))
+
+            if self.disk_max_bytes is not None and total > self.disk_max_bytes:
+                target = self.disk_max_bytes * 0.9
+                for mtime, size, path in sorted(live):
+                    if total <= target:
+                        break
+                    if self._unlink(path):
+                        total -= size
+                        self.disk_evictions += 1
+
+            with self._lock:
+                self._disk_bytes = total
+        finally:
+            self._disk_lock.release()
+
+    @staticmethod
+    def _disk_expired(path: str, now: float) -> bool:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                expires_at = json.load(f).get("expires_at")
+        except (OSError, ValueError, AttributeError):
+            # Unreadable files are never served, so they only take up space
+            return True
+        return expires_at is not None and expires_at <= now
+
+    @staticmethod
+    def _unlink(path: str) -> bool:
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
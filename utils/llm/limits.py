@@ -0,0 +1,88 @@
+import time
+import random
+import asyncio
+import threading
+from typing import Optional
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        """
+        Token bucket refilled continuously at `per_minute` tokens per minute.
+
+        Args:
+            per_minute (float): Refill rate, 0 disables the bucket.
+            capacity (Optional[float]): Burst size, defaults to one minute worth of tokens.
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        Take `amount` tokens, going into debt if needed.
+
+        Returns:
+            float: Seconds the caller has to wait before the reservation is covered.
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+
+class RateLimiter:
+    def __init__(self, max_concurrency: int, requests_per_minute: float, tokens_per_minute: float):
+        """
+        Global limit on in-flight LLM calls plus request and token buckets sized to the provider quota.
+        Shared by the sync and async clients, so it is built on thread primitives.
+        """
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def _wait_time(self, tokens: float) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def acquire(self, tokens: float, deadline: float):
+        """
+        Block until a slot is free and the quota allows the call.
+
+        Args:
+            tokens (float): Estimated tokens of the call.
+            deadline (float): time.monotonic() value after which TimeoutError is raised.
+        """
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise TimeoutError("Timed out waiting for an LLM slot")
+        wait = self._wait_time(tokens)
+        if time.monotonic() + wait > deadline:
+            self._slots.release()
+            raise TimeoutError("LLM rate limit would exceed the call deadline")
+        time.sleep(wait)
+
+    async def aacquire(self, tokens: float, deadline: float):
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                raise TimeoutError("Timed out waiting for an LLM slot")
+            await asyncio.sleep(0.01)
+        wait = self._wait_time(tokens)
+        if time.monotonic() + wait > deadline:
+            self._slots.release()
+            raise TimeoutError("LLM rate limit would exceed the call deadline")
+        await asyncio.sleep(wait)
+
+    def release(self):
+        self._slots.release()
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 20.0, retry_after: Optional[float] = None) -> float:
+    """
+    Exponential backoff with full jitter, never shorter than a server-provided Retry-After.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
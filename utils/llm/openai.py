@@ -1,30 +1,231 @@
+import time
+import asyncio
+import threading
+import weakref
+from typing import Dict, List, Optional
+
+import httpx
 import openai
 from config import Config
+from utils import metrics
+from utils import tracing
 from .base import LLMBase
+from .limits import RateLimiter, backoff
+from .replay import ReplayChat, REPLAY, from_config
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+limiter = RateLimiter(
+    max_concurrency=Config.LLM_MAX_CONCURRENCY,
+    requests_per_minute=Config.LLM_REQUESTS_PER_MINUTE,
+    tokens_per_minute=Config.LLM_TOKENS_PER_MINUTE,
+)
+
+def _retry_after(error: Exception):
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def _estimate_tokens(*texts: str) -> float:
+    # Roughly four characters per token, plus room for the completion
+    return sum(len(t or "") for t in texts) / 4 + Config.LLM_COMPLETION_TOKENS_ESTIMATE
+
+def _history_text(history: Optional[List[Dict[str, str]]]) -> str:
+    return "".join(message.get("content") or "" for message in history or ())
+
+def _record(model: str, site: str, start: float, response) -> None:
+    labels = {"model": model, "site": site or "unknown"}
+    metrics.LLM_CALL_SECONDS.labels(outcome=metrics.outcome(response is not None), **labels).observe(time.monotonic() - start)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        metrics.LLM_TOKENS.labels(kind="prompt", **labels).inc(usage.prompt_tokens or 0)
+        metrics.LLM_TOKENS.labels(kind="completion", **labels).inc(usage.completion_tokens or 0)
+        details = getattr(usage, "prompt_tokens_details", None)
+        # The active span is the llm span of this call, callers read per-call usage from it
+        span = tracing.current()
+        if span is not None:
+            span.set(
+                prompt_tokens=usage.prompt_tokens or 0,
+                completion_tokens=usage.completion_tokens or 0,
+                cached_tokens=getattr(details, "cached_tokens", 0) or 0,
+            )
+
+def _record_estimate(prompt: str, completion: str) -> None:
+    # Replayed calls carry no usage, estimate it the same way the rate limiter does
+    span = tracing.current()
+    if span is not None:
+        span.set(prompt_tokens=len(prompt) // 4, completion_tokens=len(completion or "") // 4, usage_estimated=True)
 
 class OpenAIChat(LLMBase):
     _initialized = False
     _client = None
+    _async_clients = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
     DEFAULT_MODEL = "gpt-4o-mini-2024-07-18"
+    # Record/replay backend selected by Config.LLM_BACKEND, None talks to the live API
+    backend: ReplayChat = from_config()
+
+    @classmethod
+    def use_backend(cls, backend: ReplayChat):
+        cls.backend = backend
+
+    @classmethod
+    def _limits(cls) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=Config.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.LLM_MAX_CONNECTIONS,
+            keepalive_expiry=60,
+        )
 
     @classmethod
     def _initialize(cls):
-        if not cls._initialized:
-            cls._client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
-            cls._initialized = True
-
-    @classmethod
-    def chat(cls, dev_prompt:str, usr_prompt: str, model: str = None) -> str:
-        cls._initialize()
-        model_name = model or cls.DEFAULT_MODEL
-        response = cls._client.chat.completions.create(
-            model = model_name,
-            store = True,
-            messages = [
+        with cls._lock:
+            if not cls._initialized:
+                cls._client = openai.OpenAI(
+                    api_key=Config.OPENAI_API_KEY,
+                    timeout=Config.LLM_TIMEOUT,
+                    max_retries=0,
+                    http_client=httpx.Client(limits=cls._limits(), timeout=Config.LLM_TIMEOUT),
+                )
+                cls._initialized = True
+
+    @classmethod
+    def _async_client(cls) -> openai.AsyncOpenAI:
+        # httpx async clients are bound to the event loop that created them
+        loop = asyncio.get_running_loop()
+        with cls._lock:
+            client = cls._async_clients.get(loop)
+            if client is None:
+                client = openai.AsyncOpenAI(
+                    api_key=Config.OPENAI_API_KEY,
+                    timeout=Config.LLM_TIMEOUT,
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(limits=cls._limits(), timeout=Config.LLM_TIMEOUT),
+                )
+                cls._async_clients[loop] = client
+        return client
+
+    @classmethod
+    def _request(cls, dev_prompt: str, usr_prompt: str, model: str, response_format: dict, history: Optional[List[Dict[str, str]]] = None) -> dict:
+        request = {
+            "model": model or cls.DEFAULT_MODEL,
+            "store": True,
+            "messages": [
                 {"role": "developer", "content": dev_prompt},
+                *(history or []),
                 {"role": "user", "content": usr_prompt}
-            ]
-        )
-        return response.choices[0].message.content
+            ],
+        }
+        if response_format:
+            request["response_format"] = response_format
+        return request
+
+    @classmethod
+    def chat(cls, dev_prompt:str, usr_prompt: str, model: str = None, response_format: dict = None, deadline: float = None, site: str = None, history: List[Dict[str, str]] = None) -> str:
+        """
+        Blocking chat completion with per-call deadline, jittered retries on 429/5xx and global rate limits.
+
+        Args:
+            dev_prompt (str): Developer (system) prompt.
+            usr_prompt (str): User prompt.
+            model (str): Model name, defaults to DEFAULT_MODEL.
+            response_format (dict): Optional structured output format.
+            deadline (float): Seconds the whole call may take including retries, defaults to Config.LLM_DEADLINE.
+            site (str): Name of the call site, used as a metrics label.
+            history (List[Dict[str, str]]): Earlier turns sent between the developer prompt and the user prompt.
 
-        
\ No newline at end of file
+        Returns:
+            str: The content of the first choice.
+        """
+        model = model or cls.DEFAULT_MODEL
+        with tracing.span(f"llm:{site or 'unknown'}", model=model):
+            backend = cls.backend
+            if backend is not None and backend.mode == REPLAY:
+                response = backend.chat(dev_prompt, usr_prompt, model, response_format, history)
+                _record_estimate(dev_prompt + _history_text(history) + usr_prompt, response)
+                return response
+            cls._initialize()
+            start = time.monotonic()
+            response = cls._chat(dev_prompt, usr_prompt, model, response_format, deadline, site, history)
+            if backend is not None:
+                backend.record(dev_prompt, usr_prompt, model, response_format, response, time.monotonic() - start, history)
+            return response
+
+    @classmethod
+    def _chat(cls, dev_prompt: str, usr_prompt: str, model: str, response_format: dict, deadline: float, site: str, history: Optional[List[Dict[str, str]]] = None) -> str:
+        request = cls._request(dev_prompt, usr_prompt, model, response_format, history)
+        tokens = _estimate_tokens(dev_prompt, _history_text(history), usr_prompt)
+        start = time.monotonic()
+        end = start + (deadline or Config.LLM_DEADLINE)
+        attempt = 0
+        while True:
+            limiter.acquire(tokens, end)
+            try:
+                response = cls._client.chat.completions.create(
+                    **request, timeout=min(Config.LLM_TIMEOUT, max(end - time.monotonic(), 1))
+                )
+                _record(request["model"], site, start, response)
+                return response.choices[0].message.content
+            except Exception as e:
+                delay = backoff(attempt, retry_after=_retry_after(e))
+                retryable = isinstance(e, RETRYABLE_ERRORS)
+                if not retryable or attempt >= Config.LLM_MAX_RETRIES or time.monotonic() + delay >= end:
+                    _record(request["model"], site, start, None)
+                    raise
+            finally:
+                limiter.release()
+            time.sleep(delay)
+            attempt += 1
+
+    @classmethod
+    async def achat(cls, dev_prompt: str, usr_prompt: str, model: str = None, response_format: dict = None, deadline: float = None, site: str = None, history: List[Dict[str, str]] = None) -> str:
+        """
+        Async variant of `chat` sharing the same limits and retry policy.
+        """
+        model = model or cls.DEFAULT_MODEL
+        with tracing.span(f"llm:{site or 'unknown'}", model=model):
+            backend = cls.backend
+            if backend is not None and backend.mode == REPLAY:
+                fixture = backend.lookup(dev_prompt, usr_prompt, model, response_format, history)
+                await asyncio.sleep(backend.delay(fixture))
+                _record_estimate(dev_prompt + _history_text(history) + usr_prompt, fixture["response"])
+                return fixture["response"]
+            start = time.monotonic()
+            response = await cls._achat(dev_prompt, usr_prompt, model, response_format, deadline, site, history)
+            if backend is not None:
+                backend.record(dev_prompt, usr_prompt, model, response_format, response, time.monotonic() - start, history)
+            return response
+
+    @classmethod
+    async def _achat(cls, dev_prompt: str, usr_prompt: str, model: str, response_format: dict, deadline: float, site: str, history: Optional[List[Dict[str, str]]] = None) -> str:
+        client = cls._async_client()
+        request = cls._request(dev_prompt, usr_prompt, model, response_format, history)
+        tokens = _estimate_tokens(dev_prompt, _history_text(history), usr_prompt)
+        start = time.monotonic()
+        end = start + (deadline or Config.LLM_DEADLINE)
+        attempt = 0
+        while True:
+            await limiter.aacquire(tokens, end)
+            try:
+                response = await client.chat.completions.create(
+                    **request, timeout=min(Config.LLM_TIMEOUT, max(end - time.monotonic(), 1))
+                )
+                _record(request["model"], site, start, response)
+                return response.choices[0].message.content
+            except Exception as e:
+                delay = backoff(attempt, retry_after=_retry_after(e))
+                retryable = isinstance(e, RETRYABLE_ERRORS)
+                if not retryable or attempt >= Config.LLM_MAX_RETRIES or time.monotonic() + delay >= end:
+                    _record(request["model"], site, start, None)
+                    raise
+            finally:
+                limiter.release()
+            await asyncio.sleep(delay)
+            attempt += 1
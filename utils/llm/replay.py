@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import random
+import threading
+from typing import Callable, Dict, List, Optional
+
+from config import Config
+from utils.cache import make_key
+from .base import LLMBase
+
+RECORD = "record"
+REPLAY = "replay"
+
+def parse_latency(spec: str) -> Optional[Callable[[Optional[float]], float]]:
+    """
+    Parse a synthetic latency distribution.
+
+    Supported specs: "fixed:S", "uniform:LOW,HIGH", "normal:MEAN,STDDEV",
+    "lognormal:MU,SIGMA" and "recorded" (the latency captured while recording).
+
+    Returns:
+        Optional[Callable[[Optional[float]], float]]: Sampler taking the recorded latency, or None for no delay.
+    """
+    if not spec:
+        return None
+    kind, _, args = spec.partition(":")
+    params = [float(p) for p in args.split(",") if p.strip()]
+    if kind == "fixed":
+        return lambda recorded: params[0]
+    if kind == "uniform":
+        return lambda recorded: random.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda recorded: max(0.0, random.gauss(params[0], params[1]))
+    if kind == "lognormal":
+        return lambda recorded: random.lognormvariate(params[0], params[1])
+    if kind == "recorded":
+        return lambda recorded: recorded or 0.0
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+class ReplayChat(LLMBase):
+    def __init__(self, mode: str, fixture_dir: str, latency: str = ""):
+        """
+        Record/replay LLM backend. Record mode stores every (dev_prompt, usr_prompt, model)
+        -> response pair in a fixture directory, replay mode serves them back offline.
+
+        Args:
+            mode (str): RECORD or REPLAY.
+            fixture_dir (str): Directory holding one JSON fixture per call.
+            latency (str): Synthetic latency spec used in replay mode, see parse_latency.
+        """
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown LLM backend mode: {mode}")
+        self.mode = mode
+        self.fixture_dir = fixture_dir
+        self.sampler = parse_latency(latency)
+        self._lock = threading.Lock()
+        os.makedirs(self.fixture_dir, exist_ok=True)
+
+    @staticmethod
+    def key(dev_prompt: str, usr_prompt: str, model: str, response_format: Optional[dict] = None, history: Optional[List[Dict[str, str]]] = None) -> str:
+        parts = [model, dev_prompt, usr_prompt, json.dumps(response_format, sort_keys=True) if response_format else ""]
+        # Single-turn calls keep the keys of fixtures recorded before multi-turn support
+        if history:
+            parts.append(json.dumps(history, sort_keys=True, ensure_ascii=False))
+        return make_key(*parts)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.fixture_dir, f"{key}.json")
+
+    def lookup(self, dev_prompt: str, usr_prompt: str, model: str, response_format: Optional[dict] = None, history: Optional[List[Dict[str, str]]] = None) -> dict:
+        """
+        Load the fixture of a call.
+
+        Raises:
+            LookupError: If the call was never recorded.
+        """
+        path = self._path(self.key(dev_prompt, usr_prompt, model, response_format, history))
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise LookupError(f"No recorded LLM response for this call ({os.path.basename(path)}), record it first")
+
+    def delay(self, fixture: dict) -> float:
+        return self.sampler(fixture.get("latency")) if self.sampler else 0.0
+
+    def record(self, dev_prompt: str, usr_prompt: str, model: str, response_format: Optional[dict], response: str, latency: float, history: Optional[List[Dict[str, str]]] = None):
+        fixture = {
+            "model": model,
+            "dev_prompt": dev_prompt,
+            "history": history or [],
+            "usr_prompt": usr_prompt,
+            "response_format": response_format,
+            "response": response,
+            "latency": latency,
+        }
+        path = self._path(self.key(dev_prompt, usr_prompt, model, response_format, history))
+        with self._lock:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(fixture, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+
+    def chat(self, dev_prompt: str, usr_prompt: str, model: str = None, response_format: dict = None, history: List[Dict[str, str]] = None) -> str:
+        fixture = self.lookup(dev_prompt, usr_prompt, model, response_format, history)
+        time.sleep(self.delay(fixture))
+        return fixture["response"]
+
+def from_config() -> Optional[ReplayChat]:
+    """
+    Build the backend selected by Config.LLM_BACKEND, None for the live API.
+    """
+    if Config.LLM_BACKEND in ("", "openai"):
+        return None
+    return ReplayChat(Config.LLM_BACKEND, Config.LLM_FIXTURE_DIR, Config.LLM_REPLAY_LATENCY)
@@ -0,0 +1,86 @@
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+LLM_CALL_SECONDS = Histogram(
+    "codeaidapter_llm_call_seconds",
+    "Latency of LLM calls including retries.",
+    ["model", "site", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "codeaidapter_llm_tokens_total",
+    "Tokens used by LLM calls.",
+    ["model", "site", "kind"],
+)
+SANDBOX_RUN_SECONDS = Histogram(
+    "codeaidapter_sandbox_run_seconds",
+    "Duration of run_code executions.",
+    ["language", "image"],
+    buckets=LATENCY_BUCKETS,
+)
+SANDBOX_EXIT_CODES = Counter(
+    "codeaidapter_sandbox_exit_total",
+    "Exit codes of run_code executions.",
+    ["language", "image", "exit_code"],
+)
+SANDBOX_RUN_CACHE = Counter(
+    "codeaidapter_sandbox_run_cache_total",
+    "Lookups of the sandbox result cache.",
+    ["result"],
+)
+JOB_QUEUE_DEPTH = Gauge(
+    "codeaidapter_job_queue_depth",
+    "Jobs waiting for a worker, per lane.",
+    ["lane"],
+)
+JOB_QUEUE_WAIT_SECONDS = Histogram(
+    "codeaidapter_job_queue_wait_seconds",
+    "Time jobs waited for a worker, per lane.",
+    ["lane"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120),
+)
+JOBS_REJECTED = Counter(
+    "codeaidapter_jobs_rejected_total",
+    "Requests turned away with 429 because a lane was full or a client was at its limit.",
+    ["lane", "reason"],
+)
+JOBS_COALESCED = Counter(
+    "codeaidapter_jobs_coalesced_total",
+    "Requests attached to an identical job that was running or had just finished.",
+    ["state"],
+)
+FIX_LOOP_ITERATIONS = Histogram(
+    "codeaidapter_fix_loop_iterations",
+    "Fix rounds needed per conversion request.",
+    ["task", "mode"],
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12),
+)
+DEPLOY_STAGE_SECONDS = Histogram(
+    "codeaidapter_deploy_stage_seconds",
+    "Duration of deploy stages (build, tag, push, apply, pod wait, logs).",
+    ["stage", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+LIFECYCLE_RECLAIMED_OBJECTS = Counter(
+    "codeaidapter_lifecycle_reclaimed_objects_total",
+    "Deploy workspaces, images and Kubernetes objects removed by the lifecycle manager.",
+    ["kind", "reason"],
+)
+LIFECYCLE_RECLAIMED_BYTES = Counter(
+    "codeaidapter_lifecycle_reclaimed_bytes_total",
+    "Disk space freed by removing deploy workspaces and images.",
+    ["kind"],
+)
+
+def outcome(ok: bool) -> str:
+    return "success" if ok else "failure"
+
+def export() -> tuple:
+    """
+    Render all metrics in the Prometheus text format.
+
+    Returns:
+        tuple: The payload and its content type.
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
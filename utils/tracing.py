@@ -0,0 +1,192 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import threading
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from config import Config
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    parent_id: Optional[str] = None
+    start_time: float = field(default_factory=time.time)
+    attributes: Dict[str, object] = field(default_factory=dict)
+    children: List["Span"] = field(default_factory=list)
+    error: Optional[str] = None
+    _start: float = field(default_factory=time.monotonic, repr=False)
+    _end: Optional[float] = field(default=None, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def duration(self) -> float:
+        return (self._end if self._end is not None else time.monotonic()) - self._start
+
+    @property
+    def end_time(self) -> float:
+        return self.start_time + self.duration
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def child(self, name: str, **attributes) -> "Span":
+        span = Span(name=name, trace_id=self.trace_id, parent_id=self.span_id, attributes=attributes)
+        # Children can be added from several candidate threads at once
+        with self._lock:
+            self.children.append(span)
+        return span
+
+    def finish(self):
+        self._end = time.monotonic()
+
+    def walk(self):
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+            "children": [child.to_dict() for child in list(self.children)],
+        }
+
+_current: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time a stage as a child of the active span. Outside a trace the span is timed but not recorded.
+    """
+    parent = _current.get()
+    if parent is not None:
+        s = parent.child(name, **attributes)
+    else:
+        s = Span(name=name, trace_id=uuid.uuid4().hex, attributes=attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except Exception as e:
+        s.error = str(e)
+        raise
+    finally:
+        s.finish()
+        _current.reset(token)
+
+@contextmanager
+def trace(name: str, **attributes):
+    """
+    Start a new trace with `name` as its root span and export it when the block ends.
+    """
+    root = Span(name=name, trace_id=uuid.uuid4().hex, attributes=attributes)
+    token = _current.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = str(e)
+        raise
+    finally:
+        root.finish()
+        _current.reset(token)
+        export(root)
+
+def server_timing(root: Optional[Span]) -> str:
+    """
+    Summarize a trace as a Server-Timing header value, one entry per stage name.
+    """
+    if root is None:
+        return ""
+    totals: Dict[str, List[float]] = {}
+    for s in root.walk():
+        if s is root:
+            continue
+        entry = totals.setdefault(re.sub(r"[^A-Za-z0-9_-]", "_", s.name), [0.0, 0])
+        entry[0] += s.duration
+        entry[1] += 1
+    metrics = [f'total;dur={root.duration * 1000:.1f}']
+    for name, (duration, count) in totals.items():
+        metric = f"{name};dur={duration * 1000:.1f}"
+        if count > 1:
+            metric += f';desc="{count}x"'
+        metrics.append(metric)
+    return ", ".join(metrics)
+
+_file_lock = threading.Lock()
+
+def export(root: Span):
+    """
+    Write a finished trace to the JSONL trace file and, when configured, to an OTLP/HTTP collector.
+    """
+    if Config.TRACE_FILE:
+        line = json.dumps(root.to_dict(), ensure_ascii=False, default=str)
+        with _file_lock:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(Config.TRACE_FILE)), exist_ok=True)
+                if os.path.exists(Config.TRACE_FILE) and os.path.getsize(Config.TRACE_FILE) > Config.TRACE_FILE_MAX_MB * 1024 * 1024:
+                    os.replace(Config.TRACE_FILE, f"{Config.TRACE_FILE}.1")
+                with open(Config.TRACE_FILE, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                print('[tracing.py] Failed to write trace:', e, file=sys.stderr)
+    if Config.OTLP_ENDPOINT:
+        threading.Thread(target=_send_otlp, args=(root,), daemon=True).start()
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_span(s: Span) -> dict:
+    span = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": 1,
+        "startTimeUnixNano": str(int(s.start_time * 1e9)),
+        "endTimeUnixNano": str(int(s.end_time * 1e9)),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+    if s.parent_id:
+        span["parentSpanId"] = s.parent_id
+    return span
+
+def _send_otlp(root: Span):
+    payload = {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "codeaidapter-server"}}]},
+            "scopeSpans": [{"scope": {"name": "codeaidapter"}, "spans": [_otlp_span(s) for s in root.walk()]}],
+        }]
+    }
+    request = urllib.request.Request(
+        f"{Config.OTLP_ENDPOINT.rstrip('/')}/v1/traces",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        urllib.request.urlopen(request, timeout=5).close()
+    except OSError as e:
+        print('[tracing.py] Failed to export trace:', e, file=sys.stderr)
@@ -13,4 +13,6 @@ class CodeResponse:
     filename: Optional[str]
     success_msg: Optional[str]
     error_msg: Optional[str]
-    status: bool
\ No newline at end of file
+    status: bool
+    # Token usage of each generate/fix iteration, when the response came from the LLM
+    usage: Optional[List[dict]] = None
\ No newline at end of file